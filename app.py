@@ -1,25 +1,83 @@
 from __future__ import annotations
 
-from dataclasses import dataclass, field
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
+from datetime import date, datetime, timedelta
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import os
+import queue
 import random
+import re
 import secrets
+import signal
 import ast
+import atexit
+import copy
 import math
+import mimetypes
 import difflib
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+from collections import Counter, OrderedDict, deque
 import sys
-from typing import Optional
+import threading
+import tempfile
+import time
+from multiprocessing.managers import BaseManager
+from typing import Any, Callable, Optional
 from uuid import uuid4
 
-from flask import Flask, flash, jsonify, redirect, render_template, request, session, url_for
+import click
+from flask import (
+    Flask,
+    Response,
+    flash,
+    g,
+    has_request_context,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_from_directory,
+    session,
+    stream_with_context,
+    url_for,
+)
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import inspect, text
-from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy import case, delete, event, func, inspect, or_, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import NEVER_SET, NO_VALUE
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
-REQUIRED_DB_PATH = '/home/Sanya1825/DRAsite_data/databaseDRA.db'
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+DB_PATH_ENV = 'DRA_DB_PATH'
+REQUIRED_DB_PATH = os.environ.get(DB_PATH_ENV) or '/home/Sanya1825/DRAsite_data/databaseDRA.db'
 REQUIRED_DB_URI = f"sqlite:///{REQUIRED_DB_PATH}"
 
 
@@ -36,7 +94,62 @@ def _normalize_database_uri(db_uri: Optional[str]) -> str:
     return REQUIRED_DB_URI
 
 
+JSON_BACKEND_ENV = 'JSON_BACKEND'
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider that encodes with orjson when it is installed and the stdlib otherwise.
+
+    Both paths write datetimes as ISO 8601 (`datetime.isoformat()`), so API payloads look the
+    same whichever encoder produced them. Set JSON_BACKEND=stdlib to force the fallback.
+    """
+
+    use_orjson = orjson is not None and os.environ.get(JSON_BACKEND_ENV, '').strip().lower() != 'stdlib'
+
+    @staticmethod
+    def default(value: Any) -> Any:
+        if isinstance(value, (date, datetime)):
+            return value.isoformat()
+        return DefaultJSONProvider.default(value)
+
+    def _orjson_options(self, **kwargs: Any) -> int:
+        options = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            options |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if self.use_orjson:
+            try:
+                return orjson.dumps(obj, default=self.default, option=self._orjson_options(**kwargs)).decode('utf-8')
+            except TypeError:
+                pass
+        kwargs.setdefault('default', self.default)
+        kwargs.setdefault('ensure_ascii', self.ensure_ascii)
+        kwargs.setdefault('sort_keys', self.sort_keys)
+        return json.dumps(obj, **kwargs)
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        if self.use_orjson and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        if not self.use_orjson:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self._app.debug if self.compact is None else not self.compact
+        try:
+            body = orjson.dumps(obj, default=self.default, option=self._orjson_options(indent=indent))
+        except TypeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 app.config['SQLALCHEMY_DATABASE_URI'] = _normalize_database_uri(os.environ.get('DATABASE_URL'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'supersecretkey')
@@ -46,11 +159,33 @@ RESET_DB_ENV = 'RESET_DB_ON_START'
 INVENTORY_DEBUG_ENV = 'DEBUG_INVENTORY'
 SHOP_DEBUG_ENV = 'DEBUG_SHOP'
 DEBUG_GIVEID_ENV = 'DEBUG_GIVEID'
+TEMPLATE_SEARCH_BACKEND_ENV = 'TEMPLATE_SEARCH_BACKEND'
+CHAT_RETENTION_ENV = 'CHAT_RETENTION_DAYS'
+CHAT_ARCHIVE_DIR = os.path.join(os.path.dirname(REQUIRED_DB_PATH), 'chat_archive')
+CHAT_ARCHIVE_BATCH = 2000
+CHAT_ARCHIVE_INTERVAL_SECONDS = 60 * 60
+# A pending segment older than this belongs to a pass that died between writing it and promoting it.
+CHAT_ARCHIVE_PENDING_GRACE_SECONDS = 10 * 60
+STATE_BACKEND_ENV = 'STATE_BACKEND'
+STATE_SERVER_ADDRESS_ENV = 'STATE_SERVER_ADDRESS'
+DEFAULT_STATE_SERVER_ADDRESS = os.path.join(os.path.dirname(REQUIRED_DB_PATH), 'state.sock')
 INVENTORY_LOG_FILE = 'inventory_debug.log'
+LOG_SAMPLE_RATES_ENV = 'LOG_SAMPLE_RATES'
 ALLOWED_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
 ALLOWED_IMAGE_MIME_TYPES = {'image/jpeg', 'image/png', 'image/webp'}
 MAX_AVATAR_SIZE_BYTES = 2 * 1024 * 1024
 MAX_ITEM_IMAGE_BYTES = 5 * 1024 * 1024
+UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_CHUNK_BYTES = 64 * 1024
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+)
+ITEM_IMAGE_SIZES = (64, 160, 320)
+ITEM_IMAGE_WEBP_QUALITY = 80
+UPLOAD_GC_GRACE_SECONDS = 60 * 60
+UPLOAD_GC_INTERVAL_SECONDS = 10 * 60
+CONTENT_ADDRESSED_NAME = re.compile(r'^[0-9a-f]{64}(?:_\d+)?\.[a-z0-9]+$')
 MAIN_GRID_WIDTH = 5
 MAIN_GRID_HEIGHT = 3
 BACKPACK_GRID_WIDTH = 8
@@ -70,6 +205,115 @@ CHARACTER_CLASSES = {
     '???',
 }
 SKILL_CHECK_TIME_LIMIT = 30
+SKILL_CHECK_RESCAN_SECONDS = 5
+SKILL_CHECK_HISTORY_LIMIT = 50
+CHAT_PAGE_LIMIT = 120
+CHAT_FLUSH_INTERVAL_SECONDS = 0.25
+CHAT_BUFFER_CAPACITY = 5000
+CHAT_BUFFER_MAX_EVENTS = 50000
+CHAT_FLUSH_MAX_ATTEMPTS = 5
+SHOP_CACHE_CAPACITY = 256
+SHOP_TAKE_ATTEMPTS = 3
+INVENTORY_BATCH_LIMIT = 100
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 5
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/javascript',
+    'text/javascript',
+    'text/css',
+    'text/html',
+    'text/plain',
+    'image/svg+xml',
+}
+PRECOMPRESS_EXTENSIONS = {'.js', '.css', '.html', '.json', '.svg', '.txt'}
+STATIC_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Werkzeug rejects larger bodies from Content-Length before the form is parsed.
+app.config['MAX_CONTENT_LENGTH'] = MAX_ITEM_IMAGE_BYTES + UPLOAD_FORM_OVERHEAD_BYTES
+
+
+TRUTHY_ENV_VALUES = {'1', 'true', 'yes', 'on'}
+MAIN_GRID_ENV = 'MAIN_GRID_SIZE'
+HANDS_GRID_ENV = 'HANDS_GRID_SIZE'
+DEBUG_ENDPOINTS_ENV = 'DEBUG_ENDPOINTS'
+METRICS_TOKEN_ENV = 'METRICS_TOKEN'
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, '').strip().lower() in TRUTHY_ENV_VALUES
+
+
+def _env_grid(name: str, default: tuple[int, int]) -> tuple[int, int]:
+    """Parse a `WxH` grid size, keeping the default for anything malformed."""
+    width, _, height = os.environ.get(name, '').strip().lower().partition('x')
+    try:
+        size = int(width), int(height)
+    except ValueError:
+        return default
+    return size if min(size) > 0 else default
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Environment-derived settings, read once so hot paths check attributes instead of os.environ."""
+
+    debug_inventory: bool = False
+    debug_shop: bool = False
+    debug_giveid: bool = False
+    template_search_backend: str = 'memory'
+    main_grid: tuple[int, int] = (MAIN_GRID_WIDTH, MAIN_GRID_HEIGHT)
+    hands_grid: tuple[int, int] = (HANDS_GRID_WIDTH, HANDS_GRID_HEIGHT)
+    debug_endpoints: bool = False
+    metrics_token: str = ''
+
+    @classmethod
+    def from_env(cls) -> 'Settings':
+        return cls(
+            debug_inventory=_env_flag(INVENTORY_DEBUG_ENV),
+            debug_shop=_env_flag(SHOP_DEBUG_ENV),
+            debug_giveid=_env_flag(DEBUG_GIVEID_ENV),
+            template_search_backend=os.environ.get(TEMPLATE_SEARCH_BACKEND_ENV, '').strip().lower() or 'memory',
+            main_grid=_env_grid(MAIN_GRID_ENV, (MAIN_GRID_WIDTH, MAIN_GRID_HEIGHT)),
+            hands_grid=_env_grid(HANDS_GRID_ENV, (HANDS_GRID_WIDTH, HANDS_GRID_HEIGHT)),
+            debug_endpoints=_env_flag(DEBUG_ENDPOINTS_ENV),
+            metrics_token=os.environ.get(METRICS_TOKEN_ENV, '').strip(),
+        )
+
+
+settings = Settings.from_env()
+settings_reload_hooks: list[Callable[[Settings, Settings], None]] = []
+
+
+def reload_settings() -> Settings:
+    """Re-read the environment and run hooks with (old, new); per process, like the settings."""
+    global settings
+    previous, settings = settings, Settings.from_env()
+    for hook in settings_reload_hooks:
+        hook(previous, settings)
+    return settings
+
+
+def _reload_settings_on_signal(_signum, _frame) -> None:
+    # Hooks take logging locks, which the interrupted main thread may be holding.
+    threading.Thread(target=reload_settings, name='settings-reload', daemon=True).start()
+
+
+def install_settings_reload_signal() -> bool:
+    """Reload settings on SIGHUP (`kill -HUP <pid>`) unless the server already handles it."""
+    reload_signal = getattr(signal, 'SIGHUP', None)
+    if reload_signal is None or threading.current_thread() is not threading.main_thread():
+        return False
+    if signal.getsignal(reload_signal) not in (signal.SIG_DFL, None):
+        return False
+    signal.signal(reload_signal, _reload_settings_on_signal)
+    return True
+
+
+install_settings_reload_signal()
 
 
 @dataclass
@@ -83,9 +327,7 @@ class ActiveSkillCheck:
     started_at: Optional[datetime] = None
     expires_at: Optional[datetime] = None
     result: Optional[str] = None
-
-
-ACTIVE_SKILL_CHECKS: dict[int, ActiveSkillCheck] = {}
+    master_user_id: Optional[int] = None
 
 
 @dataclass
@@ -96,7 +338,6 @@ class ActiveShop:
     started_at: datetime = field(default_factory=datetime.utcnow)
 
 
-ACTIVE_SHOPS: dict[int, ActiveShop] = {}
 EQUIPMENT_GRIDS = {
     'equip_head': (3, 2),
     'equip_shirt': (3, 2),
@@ -158,25 +399,108 @@ db = SQLAlchemy(app)
 class RequestIdFilter(logging.Filter):
     def filter(self, record: logging.LogRecord) -> bool:
         if not hasattr(record, 'request_id'):
-            record.request_id = '-'
+            record.request_id = g.get('request_id', '-') if has_request_context() else '-'
         return True
 
 
+def log_sample_rates() -> dict[str, float]:
+    """Parse LOG_SAMPLE_RATES, e.g. `inventory=0.05,dra.giveid=1`."""
+    rates = {}
+    for entry in os.environ.get(LOG_SAMPLE_RATES_ENV, '').split(','):
+        name, _, raw_rate = entry.partition('=')
+        try:
+            rates[name.strip()] = min(max(float(raw_rate), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of DEBUG/INFO records; warnings and errors always pass."""
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or self.rate >= 1.0 or random.random() < self.rate
+
+
+_STANDARD_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record; `extra=` fields are kept as top-level keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'ts': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_RECORD_FIELDS and key not in payload:
+                payload[key] = value
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exc_info'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class StructuredQueueHandler(QueueHandler):
+    """QueueHandler that hands the listener a record the JSON formatter can still take apart.
+
+    The stock prepare() bakes the traceback into `message` and clears exc_info; here the
+    traceback is rendered into exc_text on the calling thread and the message stays plain.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            # Drop the traceback so queued records don't keep request frames alive.
+            record.exc_info = None
+        return record
+
+
+_log_listeners: list[QueueListener] = []
+
+
+def _attach_queued_handler(logger: logging.Logger, target: logging.Handler) -> None:
+    """Route a logger through a queue so the request thread never waits on the target's I/O.
+
+    Request-id and sampling filters run on the calling thread, where the request context is;
+    the listener thread only formats and writes.
+    """
+    target.setFormatter(JsonLogFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(SamplingFilter(log_sample_rates().get(logger.name, 1.0)))
+    logger.addHandler(queue_handler)
+    listener = QueueListener(log_queue, target, respect_handler_level=True)
+    listener.start()
+    _log_listeners.append(listener)
+
+
+@atexit.register
+def _stop_log_listeners() -> None:
+    for listener in _log_listeners:
+        listener.stop()
+
+
 def _setup_giveid_logger() -> logging.Logger:
     logger = logging.getLogger('dra.giveid')
     logger.setLevel(logging.DEBUG)
-    handler_exists = any(
-        isinstance(handler, logging.StreamHandler) and handler.stream is sys.stderr
-        for handler in logger.handlers
-    )
-    if not handler_exists:
+    if not any(isinstance(handler, QueueHandler) for handler in logger.handlers):
         handler = logging.StreamHandler(sys.stderr)
         handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s [%(levelname)s] [%(request_id)s] %(message)s')
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-    if not any(isinstance(existing, RequestIdFilter) for existing in logger.filters):
-        logger.addFilter(RequestIdFilter())
+        _attach_queued_handler(logger, handler)
     logger.propagate = False
     return logger
 
@@ -184,14 +508,12 @@ def _setup_giveid_logger() -> logging.Logger:
 def _setup_inventory_logger() -> logging.Logger:
     logger = logging.getLogger('inventory')
     logger.setLevel(logging.DEBUG)
-    if not any(isinstance(handler, logging.FileHandler) for handler in logger.handlers):
-        if os.environ.get(INVENTORY_DEBUG_ENV, '').strip() in {'1', 'true', 'yes'}:
+    if not any(isinstance(handler, QueueHandler) for handler in logger.handlers):
+        if settings.debug_inventory:
             log_path = os.path.join(app.root_path, INVENTORY_LOG_FILE)
             handler = logging.FileHandler(log_path)
             handler.setLevel(logging.DEBUG)
-            formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
-            handler.setFormatter(formatter)
-            logger.addHandler(handler)
+            _attach_queued_handler(logger, handler)
     return logger
 
 
@@ -199,6 +521,28 @@ inventory_logger = _setup_inventory_logger()
 giveid_logger = _setup_giveid_logger()
 
 
+def _detach_queued_handlers(logger: logging.Logger) -> None:
+    """Undo _attach_queued_handler: drain and stop the listener, then close its targets."""
+    for handler in [handler for handler in logger.handlers if isinstance(handler, QueueHandler)]:
+        logger.removeHandler(handler)
+        handler.close()
+        for listener in [listener for listener in _log_listeners if listener.queue is handler.queue]:
+            listener.stop()
+            _log_listeners.remove(listener)
+            for target in listener.handlers:
+                target.close()
+
+
+def _sync_inventory_logger(_previous: Settings, current: Settings) -> None:
+    if current.debug_inventory:
+        _setup_inventory_logger()
+    else:
+        _detach_queued_handlers(inventory_logger)
+
+
+settings_reload_hooks.append(_sync_inventory_logger)
+
+
 class User(db.Model):
     __tablename__ = 'userid'
 
@@ -225,6 +569,7 @@ class Lobby(db.Model):
     access_key = db.Column(db.String(16), unique=True, nullable=False)
     admin_id = db.Column(db.Integer, db.ForeignKey('userid.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    chat_retention_days = db.Column(db.Integer, nullable=True)
 
     admin = db.relationship('User', back_populates='owned_lobbies')
     members = db.relationship('LobbyMember', back_populates='lobby', cascade='all, delete-orphan')
@@ -277,6 +622,7 @@ class ItemDefinition(db.Model):
     bag_height = db.Column(db.Integer, nullable=True)
     fast_w = db.Column(db.Integer, nullable=True)
     fast_h = db.Column(db.Integer, nullable=True)
+    image_variants = db.Column(db.Text, nullable=True)
     type_id = db.Column(db.Integer, db.ForeignKey('item_type.id'), nullable=False)
 
     item_type = db.relationship('ItemType', back_populates='definitions')
@@ -303,6 +649,9 @@ class ItemInstance(db.Model):
 
     definition = db.relationship('ItemDefinition', back_populates='instances')
 
+    # Every flush writes with WHERE id = ? AND version = <loaded version>; routes still bump version themselves.
+    __mapper_args__ = {'version_id_col': version, 'version_id_generator': False}
+
 
 @dataclass
 class PlacementPreview:
@@ -363,6 +712,565 @@ class ChatMessage(db.Model):
 
     user = db.relationship('User')
 
+    __table_args__ = (
+        db.Index('ix_chat_message_lobby_id_id', 'lobby_id', 'id'),
+    )
+
+
+# Identifies this process run; a restarted container can get the old PID back, but never this token.
+WORKER_BOOT_TOKEN = uuid4().hex
+
+
+class BackgroundJob(db.Model):
+    __tablename__ = 'background_job'
+
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    payload = db.Column(db.Text, nullable=True)
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.String(255), nullable=True)
+    progress_done = db.Column(db.Integer, nullable=False, default=0)
+    progress_total = db.Column(db.Integer, nullable=False, default=0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    worker_pid = db.Column(db.Integer, nullable=True)
+    worker_token = db.Column(db.String(32), nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('userid.id'), nullable=True)
+    lobby_id = db.Column(db.Integer, db.ForeignKey('lobby.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class SkillCheckResult(db.Model):
+    __tablename__ = 'skill_check_result'
+
+    id = db.Column(db.Integer, primary_key=True)
+    check_id = db.Column(db.String(16), nullable=False)
+    lobby_id = db.Column(db.Integer, db.ForeignKey('lobby.id'), nullable=False)
+    target_user_id = db.Column(db.Integer, db.ForeignKey('userid.id'), nullable=False)
+    master_user_id = db.Column(db.Integer, db.ForeignKey('userid.id'), nullable=True)
+    difficulty = db.Column(db.Integer, nullable=False)
+    result = db.Column(db.String(20), nullable=False)
+    reason = db.Column(db.String(20), nullable=False, default='result')
+    successes = db.Column(db.Integer, nullable=True)
+    failures = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    completed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_skill_check_result_lobby_id_id', 'lobby_id', 'id'),
+    )
+
+
+class UploadBlob(db.Model):
+    __tablename__ = 'upload_blob'
+
+    path = db.Column(db.String(255), primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.Integer, nullable=False, default=0)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    orphaned_at = db.Column(db.DateTime, nullable=True)
+
+
+class SharedState(db.Model):
+    __tablename__ = 'shared_state'
+
+    namespace = db.Column(db.String(40), primary_key=True)
+    key = db.Column(db.String(80), primary_key=True)
+    value = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class MemoryStateBackend:
+    """Per-process state; only correct with a single worker."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._data: dict[str, dict[str, str]] = {}
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        with self._lock:
+            return self._data.get(namespace, {}).get(key)
+
+    def set(self, namespace: str, key: str, value: str) -> None:
+        with self._lock:
+            self._data.setdefault(namespace, {})[key] = value
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with self._lock:
+            return self._data.get(namespace, {}).pop(key, None) is not None
+
+    def incr(self, namespace: str, key: str) -> int:
+        with self._lock:
+            bucket = self._data.setdefault(namespace, {})
+            value = int(bucket.get(key) or 0) + 1
+            bucket[key] = str(value)
+            return value
+
+    def incr_many(self, namespace: str, keys: list[str]) -> dict[str, int]:
+        with self._lock:
+            bucket = self._data.setdefault(namespace, {})
+            values = {}
+            for key in keys:
+                values[key] = int(bucket.get(key) or 0) + 1
+                bucket[key] = str(values[key])
+            return values
+
+    def items(self, namespace: str, prefix: str = '') -> dict[str, str]:
+        with self._lock:
+            return {
+                key: value
+                for key, value in self._data.get(namespace, {}).items()
+                if key.startswith(prefix)
+            }
+
+
+class SqliteStateBackend:
+    """State kept in the shared_state table, visible to every worker using the database."""
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        with db.engine.connect() as connection:
+            return connection.execute(
+                text('SELECT value FROM shared_state WHERE namespace = :namespace AND key = :key'),
+                {'namespace': namespace, 'key': key},
+            ).scalar()
+
+    def set(self, namespace: str, key: str, value: str) -> None:
+        with db.engine.begin() as connection:
+            connection.execute(
+                text(
+                    'INSERT INTO shared_state (namespace, key, value, updated_at) '
+                    'VALUES (:namespace, :key, :value, :updated_at) '
+                    'ON CONFLICT (namespace, key) DO UPDATE SET '
+                    'value = excluded.value, updated_at = excluded.updated_at'
+                ),
+                {'namespace': namespace, 'key': key, 'value': value, 'updated_at': datetime.utcnow()},
+            )
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with db.engine.begin() as connection:
+            result = connection.execute(
+                text('DELETE FROM shared_state WHERE namespace = :namespace AND key = :key'),
+                {'namespace': namespace, 'key': key},
+            )
+        return result.rowcount > 0
+
+    _INCR_SQL = text(
+        'INSERT INTO shared_state (namespace, key, value, updated_at) '
+        "VALUES (:namespace, :key, '1', :updated_at) "
+        'ON CONFLICT (namespace, key) DO UPDATE SET '
+        'value = CAST(shared_state.value AS INTEGER) + 1, updated_at = excluded.updated_at '
+        'RETURNING value'
+    )
+
+    def incr(self, namespace: str, key: str) -> int:
+        return self.incr_many(namespace, [key])[key]
+
+    def incr_many(self, namespace: str, keys: list[str]) -> dict[str, int]:
+        # One transaction for the whole set, so a commit takes the write lock once.
+        now = datetime.utcnow()
+        with db.engine.begin() as connection:
+            return {
+                key: int(connection.execute(
+                    self._INCR_SQL,
+                    {'namespace': namespace, 'key': key, 'updated_at': now},
+                ).scalar())
+                for key in keys
+            }
+
+    def items(self, namespace: str, prefix: str = '') -> dict[str, str]:
+        with db.engine.connect() as connection:
+            rows = connection.execute(
+                text(
+                    'SELECT key, value FROM shared_state '
+                    'WHERE namespace = :namespace AND substr(key, 1, :prefix_length) = :prefix'
+                ),
+                {'namespace': namespace, 'prefix': prefix, 'prefix_length': len(prefix)},
+            ).all()
+        return {key: value for key, value in rows}
+
+
+class StateManager(BaseManager):
+    pass
+
+
+_STATE_SERVER_STORE = MemoryStateBackend()
+StateManager.register('state', callable=lambda: _STATE_SERVER_STORE)
+
+
+class SocketStateBackend:
+    """Client for the state server started with `flask state-server`."""
+
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self._lock = threading.Lock()
+        self._store = None
+
+    def _connect(self):
+        with self._lock:
+            if self._store is None:
+                manager = StateManager(address=self.address, authkey=app.config['SECRET_KEY'].encode('utf-8'))
+                manager.connect()
+                self._store = manager.state()
+            return self._store
+
+    def _call(self, method: str, *args):
+        for attempt in range(2):
+            try:
+                return getattr(self._connect(), method)(*args)
+            except (ConnectionError, EOFError, OSError):
+                # The server may have restarted; reconnect once before giving up.
+                with self._lock:
+                    self._store = None
+                if attempt:
+                    raise
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        return self._call('get', namespace, key)
+
+    def set(self, namespace: str, key: str, value: str) -> None:
+        self._call('set', namespace, key, value)
+
+    def delete(self, namespace: str, key: str) -> bool:
+        return self._call('delete', namespace, key)
+
+    def incr(self, namespace: str, key: str) -> int:
+        return self._call('incr', namespace, key)
+
+    def incr_many(self, namespace: str, keys: list[str]) -> dict[str, int]:
+        return self._call('incr_many', namespace, keys)
+
+    def items(self, namespace: str, prefix: str = '') -> dict[str, str]:
+        return self._call('items', namespace, prefix)
+
+
+_state_backend = None
+_state_backend_lock = threading.Lock()
+
+
+def state_server_address() -> str:
+    return os.environ.get(STATE_SERVER_ADDRESS_ENV, '').strip() or DEFAULT_STATE_SERVER_ADDRESS
+
+
+def get_state_backend():
+    global _state_backend
+    with _state_backend_lock:
+        if _state_backend is None:
+            backend = os.environ.get(STATE_BACKEND_ENV, '').strip().lower()
+            if backend == 'sqlite':
+                _state_backend = SqliteStateBackend()
+            elif backend == 'socket':
+                _state_backend = SocketStateBackend(state_server_address())
+            else:
+                _state_backend = MemoryStateBackend()
+        return _state_backend
+
+
+def _dump_state_value(value) -> str:
+    data = {}
+    for item in fields(value):
+        raw = getattr(value, item.name)
+        data[item.name] = {'$dt': raw.isoformat()} if isinstance(raw, datetime) else raw
+    return json.dumps(data)
+
+
+def _load_state_value(factory, raw: str):
+    data = json.loads(raw)
+    return factory(**{
+        name: datetime.fromisoformat(value['$dt']) if isinstance(value, dict) and '$dt' in value else value
+        for name, value in data.items()
+    })
+
+
+class SharedStateMap:
+    """Dict-like view of one state namespace holding dataclass values.
+
+    Values are copies: mutate a value, then assign it back to publish the change.
+    """
+
+    def __init__(self, namespace: str, factory) -> None:
+        self.namespace = namespace
+        self.factory = factory
+
+    @staticmethod
+    def _key(key: Any) -> str:
+        if isinstance(key, tuple):
+            return ':'.join(str(part) for part in key)
+        return str(key)
+
+    def get(self, key: Any, default=None):
+        raw = get_state_backend().get(self.namespace, self._key(key))
+        return _load_state_value(self.factory, raw) if raw is not None else default
+
+    def __getitem__(self, key: Any):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Any, value) -> None:
+        get_state_backend().set(self.namespace, self._key(key), _dump_state_value(value))
+
+    def __contains__(self, key: Any) -> bool:
+        return get_state_backend().get(self.namespace, self._key(key)) is not None
+
+    def pop(self, key: Any, default=None):
+        value = self.get(key)
+        if not get_state_backend().delete(self.namespace, self._key(key)):
+            return default
+        return value
+
+    def values(self, prefix: Any = None) -> list:
+        """All values, or those whose key starts with the given key parts."""
+        key_prefix = f'{self._key(prefix)}:' if prefix is not None else ''
+        return [
+            _load_state_value(self.factory, raw)
+            for raw in get_state_backend().items(self.namespace, key_prefix).values()
+        ]
+
+
+ACTIVE_SKILL_CHECKS = SharedStateMap('skill_checks', ActiveSkillCheck)
+ACTIVE_SHOPS = SharedStateMap('shops', ActiveShop)
+TEMPLATES_REVISION_KEY = 'templates'
+
+
+def container_revision_key(owner_id: int, container_id: str) -> str:
+    return f'container:{owner_id}:{container_id}'
+
+
+def state_revisions(keys: list[str]) -> tuple[int, ...]:
+    backend = get_state_backend()
+    return tuple(int(backend.get('revisions', key) or 0) for key in keys)
+
+
+def mark_containers_touched(*containers: tuple[int, str]) -> None:
+    """Record containers changed by bulk statements the flush hook cannot see."""
+    touched = db.session.info.setdefault('touched_revisions', set())
+    for owner_id, container_id in containers:
+        touched.add(container_revision_key(owner_id, container_id))
+
+
+@event.listens_for(Session, 'before_flush')
+def _record_touched_revisions(session: Session, flush_context, instances) -> None:
+    touched = session.info.setdefault('touched_revisions', set())
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, ItemInstance):
+            state = inspect(obj)
+            # History covers both sides of a move; expired rows fall back to a load.
+            owner_ids = set(state.attrs.owner_id.history.sum()) or {obj.owner_id}
+            container_ids = set(state.attrs.container_i.history.sum()) or {obj.container_i}
+            for owner_id in owner_ids:
+                for container_id in container_ids:
+                    touched.add(container_revision_key(owner_id, container_id))
+        elif isinstance(obj, (ItemDefinition, ItemType)) and obj not in session.new:
+            touched.add(TEMPLATES_REVISION_KEY)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_touched_revisions(session: Session) -> None:
+    touched = session.info.pop('touched_revisions', None)
+    if not touched:
+        return
+    # The data is already committed; a state backend outage must not turn the write into a 500.
+    try:
+        get_state_backend().incr_many('revisions', sorted(touched))
+    except Exception:
+        app.logger.warning('Revision bump failed for %s keys; cached snapshots may lag', len(touched), exc_info=True)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_touched_revisions(session: Session) -> None:
+    session.info.pop('touched_revisions', None)
+
+
+class ShopPayloadCache:
+    """Serialized shop snapshots keyed by container and template revisions."""
+
+    def __init__(self, capacity: int = SHOP_CACHE_CAPACITY) -> None:
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple, str] = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[str]:
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key: tuple, body: str) -> None:
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+
+shop_payload_cache = ShopPayloadCache()
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+def _prometheus_labels(labels: dict[str, str]) -> str:
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class RequestMetrics:
+    """Per-process request, SQL and commit counters rendered in Prometheus text format.
+
+    Work outside a request (jobs, the chat flusher) is attributed to endpoint="background".
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.latency: dict[tuple[str, str], Histogram] = {}
+        self.statements_per_request: dict[str, Histogram] = {}
+        self.sections: dict[str, Histogram] = {}
+        self.requests: Counter = Counter()
+        self.statements: Counter = Counter()
+        self.rows: Counter = Counter()
+        self.commits: Counter = Counter()
+
+    @staticmethod
+    def current() -> Optional[dict]:
+        return g.get('metrics') if has_request_context() else None
+
+    def count(self, counter: str, amount: int = 1) -> None:
+        request_counts = self.current()
+        if request_counts is not None:
+            request_counts[counter] += amount
+            return
+        with self._lock:
+            getattr(self, counter)['background'] += amount
+
+    def record_request(self, endpoint: str, method: str, status: int, seconds: float, counts: dict) -> None:
+        with self._lock:
+            self.latency.setdefault((endpoint, method), Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self.statements_per_request.setdefault(endpoint, Histogram(SQL_COUNT_BUCKETS)).observe(
+                counts['statements']
+            )
+            self.requests[(endpoint, method, str(status))] += 1
+            self.statements[endpoint] += counts['statements']
+            self.rows[endpoint] += counts['rows']
+            self.commits[endpoint] += counts['commits']
+
+    def record_section(self, section: str, seconds: float) -> None:
+        with self._lock:
+            self.sections.setdefault(section, Histogram(LATENCY_BUCKETS)).observe(seconds)
+
+    @staticmethod
+    def _render_histogram(lines: list[str], name: str, labels: dict, histogram: Histogram) -> None:
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{_prometheus_labels({**labels, "le": f"{bound:g}"})} {cumulative}')
+        lines.append(f'{name}_bucket{_prometheus_labels({**labels, "le": "+Inf"})} {histogram.count}')
+        lines.append(f'{name}_sum{_prometheus_labels(labels)} {histogram.total:.6f}')
+        lines.append(f'{name}_count{_prometheus_labels(labels)} {histogram.count}')
+
+    def render(self) -> str:
+        lines: list[str] = []
+        with self._lock:
+            lines += [
+                '# HELP dra_request_duration_seconds Request latency by endpoint.',
+                '# TYPE dra_request_duration_seconds histogram',
+            ]
+            for (endpoint, method), histogram in sorted(self.latency.items()):
+                self._render_histogram(
+                    lines, 'dra_request_duration_seconds', {'endpoint': endpoint, 'method': method}, histogram
+                )
+            lines += [
+                '# HELP dra_request_sql_statements SQL statements executed per request.',
+                '# TYPE dra_request_sql_statements histogram',
+            ]
+            for endpoint, histogram in sorted(self.statements_per_request.items()):
+                self._render_histogram(lines, 'dra_request_sql_statements', {'endpoint': endpoint}, histogram)
+            lines += [
+                '# HELP dra_section_duration_seconds Latency of instrumented functions.',
+                '# TYPE dra_section_duration_seconds histogram',
+            ]
+            for section, histogram in sorted(self.sections.items()):
+                self._render_histogram(lines, 'dra_section_duration_seconds', {'section': section}, histogram)
+            lines += ['# HELP dra_requests_total Requests by endpoint and status.', '# TYPE dra_requests_total counter']
+            for (endpoint, method, status), value in sorted(self.requests.items()):
+                labels = {'endpoint': endpoint, 'method': method, 'status': status}
+                lines.append(f'dra_requests_total{_prometheus_labels(labels)} {value}')
+            for name, counter, help_text in (
+                ('dra_sql_statements_total', self.statements, 'SQL statements executed.'),
+                ('dra_orm_rows_loaded_total', self.rows, 'ORM instances loaded from result rows.'),
+                ('dra_commits_total', self.commits, 'Session commits.'),
+            ):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                for endpoint, value in sorted(counter.items()):
+                    lines.append(f'{name}{_prometheus_labels({"endpoint": endpoint})} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+
+def instrumented(section: str):
+    """Record a function's latency under dra_section_duration_seconds{section=...}."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                request_metrics.record_section(section, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_sql_statement(conn, cursor, statement, parameters, context, executemany) -> None:
+    request_metrics.count('statements')
+
+
+@event.listens_for(db.Model, 'load', propagate=True)
+def _count_loaded_row(target, context) -> None:
+    request_metrics.count('rows')
+
+
+@event.listens_for(Session, 'after_commit')
+def _count_commit(session: Session) -> None:
+    request_metrics.count('commits')
+
+
+@app.cli.command('state-server')
+def state_server_command():
+    """Serve shared lobby state to workers configured with STATE_BACKEND=socket."""
+    address = state_server_address()
+    if os.path.exists(address):
+        os.remove(address)
+    manager = StateManager(address=address, authkey=app.config['SECRET_KEY'].encode('utf-8'))
+    server = manager.get_server()
+    click.echo(f'State server listening on {address}')
+    server.serve_forever()
+
 
 def _sqlite_db_path(db_uri: str) -> Optional[str]:
     if not db_uri.startswith('sqlite:///'):
@@ -391,6 +1299,15 @@ def _ensure_user_columns():
         db.session.commit()
 
 
+def _ensure_lobby_columns():
+    inspector = inspect(db.engine)
+    if 'lobby' in inspector.get_table_names():
+        columns = {column['name'] for column in inspector.get_columns('lobby')}
+        if 'chat_retention_days' not in columns:
+            db.session.execute(text('ALTER TABLE lobby ADD COLUMN chat_retention_days INTEGER'))
+            db.session.commit()
+
+
 def _ensure_item_type_columns():
     inspector = inspect(db.engine)
     if 'item_type' in inspector.get_table_names():
@@ -445,6 +1362,9 @@ def _ensure_item_definition_columns():
         if 'max_stack' not in columns:
             db.session.execute(text('ALTER TABLE item_definition ADD COLUMN max_stack INTEGER'))
             db.session.commit()
+        if 'image_variants' not in columns:
+            db.session.execute(text('ALTER TABLE item_definition ADD COLUMN image_variants TEXT'))
+            db.session.commit()
         db.session.execute(text(
             'UPDATE item_definition '
             'SET max_stack = ('
@@ -489,6 +1409,15 @@ def _ensure_character_stats_columns():
             db.session.commit()
 
 
+def _ensure_chat_message_indexes():
+    inspector = inspect(db.engine)
+    if 'chat_message' in inspector.get_table_names():
+        db.session.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_chat_message_lobby_id_id ON chat_message (lobby_id, id)'
+        ))
+        db.session.commit()
+
+
 def ensure_attribute_formula() -> AttributeFormula:
     formula = AttributeFormula.query.first()
     if not formula:
@@ -498,13 +1427,109 @@ def ensure_attribute_formula() -> AttributeFormula:
     return formula
 
 
+TEMPLATE_FTS_READY = False
+
+
+def _template_fts_row(definition_id: int, name: Optional[str], description: Optional[str]) -> dict:
+    return {
+        'id': definition_id,
+        'name': name or '',
+        'description': description or '',
+        'name_lower': (name or '').lower(),
+    }
+
+
+def rebuild_template_fts() -> None:
+    rows = db.session.query(ItemDefinition.id, ItemDefinition.name, ItemDefinition.description).all()
+    db.session.execute(text('DELETE FROM item_definition_fts'))
+    if rows:
+        db.session.execute(
+            text(
+                'INSERT INTO item_definition_fts (rowid, name, description, name_lower) '
+                'VALUES (:id, :name, :description, :name_lower)'
+            ),
+            [_template_fts_row(*row) for row in rows],
+        )
+    db.session.commit()
+
+
+def _ensure_item_definition_fts():
+    global TEMPLATE_FTS_READY
+    if db.engine.dialect.name != 'sqlite':
+        return
+    try:
+        db.session.execute(text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS item_definition_fts '
+            "USING fts5(name, description, name_lower UNINDEXED, tokenize='trigram')"
+        ))
+        db.session.commit()
+    except OperationalError:
+        db.session.rollback()
+        print('[DB] FTS5 trigram tokenizer unavailable; template search stays in memory.')
+        return
+    indexed = db.session.execute(text('SELECT count(*) FROM item_definition_fts')).scalar()
+    total = db.session.execute(text('SELECT count(*) FROM item_definition')).scalar()
+    if indexed != total:
+        rebuild_template_fts()
+    TEMPLATE_FTS_READY = True
+
+
+def sync_template_fts(definition: ItemDefinition, *, previous_id: Optional[int] = None) -> None:
+    if not TEMPLATE_FTS_READY:
+        return
+    remove_template_fts([definition.id, previous_id] if previous_id else [definition.id])
+    db.session.execute(
+        text(
+            'INSERT INTO item_definition_fts (rowid, name, description, name_lower) '
+            'VALUES (:id, :name, :description, :name_lower)'
+        ),
+        _template_fts_row(definition.id, definition.name, definition.description),
+    )
+
+
+def remove_template_fts(template_ids: list[int]) -> None:
+    if not TEMPLATE_FTS_READY or not template_ids:
+        return
+    db.session.execute(
+        text('DELETE FROM item_definition_fts WHERE rowid = :id'),
+        [{'id': template_id} for template_id in template_ids],
+    )
+
+
+def _ensure_background_job_columns():
+    inspector = inspect(db.engine)
+    if 'background_job' in inspector.get_table_names():
+        columns = {column['name'] for column in inspector.get_columns('background_job')}
+        if 'worker_token' not in columns:
+            db.session.execute(text('ALTER TABLE background_job ADD COLUMN worker_token VARCHAR(32)'))
+            db.session.commit()
+        if 'heartbeat_at' not in columns:
+            db.session.execute(text('ALTER TABLE background_job ADD COLUMN heartbeat_at DATETIME'))
+            db.session.commit()
+        # At most one unfinished archive pass per lobby, and one over every lobby (lobby_id NULL).
+        try:
+            db.session.execute(text(
+                'CREATE UNIQUE INDEX IF NOT EXISTS uq_background_job_active_archive '
+                'ON background_job (COALESCE(lobby_id, 0)) '
+                "WHERE kind = 'archive_chat' AND status IN ('queued', 'running')"
+            ))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            print('[DB] Duplicate unfinished archive_chat jobs; unique index not created yet.')
+
+
 def initialize_database():
     db.create_all()
     _ensure_user_columns()
+    _ensure_lobby_columns()
     _ensure_item_type_columns()
     _ensure_item_definition_columns()
     _ensure_character_stats_columns()
+    _ensure_chat_message_indexes()
+    _ensure_item_definition_fts()
     ensure_attribute_formula()
+    _ensure_background_job_columns()
 
 
 def initialize_database_if_ready() -> None:
@@ -551,40 +1576,381 @@ def inject_helpers():
     }
 
 
-def save_upload(file, subdir: str, filename_prefix: str) -> Optional[str]:
-    if not file or not file.filename:
-        return None
-    filename = secure_filename(file.filename)
-    if not filename:
-        return None
-    upload_folder = os.path.join(app.static_folder, UPLOAD_SUBDIR, subdir)
-    os.makedirs(upload_folder, exist_ok=True)
-    saved_filename = f"{filename_prefix}_{filename}"
-    file_path = os.path.join(upload_folder, saved_filename)
-    file.save(file_path)
-    return os.path.join(UPLOAD_SUBDIR, subdir, saved_filename).replace(os.path.sep, "/")
+_static_hashes: dict[str, tuple[float, str]] = {}
 
 
-def validate_avatar_upload(file) -> Optional[str]:
-    if not file or not file.filename:
+def static_file_hash(filename: str) -> Optional[str]:
+    """Short content hash of a static file, recomputed only when its mtime changes."""
+    file_path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(file_path)
+    except OSError:
         return None
-    filename = secure_filename(file.filename)
-    if not filename:
-        return 'Некоректна назва файлу.'
-    _, ext = os.path.splitext(filename)
-    ext = ext.lower()
-    if ext not in ALLOWED_IMAGE_EXTENSIONS:
-        return 'Дозволені лише файли JPG, PNG або WEBP.'
-    mimetype = (file.mimetype or '').lower()
-    if mimetype and mimetype not in ALLOWED_IMAGE_MIME_TYPES:
-        return 'Невірний тип файлу. Завантажте JPG, PNG або WEBP.'
-    file.stream.seek(0, os.SEEK_END)
-    size = file.stream.tell()
-    file.stream.seek(0)
-    if size > MAX_AVATAR_SIZE_BYTES:
-        return 'Файл завеликий. Максимум 2MB.'
-    return None
-
+    cached = _static_hashes.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(65536), b''):
+            digest.update(chunk)
+    content_hash = digest.hexdigest()[:12]
+    _static_hashes[filename] = (mtime, content_hash)
+    return content_hash
+
+
+@app.url_defaults
+def add_static_version(endpoint: str, values: dict) -> None:
+    if endpoint != 'static' or 'v' in values or not values.get('filename'):
+        return
+    if is_content_addressed(values['filename']):
+        return
+    content_hash = static_file_hash(values['filename'])
+    if content_hash:
+        values['v'] = content_hash
+
+
+def accepted_encodings() -> list[str]:
+    """Encodings we can produce that the client accepts, best first."""
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    accepted = request.accept_encodings
+    return sorted(
+        (encoding for encoding in offered if accepted[encoding] > 0),
+        key=lambda encoding: -accepted[encoding],
+    )
+
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+def serve_static(filename: str):
+    """Static files with long caching for hashed URLs and pre-built .br/.gz siblings when present."""
+    max_age = STATIC_CACHE_MAX_AGE if request.args.get('v') or is_content_addressed(filename) else None
+    source_path = os.path.join(app.static_folder, filename)
+    for encoding in accepted_encodings():
+        suffix = '.br' if encoding == 'br' else '.gz'
+        compressed_path = source_path + suffix
+        try:
+            if os.path.getmtime(compressed_path) < os.path.getmtime(source_path):
+                continue
+        except OSError:
+            continue
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(app.static_folder, filename + suffix, mimetype=mimetype, max_age=max_age)
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        break
+    else:
+        response = send_from_directory(app.static_folder, filename, max_age=max_age)
+        if os.path.splitext(filename)[1].lower() in PRECOMPRESS_EXTENSIONS:
+            response.vary.add('Accept-Encoding')
+    if max_age:
+        response.cache_control.immutable = True
+    return response
+
+
+app.view_functions['static'] = serve_static
+
+
+@app.after_request
+def compress_response(response):
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code in {204, 206, 304}
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.content_length or 0) < COMPRESS_MIN_BYTES:
+        return response
+    encodings = accepted_encodings()
+    if not encodings:
+        return response
+    response.set_data(compress_body(response.get_data(), encodings[0]))
+    response.headers['Content-Encoding'] = encodings[0]
+    return response
+
+
+@app.cli.command('compress-static')
+@click.option('--force', is_flag=True, help='Rebuild siblings that are already up to date.')
+def compress_static_command(force: bool):
+    """Write .gz (and .br when brotli is installed) next to compressible static files."""
+    upload_root = os.path.join(app.static_folder, UPLOAD_SUBDIR)
+    encodings = ['gzip', 'br'] if brotli is not None else ['gzip']
+    written = 0
+    for root, dirs, files in os.walk(app.static_folder):
+        if os.path.commonpath([root, upload_root]) == upload_root:
+            dirs[:] = []
+            continue
+        for name in files:
+            if os.path.splitext(name)[1].lower() not in PRECOMPRESS_EXTENSIONS:
+                continue
+            source_path = os.path.join(root, name)
+            with open(source_path, 'rb') as handle:
+                body = handle.read()
+            for encoding in encodings:
+                target_path = source_path + ('.br' if encoding == 'br' else '.gz')
+                if (
+                    not force
+                    and os.path.exists(target_path)
+                    and os.path.getmtime(target_path) >= os.path.getmtime(source_path)
+                ):
+                    continue
+                if encoding == 'br':
+                    compressed = brotli.compress(body, quality=11)
+                else:
+                    compressed = gzip.compress(body, compresslevel=9, mtime=0)
+                if len(compressed) >= len(body):
+                    continue
+                temp_path = f'{target_path}.tmp'
+                with open(temp_path, 'wb') as handle:
+                    handle.write(compressed)
+                os.replace(temp_path, target_path)
+                written += 1
+                click.echo(f'{os.path.relpath(target_path, app.static_folder)}: {len(body)} -> {len(compressed)} bytes')
+    if not brotli:
+        click.echo('brotli is not installed; wrote gzip siblings only')
+    click.echo(f'{written} files written')
+
+
+class UploadRejected(Exception):
+    """Upload content failed validation; the message is shown to the user."""
+
+
+def sniff_image_extension(head: bytes) -> Optional[str]:
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    return None
+
+
+def save_upload(file, subdir: str, max_bytes: int) -> Optional[str]:
+    """Store an upload under its SHA-256; identical files share one immutable path.
+
+    The stream is validated while it is copied: magic bytes decide the image type and the
+    copy stops as soon as it passes `max_bytes`, raising UploadRejected either way.
+    The blob row starts unreferenced; assigning the path to ItemDefinition.image_path or
+    User.userImage takes the reference, so an upload the request never uses is collected later.
+    """
+    if not file or not file.filename:
+        return None
+    upload_folder = os.path.join(app.static_folder, UPLOAD_SUBDIR, subdir)
+    os.makedirs(upload_folder, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    ext = None
+    fd, temp_path = tempfile.mkstemp(dir=upload_folder, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_BYTES), b''):
+                if ext is None:
+                    ext = sniff_image_extension(chunk)
+                    if ext is None:
+                        raise UploadRejected('Невірний тип файлу. Завантажте JPG, PNG або WEBP.')
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadRejected(f'Файл завеликий. Максимум {math.ceil(max_bytes / (1024 * 1024))}MB.')
+                digest.update(chunk)
+                handle.write(chunk)
+        if ext is None:
+            raise UploadRejected('Файл порожній.')
+        content_hash = digest.hexdigest()
+        relative_path = '/'.join((UPLOAD_SUBDIR, subdir, content_hash[:2], content_hash + ext))
+        final_path = os.path.join(app.static_folder, relative_path)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        # Writing the blob row first holds the database write lock until this request ends, so
+        # the collector either finished removing the file already or waits and sees the new state.
+        _claim_upload_blob(relative_path, content_hash, size)
+        if os.path.exists(final_path):
+            os.remove(temp_path)
+            os.utime(final_path)
+        else:
+            os.replace(temp_path, final_path)
+    except UploadRejected:
+        os.remove(temp_path)
+        raise
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+    except SQLAlchemyError:
+        os.remove(temp_path)
+        raise
+    return relative_path
+
+
+def _claim_upload_blob(relative_path: str, content_hash: str, size: int) -> None:
+    blobs = UploadBlob.__table__
+    now = datetime.utcnow()
+    statement = sqlite_insert(blobs).values(
+        path=relative_path,
+        content_hash=content_hash,
+        size=size,
+        ref_count=0,
+        created_at=now,
+        orphaned_at=now,
+    )
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['path'],
+        # Restart the grace period of an unreferenced blob that is being uploaded again.
+        set_={'orphaned_at': case((blobs.c.ref_count > 0, None), else_=now)},
+    ))
+
+
+UPLOAD_REFERENCE_ATTRS = {ItemDefinition: 'image_path', User: 'userImage'}
+
+
+def _track_upload_path_change(target, value, oldvalue, initiator) -> None:
+    """Count the path taken and the one released; active_history loads `oldvalue` if needed."""
+    if value == oldvalue:
+        return
+    changes = inspect(target).info.setdefault('upload_ref_changes', Counter())
+    if value:
+        changes[value] += 1
+    if oldvalue not in (None, NO_VALUE, NEVER_SET):
+        changes[oldvalue] -= 1
+
+
+for _model, _attr in UPLOAD_REFERENCE_ATTRS.items():
+    event.listen(getattr(_model, _attr), 'set', _track_upload_path_change, active_history=True)
+
+
+@event.listens_for(Session, 'before_flush')
+def _record_upload_references(session: Session, flush_context, instances) -> None:
+    deltas = session.info.setdefault('upload_ref_deltas', Counter())
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        attr = UPLOAD_REFERENCE_ATTRS.get(type(obj))
+        if not attr:
+            continue
+        state = inspect(obj)
+        changes = state.info.pop('upload_ref_changes', None)
+        if obj in session.deleted:
+            history = state.attrs[attr].history
+            for path in history.deleted or history.unchanged or [getattr(obj, attr)]:
+                deltas[path] -= 1
+        elif changes:
+            deltas.update(changes)
+
+
+@event.listens_for(Session, 'after_flush')
+def _apply_upload_references(session: Session, flush_context) -> None:
+    deltas = session.info.pop('upload_ref_deltas', None)
+    if not deltas:
+        return
+    blobs = UploadBlob.__table__
+    now = datetime.utcnow()
+    for path, delta in deltas.items():
+        if not path or not delta:
+            continue
+        session.connection().execute(
+            update(blobs)
+            .where(blobs.c.path == path)
+            .values(
+                ref_count=func.max(blobs.c.ref_count + delta, 0),
+                orphaned_at=case(
+                    (blobs.c.ref_count + delta > 0, None),
+                    else_=func.coalesce(blobs.c.orphaned_at, now),
+                ),
+            )
+        )
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_upload_references(session: Session) -> None:
+    session.info.pop('upload_ref_deltas', None)
+    # Rolled-back assignments are expired along with the rest of the object.
+    for obj in itertools.chain(session.identity_map.values(), session.new):
+        inspect(obj).info.pop('upload_ref_changes', None)
+
+
+def _remove_upload_files(relative_path: str) -> None:
+    file_path = os.path.join(app.static_folder, relative_path)
+    stem = os.path.splitext(file_path)[0]
+    for path in [file_path] + [f'{stem}_{size}.webp' for size in ITEM_IMAGE_SIZES]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def collect_orphaned_uploads(grace_seconds: int = UPLOAD_GC_GRACE_SECONDS) -> int:
+    """Delete unreferenced content-addressed uploads older than the grace period."""
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    cutoff_ts = time.time() - grace_seconds
+    removed = 0
+    candidates = UploadBlob.query.filter(UploadBlob.ref_count <= 0, UploadBlob.orphaned_at < cutoff).all()
+    for blob in candidates:
+        file_path = os.path.join(app.static_folder, blob.path)
+        if os.path.exists(file_path) and os.path.getmtime(file_path) >= cutoff_ts:
+            continue
+        deleted = db.session.execute(
+            delete(UploadBlob).where(
+                UploadBlob.path == blob.path,
+                UploadBlob.ref_count <= 0,
+                UploadBlob.orphaned_at < cutoff,
+            )
+        ).rowcount
+        if deleted:
+            # Files go while the delete still holds the write lock; a re-upload of the same
+            # bytes waits for it in _claim_upload_blob and then writes the file back.
+            _remove_upload_files(blob.path)
+            removed += 1
+        db.session.commit()
+    # Files whose blob row never committed (the request failed after saving the upload).
+    known_paths = {path for (path,) in db.session.query(UploadBlob.path)}
+    upload_root = os.path.join(app.static_folder, UPLOAD_SUBDIR)
+    for root, _dirs, files in os.walk(upload_root):
+        for name in files:
+            # Thumbnails (<hash>_<size>.webp) go together with their original.
+            is_original = is_content_addressed(name) and '_' not in name
+            file_path = os.path.join(root, name)
+            if not (is_original or name.endswith('.part')) or os.path.getmtime(file_path) >= cutoff_ts:
+                continue
+            relative_path = os.path.relpath(file_path, app.static_folder).replace(os.path.sep, '/')
+            if relative_path in known_paths:
+                continue
+            _remove_upload_files(relative_path)
+            removed += 1
+    return removed
+
+
+_last_upload_gc = 0.0
+
+
+def schedule_upload_gc(user_id: Optional[int] = None) -> None:
+    """Queue a collection pass after an upload reference was replaced, at most once per interval."""
+    global _last_upload_gc
+    now = time.monotonic()
+    if now - _last_upload_gc < UPLOAD_GC_INTERVAL_SECONDS:
+        return
+    _last_upload_gc = now
+    enqueue_job('collect_uploads', {}, user_id=user_id)
+
+
+def is_content_addressed(filename: str) -> bool:
+    return bool(CONTENT_ADDRESSED_NAME.match(os.path.basename(filename)))
+
+
+def validate_avatar_upload(file) -> Optional[str]:
+    if not file or not file.filename:
+        return None
+    filename = secure_filename(file.filename)
+    if not filename:
+        return 'Некоректна назва файлу.'
+    _, ext = os.path.splitext(filename)
+    ext = ext.lower()
+    if ext not in ALLOWED_IMAGE_EXTENSIONS:
+        return 'Дозволені лише файли JPG, PNG або WEBP.'
+    mimetype = (file.mimetype or '').lower()
+    if mimetype and mimetype not in ALLOWED_IMAGE_MIME_TYPES:
+        return 'Невірний тип файлу. Завантажте JPG, PNG або WEBP.'
+    return None
+
 
 def validate_item_image_upload(file) -> Optional[str]:
     if not file or not file.filename:
@@ -599,14 +1965,59 @@ def validate_item_image_upload(file) -> Optional[str]:
     mimetype = (file.mimetype or '').lower()
     if mimetype and mimetype not in ALLOWED_IMAGE_MIME_TYPES:
         return 'Невірний тип файлу. Завантажте JPG, PNG або WEBP.'
-    file.stream.seek(0, os.SEEK_END)
-    size = file.stream.tell()
-    file.stream.seek(0)
-    if size > MAX_ITEM_IMAGE_BYTES:
-        return 'Файл завеликий.'
     return None
 
 
+def build_image_variants(image_path: str, sizes: tuple[int, ...] = ITEM_IMAGE_SIZES) -> dict[str, str]:
+    """Decode an uploaded image once and write a WebP thumbnail per size; returns {size: path}.
+
+    Sizes bound the longest side and are produced largest first, each from the previous one.
+    Returns an empty dict when Pillow is not installed or the file cannot be decoded.
+    """
+    if Image is None or not image_path:
+        return {}
+    source_path = os.path.join(app.static_folder, normalize_static_path(image_path))
+    stem = os.path.splitext(normalize_static_path(image_path))[0]
+    try:
+        with Image.open(source_path) as source:
+            source.draft('RGB', (max(sizes), max(sizes)))
+            image = ImageOps.exif_transpose(source)
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    except (OSError, ValueError) as exc:
+        if inventory_logger.handlers:
+            inventory_logger.error('Image variants failed for %s: %s', image_path, exc)
+        return {}
+    variants = {}
+    for size in sorted(sizes, reverse=True):
+        image.thumbnail((size, size), Image.LANCZOS)
+        variant_path = f'{stem}_{size}.webp'
+        # Content-addressed originals make existing thumbnails reusable as they are.
+        if not os.path.exists(os.path.join(app.static_folder, variant_path)):
+            image.save(
+                os.path.join(app.static_folder, variant_path),
+                'WEBP',
+                quality=ITEM_IMAGE_WEBP_QUALITY,
+                method=4,
+            )
+        variants[str(size)] = variant_path.replace(os.path.sep, '/')
+    return variants
+
+
+def image_variants_for(definition: ItemDefinition) -> dict[str, str]:
+    if not definition.image_variants:
+        return {}
+    try:
+        return json.loads(definition.image_variants)
+    except ValueError:
+        return {}
+
+
+def refresh_image_variants(definition: ItemDefinition) -> dict[str, str]:
+    variants = build_image_variants(definition.image_path)
+    definition.image_variants = json.dumps(variants) if variants else None
+    return variants
+
+
 def current_user() -> Optional[User]:
     user_id = session.get('user_id')
     if not user_id:
@@ -620,6 +2031,38 @@ def is_user_online(user: User | None) -> bool:
     return datetime.utcnow() - user.last_seen <= timedelta(seconds=30)
 
 
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+
+@app.before_request
+def assign_request_id():
+    # The id is echoed back and written to the logs, so only short, plain client ids are kept.
+    client_id = request.headers.get('X-Request-ID', '')
+    g.request_id = client_id if REQUEST_ID_PATTERN.fullmatch(client_id) else str(uuid4())
+    g.metrics = Counter(statements=0, rows=0, commits=0)
+    g.started_at = time.perf_counter()
+
+
+@app.after_request
+def echo_request_id(response):
+    response.headers.setdefault('X-Request-ID', g.get('request_id', ''))
+    return response
+
+
+@app.after_request
+def record_request_metrics(response):
+    started_at = g.get('started_at')
+    if started_at is not None:
+        request_metrics.record_request(
+            request.endpoint or 'unmatched',
+            request.method,
+            response.status_code,
+            time.perf_counter() - started_at,
+            g.metrics,
+        )
+    return response
+
+
 @app.before_request
 def update_last_seen():
     user = current_user()
@@ -697,47 +2140,366 @@ def giveid_debug_enabled() -> bool:
     config_value = app.config.get('DEBUG_GIVEID')
     if config_value is not None:
         return str(config_value).strip().lower() in {'1', 'true', 'yes', 'on'}
-    return os.environ.get(DEBUG_GIVEID_ENV, '').strip().lower() in {'1', 'true', 'yes', 'on'}
+    return settings.debug_giveid
 
 
-def log_giveid_step(lobby_id: int, user_id: int, text: str) -> None:
+def log_giveid_step(lobby_id: int, user_id: int, message: str) -> None:
+    if giveid_debug_enabled():
+        giveid_logger.debug(message, extra={'lobby_id': lobby_id, 'user_id': user_id})
     if lobby_id <= 0 or user_id <= 0:
         return
-    try:
-        with db.engine.begin() as connection:
-            connection.execute(
-                text(
-                    'INSERT INTO chat_message (lobby_id, user_id, message, is_system, created_at) '
-                    'VALUES (:lobby_id, :user_id, :message, :is_system, :created_at)'
-                ),
-                {
-                    'lobby_id': lobby_id,
-                    'user_id': user_id,
-                    'message': text,
-                    'is_system': True,
-                    'created_at': datetime.utcnow(),
-                },
-            )
-    except Exception:
-        app.logger.warning('GiveID chat log failed', exc_info=True)
+    # Steps are logged even when the issuing transaction rolls back, so they bypass the session.
+    system_chat_buffer.push([PendingChatEvent(lobby_id, user_id, message)])
 
 
 def log_shop_debug(message: str, *args) -> None:
-    if os.environ.get(SHOP_DEBUG_ENV, '').strip() in {'1', 'true', 'yes'}:
+    if settings.debug_shop:
         log_debug(message, *args)
 
 
-def serialize_chat_message(message: ChatMessage) -> dict:
+def serialize_chat_message(message: ChatMessage, sender: Optional[str] = None) -> dict:
+    if sender is None:
+        sender = message.user.nickname if message.user else ''
     return {
         'id': message.id,
         'user_id': message.user_id,
-        'sender': message.user.nickname if message.user else '',
+        'sender': sender,
         'message': message.message,
         'is_system': bool(message.is_system),
         'created_at': message.created_at.isoformat() if message.created_at else None,
     }
 
 
+def default_chat_retention_days() -> int:
+    return parse_int(os.environ.get(CHAT_RETENTION_ENV), 0)
+
+
+def chat_retention_days(lobby: Lobby) -> int:
+    """Days of chat kept in the hot table; 0 keeps everything."""
+    if lobby.chat_retention_days is None:
+        return default_chat_retention_days()
+    return max(lobby.chat_retention_days, 0)
+
+
+CHAT_SEGMENT_NAME = re.compile(r'(\d{4}-\d{2}-\d{2})\.(?:(\d+)-(\d+)\.)?jsonl\.gz')
+
+
+def _chat_segment_sort_key(name: str) -> tuple:
+    match = CHAT_SEGMENT_NAME.fullmatch(name)
+    # Whole-day segments written before batches got their own files come first within their day.
+    return match.group(1), int(match.group(2) or 0)
+
+
+def chat_archive_segments(lobby_id: int) -> list[str]:
+    lobby_dir = os.path.join(CHAT_ARCHIVE_DIR, str(lobby_id))
+    if not os.path.isdir(lobby_dir):
+        return []
+    names = [name for name in os.listdir(lobby_dir) if CHAT_SEGMENT_NAME.fullmatch(name)]
+    return [os.path.join(lobby_dir, name) for name in sorted(names, key=_chat_segment_sort_key)]
+
+
+def _write_pending_segment(lobby_id: int, day: str, entries: list[tuple[int, str]]) -> str:
+    """Write one day's part of a batch next to its final name; promoted once the rows are deleted."""
+    lobby_dir = os.path.join(CHAT_ARCHIVE_DIR, str(lobby_id))
+    _ensure_directory(lobby_dir)
+    segment_name = f'{day}.{entries[0][0]:012d}-{entries[-1][0]:012d}.jsonl.gz'
+    pending_path = os.path.join(lobby_dir, f'{segment_name}.{secrets.token_hex(4)}.part')
+    with open(pending_path, 'wb') as handle:
+        handle.write(gzip.compress(''.join(line for _id, line in entries).encode('utf-8')))
+        handle.flush()
+        os.fsync(handle.fileno())
+    return pending_path
+
+
+def _promote_pending_segment(pending_path: str) -> None:
+    # The final name depends only on the ids it holds, so promoting twice cannot duplicate lines.
+    os.replace(pending_path, pending_path.rsplit('.', 2)[0])
+
+
+def _discard_pending_segments(pending_paths: list[str]) -> None:
+    for path in pending_paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _recover_pending_segments(lobby_id: int) -> None:
+    """Finish or drop batches of a pass that died between writing a segment and promoting it."""
+    lobby_dir = os.path.join(CHAT_ARCHIVE_DIR, str(lobby_id))
+    if not os.path.isdir(lobby_dir):
+        return
+    cutoff_ts = time.time() - CHAT_ARCHIVE_PENDING_GRACE_SECONDS
+    archived_ranges = [
+        (int(match.group(2)), int(match.group(3)))
+        for match in map(CHAT_SEGMENT_NAME.fullmatch, os.listdir(lobby_dir))
+        if match and match.group(2)
+    ]
+    for name in os.listdir(lobby_dir):
+        path = os.path.join(lobby_dir, name)
+        match = CHAT_SEGMENT_NAME.fullmatch(name.rsplit('.', 2)[0]) if name.endswith('.part') else None
+        if not match or not match.group(2) or os.path.getmtime(path) >= cutoff_ts:
+            continue
+        first_id, last_id = int(match.group(2)), int(match.group(3))
+        rows_left = db.session.query(ChatMessage.id).filter(
+            ChatMessage.lobby_id == lobby_id,
+            ChatMessage.id.between(first_id, last_id),
+        ).first()
+        # Rows still present: the delete never committed. Overlap: another pass archived them.
+        if rows_left or any(first <= last_id and last >= first_id for first, last in archived_ranges):
+            os.remove(path)
+        else:
+            _promote_pending_segment(path)
+            archived_ranges.append((first_id, last_id))
+
+
+def archive_lobby_chat(lobby: Lobby) -> int:
+    """Move chat rows older than the lobby retention into archive segments.
+
+    Each batch is written to pending files first, the rows are deleted, and only after that
+    commits are the files renamed into place. A failed commit drops the pending files, so a
+    retried pass rewrites the same rows once; a pass whose delete removes fewer rows than it
+    read lost them to a concurrent pass and drops its files too.
+    """
+    _recover_pending_segments(lobby.id)
+    retention_days = chat_retention_days(lobby)
+    if retention_days <= 0:
+        return 0
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    cutoff = today - timedelta(days=retention_days)
+    archived = 0
+    while True:
+        rows = (
+            db.session.query(ChatMessage, User.nickname)
+            .outerjoin(User, User.id == ChatMessage.user_id)
+            .filter(ChatMessage.lobby_id == lobby.id, ChatMessage.created_at < cutoff)
+            .order_by(ChatMessage.id.asc())
+            .limit(CHAT_ARCHIVE_BATCH)
+            .all()
+        )
+        if not rows:
+            break
+        segments: dict[str, list[tuple[int, str]]] = {}
+        for message, sender in rows:
+            day = message.created_at.strftime('%Y-%m-%d')
+            line = json.dumps(serialize_chat_message(message, sender or ''), ensure_ascii=False)
+            segments.setdefault(day, []).append((message.id, line + '\n'))
+        pending: list[str] = []
+        try:
+            for day, entries in segments.items():
+                pending.append(_write_pending_segment(lobby.id, day, entries))
+            deleted = db.session.execute(
+                delete(ChatMessage).where(ChatMessage.id.in_([message.id for message, _sender in rows]))
+            ).rowcount
+            if deleted != len(rows):
+                db.session.rollback()
+                _discard_pending_segments(pending)
+                break
+            db.session.commit()
+        except (OSError, SQLAlchemyError):
+            db.session.rollback()
+            _discard_pending_segments(pending)
+            raise
+        for path in pending:
+            _promote_pending_segment(path)
+        archived += len(rows)
+    return archived
+
+
+def archive_expired_chat(
+    lobby_ids: Optional[list[int]] = None,
+    *,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> dict[int, int]:
+    query = Lobby.query.order_by(Lobby.id)
+    if lobby_ids:
+        query = query.filter(Lobby.id.in_(lobby_ids))
+    lobbies = query.all()
+    archived: dict[int, int] = {}
+    for index, lobby in enumerate(lobbies, start=1):
+        archived[lobby.id] = archive_lobby_chat(lobby)
+        if on_progress:
+            on_progress(index, len(lobbies))
+    return archived
+
+
+def iter_chat_export(lobby_id: int):
+    """Yield the archived segments followed by the hot rows as one gzip JSONL stream."""
+    for path in chat_archive_segments(lobby_id):
+        with open(path, 'rb') as handle:
+            while True:
+                chunk = handle.read(64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+    last_id = 0
+    while True:
+        rows = (
+            db.session.query(ChatMessage, User.nickname)
+            .outerjoin(User, User.id == ChatMessage.user_id)
+            .filter(ChatMessage.lobby_id == lobby_id, ChatMessage.id > last_id)
+            .order_by(ChatMessage.id.asc())
+            .limit(CHAT_ARCHIVE_BATCH)
+            .all()
+        )
+        if not rows:
+            break
+        lines = [
+            json.dumps(serialize_chat_message(message, sender or ''), ensure_ascii=False) + '\n'
+            for message, sender in rows
+        ]
+        yield gzip.compress(''.join(lines).encode('utf-8'))
+        last_id = rows[-1][0].id
+
+
+@dataclass
+class PendingChatEvent:
+    lobby_id: int
+    user_id: int
+    message: str
+    created_at: datetime = field(default_factory=datetime.utcnow)
+    attempts: int = 0
+
+
+class SystemChatBuffer:
+    """Write-behind buffer for system chat lines, bulk-inserted by a flusher thread.
+
+    At most `max_events` lines are held; when the database stays unavailable the oldest are
+    dropped, and a line that fails `max_attempts` flushes is logged and given up.
+    """
+
+    def __init__(
+        self,
+        capacity: int = CHAT_BUFFER_CAPACITY,
+        max_events: int = CHAT_BUFFER_MAX_EVENTS,
+        max_attempts: int = CHAT_FLUSH_MAX_ATTEMPTS,
+    ) -> None:
+        self.capacity = capacity
+        self.max_events = max_events
+        self.max_attempts = max_attempts
+        self.dropped = 0
+        self.dead_lettered = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._events: deque[PendingChatEvent] = deque(maxlen=max_events)
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _count_dropped(self, incoming: int) -> None:
+        # Callers hold self._lock. The bounded deque keeps the newest lines and drops the oldest.
+        dropped = max(0, len(self._events) + incoming - self.max_events)
+        if dropped:
+            self.dropped += dropped
+            app.logger.warning('System chat buffer full; dropped %s oldest events', dropped)
+
+    def push(self, events: list[PendingChatEvent]) -> None:
+        if not events:
+            return
+        with self._lock:
+            self._count_dropped(len(events))
+            self._events.extend(events)
+            overflow = len(self._events) >= self.capacity
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='chat-flusher', daemon=True)
+                self._thread.start()
+        if overflow:
+            self._wake.set()
+
+    def _requeue(self, events: list[PendingChatEvent]) -> None:
+        retry = []
+        for item in events:
+            item.attempts += 1
+            if item.attempts < self.max_attempts:
+                retry.append(item)
+                continue
+            self.dead_lettered += 1
+            app.logger.error(
+                'System chat event dropped after %s failed flushes: lobby=%s user=%s created_at=%s message=%r',
+                item.attempts,
+                item.lobby_id,
+                item.user_id,
+                item.created_at.isoformat(),
+                item.message,
+            )
+        with self._lock:
+            self._count_dropped(len(retry))
+            self._events = deque(retry + list(self._events), maxlen=self.max_events)
+        if retry:
+            app.logger.warning('System chat flush failed; %s events requeued', len(retry), exc_info=True)
+
+    def flush(self, lobby_id: Optional[int] = None) -> int:
+        """Insert pending events (optionally one lobby's) using the current session."""
+        # Flushes are serialised so ids keep the order in which events were pushed.
+        with self._flush_lock:
+            with self._lock:
+                if lobby_id is None:
+                    events = list(self._events)
+                    self._events.clear()
+                else:
+                    events = [item for item in self._events if item.lobby_id == lobby_id]
+                    if events:
+                        self._events = deque(
+                            (item for item in self._events if item.lobby_id != lobby_id),
+                            maxlen=self.max_events,
+                        )
+            if not events:
+                return 0
+            try:
+                db.session.execute(
+                    ChatMessage.__table__.insert(),
+                    [
+                        {
+                            'lobby_id': item.lobby_id,
+                            'user_id': item.user_id,
+                            'message': item.message,
+                            'is_system': True,
+                            'created_at': item.created_at,
+                        }
+                        for item in events
+                    ],
+                )
+                db.session.commit()
+            except SQLAlchemyError:
+                db.session.rollback()
+                self._requeue(events)
+                return 0
+            return len(events)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(CHAT_FLUSH_INTERVAL_SECONDS)
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    self.flush()
+                finally:
+                    db.session.remove()
+
+
+system_chat_buffer = SystemChatBuffer()
+
+
+def queue_system_message(lobby_id: int, user_id: int, message: str) -> None:
+    """Emit a system chat line once the current transaction commits."""
+    db.session.info.setdefault('pending_chat_events', []).append(
+        PendingChatEvent(lobby_id, user_id, message)
+    )
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_pending_chat_events(session: Session) -> None:
+    system_chat_buffer.push(session.info.pop('pending_chat_events', []))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending_chat_events(session: Session) -> None:
+    session.info.pop('pending_chat_events', None)
+
+
+@atexit.register
+def _flush_system_chat_on_exit() -> None:
+    with app.app_context():
+        system_chat_buffer.flush()
+
+
 def create_chat_message(lobby_id: int, user_id: int, message: str, *, is_system: bool = False) -> ChatMessage:
     chat_message = ChatMessage(
         lobby_id=lobby_id,
@@ -763,22 +2525,128 @@ def serialize_skill_check(check: ActiveSkillCheck) -> dict:
     }
 
 
-def complete_skill_check(check: ActiveSkillCheck, *, success: bool) -> None:
+def serialize_skill_check_result(entry: SkillCheckResult) -> dict:
+    return {
+        'id': entry.id,
+        'check_id': entry.check_id,
+        'lobby_id': entry.lobby_id,
+        'target_user_id': entry.target_user_id,
+        'master_user_id': entry.master_user_id,
+        'difficulty': entry.difficulty,
+        'result': entry.result,
+        'reason': entry.reason,
+        'successes': entry.successes,
+        'failures': entry.failures,
+        'started_at': entry.started_at.isoformat() if entry.started_at else None,
+        'completed_at': entry.completed_at.isoformat() if entry.completed_at else None,
+    }
+
+
+def complete_skill_check(
+    check: ActiveSkillCheck,
+    *,
+    success: bool,
+    successes: Optional[int] = None,
+    failures: Optional[int] = None,
+    reason: str = 'result',
+) -> None:
     if check.status == 'completed':
         return
+    # Claiming the check first keeps completion single-shot across workers and the expiry thread.
+    if ACTIVE_SKILL_CHECKS.pop((check.lobby_id, check.target_user_id)) is None:
+        return
     check.status = 'completed'
     check.result = 'success' if success else 'failure'
+    db.session.add(SkillCheckResult(
+        check_id=check.id,
+        lobby_id=check.lobby_id,
+        target_user_id=check.target_user_id,
+        master_user_id=check.master_user_id,
+        difficulty=check.difficulty,
+        result=check.result,
+        reason=reason,
+        successes=successes,
+        failures=failures,
+        created_at=check.created_at,
+        started_at=check.started_at,
+    ))
     target = User.query.get(check.target_user_id)
     if target:
         outcome = 'successfully passed' if success else 'failed'
-        create_chat_message(
+        queue_system_message(
             check.lobby_id,
             target.id,
             f'{target.nickname} {outcome} the skill check.',
-            is_system=True,
         )
-        db.session.commit()
-    ACTIVE_SKILL_CHECKS.pop(check.lobby_id, None)
+    db.session.commit()
+
+
+class SkillCheckExpiryScheduler:
+    """Expires accepted skill checks at their deadline from a background thread."""
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._heap: list[tuple[datetime, str, int, int]] = []
+        self._scheduled: set[str] = set()
+        self._thread: Optional[threading.Thread] = None
+
+    def ensure_started(self) -> None:
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='skill-check-expiry', daemon=True)
+                self._thread.start()
+
+    def schedule(self, check: ActiveSkillCheck) -> None:
+        if check.status != 'active' or not check.expires_at:
+            return
+        self.ensure_started()
+        with self._condition:
+            if check.id in self._scheduled:
+                return
+            self._scheduled.add(check.id)
+            heapq.heappush(self._heap, (check.expires_at, check.id, check.lobby_id, check.target_user_id))
+            self._condition.notify()
+
+    def _rescan(self) -> None:
+        # Picks up checks accepted by other workers when state is shared between processes.
+        for check in ACTIVE_SKILL_CHECKS.values():
+            self.schedule(check)
+
+    def _expire(self, check_id: str, lobby_id: int, target_user_id: int) -> None:
+        check = ACTIVE_SKILL_CHECKS.get((lobby_id, target_user_id))
+        if check and check.id == check_id and check.status == 'active':
+            complete_skill_check(check, success=False, reason='expired')
+
+    def _run(self) -> None:
+        next_rescan = datetime.utcnow()
+        while True:
+            due: list[tuple[datetime, str, int, int]] = []
+            with self._condition:
+                now = datetime.utcnow()
+                wake_at = next_rescan
+                if self._heap:
+                    wake_at = min(wake_at, self._heap[0][0])
+                if wake_at > now:
+                    self._condition.wait((wake_at - now).total_seconds())
+                    now = datetime.utcnow()
+                while self._heap and self._heap[0][0] <= now:
+                    item = heapq.heappop(self._heap)
+                    self._scheduled.discard(item[1])
+                    due.append(item)
+            with app.app_context():
+                try:
+                    for _expires_at, check_id, lobby_id, target_user_id in due:
+                        self._expire(check_id, lobby_id, target_user_id)
+                    if now >= next_rescan:
+                        next_rescan = now + timedelta(seconds=SKILL_CHECK_RESCAN_SECONDS)
+                        self._rescan()
+                except Exception:
+                    app.logger.exception('Skill check expiry failed')
+                finally:
+                    db.session.remove()
+
+
+skill_check_scheduler = SkillCheckExpiryScheduler()
 
 
 def is_lobby_master(user: User, lobby_id: int) -> bool:
@@ -849,31 +2717,30 @@ def compute_inventory_weight(
 ) -> float:
     weight_logged = False
     weights = []
-    inventory_debug = os.environ.get(INVENTORY_DEBUG_ENV, '').strip() in {'1', 'true', 'yes'}
+    inventory_debug = settings.debug_inventory
     for instance in instances:
         definition = instance.definition
         effective_amount = max(instance.amount or 0, 0)
         if definition.weight is None and not weight_logged:
             log_weight_breakdown(instances, 'missing_weight')
             weight_logged = True
-        item_weight = (definition.weight or 0) * effective_amount
-        weights.append(item_weight)
-        if inventory_debug:
-            inventory_logger.debug(
-                'Inventory weight item id=%s template=%s weight=%s amount=%s contribution=%.2f',
-                instance.id,
-                definition.id,
-                definition.weight,
-                effective_amount,
-                item_weight,
-            )
+        weights.append((definition.weight or 0) * effective_amount)
     total_weight = sum(weights)
     if inventory_debug:
+        # One record per computation; the breakdown travels as structured fields.
         inventory_logger.debug(
             'Inventory weight total (%s) user=%s current=%.2f',
             log_context,
             user_id,
             total_weight,
+            extra={
+                'user_id': user_id,
+                'context': log_context,
+                'items': [
+                    [instance.id, instance.template_id, max(instance.amount or 0, 0), round(weight, 2)]
+                    for instance, weight in zip(instances, weights)
+                ],
+            },
         )
     return total_weight
 
@@ -1083,10 +2950,16 @@ def cleanup_starter_kit() -> None:
     if not starter_defs:
         return
     starter_ids = [definition.id for definition in starter_defs]
+    mark_containers_touched(*db.session.query(ItemInstance.owner_id, ItemInstance.container_i).filter(
+        ItemInstance.template_id.in_(starter_ids)
+    ).distinct())
     ItemInstance.query.filter(ItemInstance.template_id.in_(starter_ids)).delete(synchronize_session=False)
     for definition in starter_defs:
         db.session.delete(definition)
+    remove_template_fts(starter_ids)
     db.session.commit()
+    for template_id in starter_ids:
+        template_search_index.remove(template_id)
 
 
 def get_membership(user: User, lobby_id: Optional[int]) -> Optional[LobbyMember]:
@@ -1139,9 +3012,9 @@ def get_bag_instance(owner_id: int, bag_id: int) -> Optional[ItemInstance]:
 
 def container_size(container_id: str) -> Optional[tuple[int, int]]:
     if container_id == 'inv_main':
-        return MAIN_GRID_WIDTH, MAIN_GRID_HEIGHT
+        return settings.main_grid
     if container_id == 'hands':
-        return HANDS_GRID_WIDTH, HANDS_GRID_HEIGHT
+        return settings.hands_grid
     if container_id.startswith('fast:'):
         belt_id = parse_int(container_id.split(':', 1)[1], 0)
         belt_instance = ItemInstance.query.get(belt_id)
@@ -1181,15 +3054,15 @@ def shop_container_definition(owner_id: int, container_id: str) -> Optional[dict
         return {
             'id': container_id,
             'label': container_label(container_id),
-            'w': MAIN_GRID_WIDTH,
-            'h': MAIN_GRID_HEIGHT,
+            'w': settings.main_grid[0],
+            'h': settings.main_grid[1],
         }
     if container_id == 'hands':
         return {
             'id': container_id,
             'label': container_label(container_id),
-            'w': HANDS_GRID_WIDTH,
-            'h': HANDS_GRID_HEIGHT,
+            'w': settings.hands_grid[0],
+            'h': settings.hands_grid[1],
         }
     if container_id in EQUIPMENT_GRIDS:
         width, height = EQUIPMENT_GRIDS[container_id]
@@ -1242,47 +3115,50 @@ def shop_container_definition(owner_id: int, container_id: str) -> Optional[dict
     return None
 
 
-def build_instance_payload(
+def build_template_payload(definition: ItemDefinition) -> dict:
+    """Template-level item fields, shared by every instance of the definition."""
+    durability_enabled = has_durability(definition)
+    return {
+        'base_name': definition.name,
+        'type': definition.item_type.name,
+        'type_id': definition.type_id,
+        'quality': definition.quality,
+        'description': definition.description,
+        'image_path': definition.image_path,
+        'image_variants': image_variants_for(definition),
+        'is_cloth': bool(definition.is_cloth),
+        'size': {'w': definition.w, 'h': definition.h},
+        'rotatable': True,
+        'stackable': stackable_type(definition),
+        'max_stack': normalized_max_amount(definition),
+        'weight': definition.weight,
+        'max_durability': max(definition.max_durability or 0, 0) if durability_enabled else None,
+        'has_durability': durability_enabled,
+    }
+
+
+def build_instance_record(
     instance: ItemInstance,
     viewer: Optional[User],
     lobby_id: Optional[int],
 ) -> dict:
+    """Per-instance item fields; the compact inventory format pairs these with build_template_payload."""
     definition = instance.definition
-    effective_amount = max(instance.amount or 0, 0)
-    max_amount = normalized_max_amount(definition)
-    stackable = stackable_type(definition)
-    durability_enabled = has_durability(definition)
     visible_custom_description = None
     if viewer and (viewer.id == instance.owner_id or is_master(viewer, lobby_id)):
         visible_custom_description = instance.custom_description
-    max_durability = None
     current_durability = None
-    if durability_enabled:
+    if has_durability(definition):
         max_durability = max(definition.max_durability or 0, 0)
         current_durability = min(max(instance.str_current or 0, 0), max_durability)
     return {
         'id': instance.id,
         'template_id': definition.id,
         'owner_id': instance.owner_id,
-        'name': instance.custom_name or definition.name,
-        'base_name': definition.name,
         'custom_name': instance.custom_name,
-        'type': definition.item_type.name,
-        'type_id': definition.type_id,
-        'quality': definition.quality,
-        'description': definition.description,
         'custom_description': visible_custom_description,
-        'image_path': definition.image_path,
-        'is_cloth': bool(definition.is_cloth),
-        'size': {'w': definition.w, 'h': definition.h},
-        'rotatable': True,
-        'stackable': stackable,
-        'max_stack': max_amount,
-        'weight': definition.weight,
-        'max_durability': max_durability,
         'str_current': current_durability,
-        'has_durability': durability_enabled,
-        'amount': effective_amount,
+        'amount': max(instance.amount or 0, 0),
         'container_id': instance.container_i,
         'pos_x': instance.pos_x,
         'pos_y': instance.pos_y,
@@ -1291,11 +3167,25 @@ def build_instance_payload(
     }
 
 
+def build_instance_payload(
+    instance: ItemInstance,
+    viewer: Optional[User],
+    lobby_id: Optional[int],
+) -> dict:
+    payload = build_template_payload(instance.definition)
+    payload.update(build_instance_record(instance, viewer, lobby_id))
+    payload['name'] = instance.custom_name or instance.definition.name
+    return payload
+
+
+@instrumented('build_inventory_payload')
 def build_inventory_payload(
     user: Optional[User],
     lobby_id: Optional[int],
     viewer: Optional[User] = None,
+    compact: bool = False,
 ) -> dict:
+    """Full inventory view; `compact` moves template fields into a `templates` map keyed by template id."""
     if not user:
         return {
             'user': None,
@@ -1347,14 +3237,14 @@ def build_inventory_payload(
         {
             'id': 'inv_main',
             'label': container_label('inv_main'),
-            'w': MAIN_GRID_WIDTH,
-            'h': MAIN_GRID_HEIGHT,
+            'w': settings.main_grid[0],
+            'h': settings.main_grid[1],
         },
         {
             'id': 'hands',
             'label': container_label('hands'),
-            'w': HANDS_GRID_WIDTH,
-            'h': HANDS_GRID_HEIGHT,
+            'w': settings.hands_grid[0],
+            'h': settings.hands_grid[1],
         },
     ]
     for container_id, (width, height) in EQUIPMENT_GRIDS.items():
@@ -1418,10 +3308,17 @@ def build_inventory_payload(
             'belt_name': belt_instance.definition.name,
         })
     items_payload = []
+    templates_payload = {}
     for instance in instances:
-        items_payload.append(build_instance_payload(instance, viewer, lobby_id))
+        if not compact:
+            items_payload.append(build_instance_payload(instance, viewer, lobby_id))
+            continue
+        items_payload.append(build_instance_record(instance, viewer, lobby_id))
+        template_key = str(instance.template_id)
+        if template_key not in templates_payload:
+            templates_payload[template_key] = build_template_payload(instance.definition)
     current_weight = compute_inventory_weight(instances, user_id=user.id, log_context='payload')
-    inventory_debug = os.environ.get(INVENTORY_DEBUG_ENV, '').strip() in {'1', 'true', 'yes'}
+    inventory_debug = settings.debug_inventory
     permissions = {
         'can_edit': can_edit_inventory(viewer, user.id, lobby_id),
         'is_master': is_master(viewer, lobby_id),
@@ -1441,7 +3338,7 @@ def build_inventory_payload(
             user.id,
             current_weight,
         )
-    return {
+    payload = {
         'user': {
             'id': user.id,
             'name': user.nickname,
@@ -1462,6 +3359,13 @@ def build_inventory_payload(
         },
         'attributes': build_attributes_payload(user.id, viewer, lobby_id),
     }
+    if compact:
+        payload['templates'] = templates_payload
+    return payload
+
+
+def wants_compact_payload() -> bool:
+    return str(request.args.get('compact') or '').strip().lower() in {'1', 'true', 'yes', 'on'}
 
 
 def build_transfer_players(lobby_id: Optional[int]) -> list[dict]:
@@ -1603,6 +3507,23 @@ def handle_integrity_error(_error):
     return redirect(request.referrer or url_for('index'))
 
 
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(_error):
+    if request.path.startswith('/api/'):
+        return jsonify({'ok': False, 'error': 'too_large'}), 413
+    flash('Файл завеликий.', 'danger')
+    return redirect(request.referrer or url_for('index'))
+
+
+@app.errorhandler(StaleDataError)
+def handle_stale_data_error(_error):
+    # Another request changed or removed the row between our read and the conditional write.
+    db.session.rollback()
+    if inventory_logger.handlers:
+        inventory_logger.error('Inventory write lost a version race: %s', _error)
+    return jsonify({'ok': False, 'error': 'conflict'}), 409
+
+
 @app.route('/')
 @app.route('/index')
 def index():
@@ -1614,20 +3535,27 @@ def profile():
     user = require_user()
 
     if request.method == 'POST':
+        request.max_content_length = MAX_AVATAR_SIZE_BYTES + UPLOAD_FORM_OVERHEAD_BYTES
         user.description = request.form.get('description', '').strip() or None
         avatar_path = None
         upload_error = None
         if 'avatar' in request.files:
             avatar_file = request.files['avatar']
             error = validate_avatar_upload(avatar_file)
+            if not error:
+                try:
+                    avatar_path = save_upload(avatar_file, 'avatars', MAX_AVATAR_SIZE_BYTES)
+                except UploadRejected as exc:
+                    error = str(exc)
             if error:
                 upload_error = error
                 flash(error, 'danger')
-            else:
-                avatar_path = save_upload(avatar_file, 'avatars', f'user{user.id}')
+        replaced_avatar = bool(avatar_path and user.userImage and user.userImage != avatar_path)
         if avatar_path:
             user.userImage = avatar_path
         db.session.commit()
+        if replaced_avatar:
+            schedule_upload_gc(user.id)
         if upload_error:
             flash('Профіль оновлено, але аватар не змінено.', 'warning')
         else:
@@ -1812,11 +3740,32 @@ def inventory_api(user_id: int):
     target = User.query.get(user_id)
     if not target:
         return jsonify({'error': 'not_found'}), 404
-    return jsonify(build_inventory_payload(target, lobby_id, viewer=user))
+    return jsonify(build_inventory_payload(target, lobby_id, viewer=user, compact=wants_compact_payload()))
+
+
+def debug_access_allowed() -> bool:
+    """Debug endpoints open with DEBUG_ENDPOINTS, a METRICS_TOKEN bearer token or an admin session."""
+    if settings.debug_endpoints:
+        return True
+    auth_header = request.headers.get('Authorization', '')
+    if settings.metrics_token and auth_header.startswith('Bearer '):
+        if secrets.compare_digest(auth_header[len('Bearer '):].strip(), settings.metrics_token):
+            return True
+    user = current_user()
+    return bool(user and user.is_admin)
+
+
+@app.route('/api/debug/metrics')
+def debug_metrics():
+    if not debug_access_allowed():
+        return jsonify({'error': 'forbidden'}), 403
+    return Response(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 @app.route('/api/debug/db')
 def debug_db():
+    if not debug_access_allowed():
+        return jsonify({'error': 'forbidden'}), 403
     db_uri = app.config.get('SQLALCHEMY_DATABASE_URI')
     raw_path = _sqlite_db_path(db_uri) if db_uri else None
     db_path = os.path.abspath(raw_path) if raw_path else None
@@ -1841,7 +3790,7 @@ def lobby_inventory_api(lobby_id: int, user_id: int):
     target = User.query.get(user_id)
     if not target:
         return jsonify({'error': 'not_found'}), 404
-    return jsonify(build_inventory_payload(target, lobby_id, viewer=user))
+    return jsonify(build_inventory_payload(target, lobby_id, viewer=user, compact=wants_compact_payload()))
 
 
 @app.route('/api/lobby/<int:lobby_id>/chat', methods=['GET', 'POST'])
@@ -1858,20 +3807,84 @@ def lobby_chat_api(lobby_id: int):
         if not message_text:
             log_debug('Chat send failed: empty message from user %s in lobby %s', user.id, lobby_id)
             return jsonify({'error': 'empty_message'}), 400
+        system_chat_buffer.flush(lobby_id)
         message = create_chat_message(lobby_id, user.id, message_text)
         db.session.commit()
         return jsonify({'status': 'ok', 'message': serialize_chat_message(message)})
 
+    system_chat_buffer.flush(lobby_id)
     after_id = parse_int(request.args.get('after_id'), 0)
-    query = ChatMessage.query.filter_by(lobby_id=lobby_id).order_by(ChatMessage.id.asc())
+    before_id = parse_int(request.args.get('before_id'), 0)
+    limit = min(parse_int(request.args.get('limit'), CHAT_PAGE_LIMIT, minimum=1), CHAT_PAGE_LIMIT)
+    query = (
+        db.session.query(ChatMessage, User.nickname)
+        .outerjoin(User, User.id == ChatMessage.user_id)
+        .filter(ChatMessage.lobby_id == lobby_id)
+    )
     if after_id:
-        query = query.filter(ChatMessage.id > after_id)
-    messages = query.limit(120).all()
-    latest_id = messages[-1].id if messages else after_id
+        query = query.filter(ChatMessage.id > after_id).order_by(ChatMessage.id.asc())
+    else:
+        if before_id:
+            query = query.filter(ChatMessage.id < before_id)
+        query = query.order_by(ChatMessage.id.desc())
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not after_id:
+        rows.reverse()
+    messages = [serialize_chat_message(message, sender or '') for message, sender in rows]
+    latest_id = messages[-1]['id'] if messages else after_id
     return jsonify({
-        'messages': [serialize_chat_message(message) for message in messages],
+        'messages': messages,
         'latest_id': latest_id,
+        'oldest_id': messages[0]['id'] if messages else before_id or None,
+        'has_more': has_more,
+    })
+
+
+@app.route('/api/lobby/<int:lobby_id>/chat/retention', methods=['GET', 'POST'])
+def lobby_chat_retention(lobby_id: int):
+    user = require_user()
+    lobby = Lobby.query.get(lobby_id)
+    if not lobby:
+        return jsonify({'error': 'not_found'}), 404
+    if not is_lobby_master(user, lobby_id):
+        return jsonify({'error': 'forbidden'}), 403
+    payload = {'ok': True}
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if 'retention_days' in data:
+            raw_days = data.get('retention_days')
+            if raw_days in (None, ''):
+                lobby.chat_retention_days = None
+            else:
+                try:
+                    lobby.chat_retention_days = max(int(raw_days), 0)
+                except (TypeError, ValueError):
+                    return jsonify({'error': 'invalid_retention'}), 400
+        db.session.commit()
+        if str(data.get('archive_now') or '').strip().lower() in {'1', 'true', 'yes', 'on'}:
+            job = enqueue_chat_archive(lobby_id, user_id=user.id)
+            payload['job'] = serialize_job(job)
+    payload.update({
+        'retention_days': lobby.chat_retention_days,
+        'effective_retention_days': chat_retention_days(lobby),
+        'archived_segments': len(chat_archive_segments(lobby_id)),
     })
+    return jsonify(payload), 202 if 'job' in payload else 200
+
+
+@app.route('/api/lobby/<int:lobby_id>/chat/export')
+def lobby_chat_export(lobby_id: int):
+    user = require_user()
+    membership = LobbyMember.query.filter_by(lobby_id=lobby_id, user_id=user.id).first()
+    if not membership and not is_lobby_master(user, lobby_id):
+        return jsonify({'error': 'forbidden'}), 403
+    return Response(
+        stream_with_context(iter_chat_export(lobby_id)),
+        mimetype='application/gzip',
+        headers={'Content-Disposition': f'attachment; filename=lobby-{lobby_id}-chat.jsonl.gz'},
+    )
 
 
 @app.route('/api/lobby/<int:lobby_id>/shop/start', methods=['POST'])
@@ -1925,47 +3938,257 @@ def lobby_shop_status(lobby_id: int):
         ACTIVE_SHOPS.pop(lobby_id, None)
         log_shop_debug('Shop reset lobby=%s invalid container', lobby_id)
         return jsonify({'active': False})
-    instances = ItemInstance.query.filter_by(
-        owner_id=shop.owner_id,
-        container_i=shop.container_id,
-    ).all()
-    items_payload = [build_instance_payload(instance, user, lobby_id) for instance in instances]
-    return jsonify({
-        'active': True,
-        'container_id': shop.container_id,
-        'container': container_def,
-        'items': items_payload,
-    })
-
-
-@app.route('/api/lobby/<int:lobby_id>/skill-check/start', methods=['POST'])
-def start_skill_check(lobby_id: int):
-    user = require_user()
-    if not is_lobby_master(user, lobby_id):
+    # Custom descriptions are only shown to the owner and masters, so those viewers get their own entry.
+    privileged = user.id == shop.owner_id or is_master(user, lobby_id)
+    cache_key = (
+        lobby_id,
+        shop.owner_id,
+        shop.container_id,
+        container_def['w'],
+        container_def['h'],
+        privileged,
+    ) + state_revisions([
+        container_revision_key(shop.owner_id, shop.container_id),
+        TEMPLATES_REVISION_KEY,
+    ])
+    body = shop_payload_cache.get(cache_key)
+    if body is None:
+        instances = ItemInstance.query.filter_by(
+            owner_id=shop.owner_id,
+            container_i=shop.container_id,
+        ).all()
+        items_payload = [build_instance_payload(instance, user, lobby_id) for instance in instances]
+        body = app.json.dumps({
+            'active': True,
+            'container_id': shop.container_id,
+            'container': container_def,
+            'items': items_payload,
+        })
+        shop_payload_cache.put(cache_key, body)
+    return app.response_class(body, mimetype='application/json')
+
+
+def _reserve_shop_stock(
+    instance_id: int,
+    shop: ActiveShop,
+    requested: int,
+    version: int,
+    user_id: int,
+    placement: Optional[tuple[str, int, int, int]],
+) -> tuple[str, int, int]:
+    """Take stock from a shop stack with one conditional statement per attempt.
+
+    Returns ('moved' | 'consumed' | 'split' | 'conflict' | 'gone', amount taken, amount left).
+    Without a placement a whole stack is deleted instead of moved, for takes that only top up.
+    Without an explicit version, a take that loses a race re-reads the stack and tries again,
+    so players taking from the same stack only conflict when it runs out.
+    """
+    for _attempt in range(SHOP_TAKE_ATTEMPTS):
+        row = db.session.query(ItemInstance.amount, ItemInstance.version).filter(
+            ItemInstance.id == instance_id,
+            ItemInstance.owner_id == shop.owner_id,
+            ItemInstance.container_i == shop.container_id,
+        ).first()
+        if not row or row.amount <= 0:
+            return 'gone', 0, 0
+        if version and row.version != version:
+            return 'conflict', 0, row.amount
+        taken = min(requested, row.amount)
+        conditions = [
+            ItemInstance.id == instance_id,
+            ItemInstance.owner_id == shop.owner_id,
+            ItemInstance.container_i == shop.container_id,
+        ]
+        if version:
+            conditions.append(ItemInstance.version == version)
+        if taken == row.amount and placement is None:
+            statement = delete(ItemInstance).where(*conditions, ItemInstance.amount == taken)
+            outcome = 'consumed'
+        elif taken == row.amount:
+            container_id, pos_x, pos_y, rotation = placement
+            statement = update(ItemInstance).where(*conditions, ItemInstance.amount == taken).values(
+                owner_id=user_id,
+                container_i=container_id,
+                pos_x=pos_x,
+                pos_y=pos_y,
+                rotated=rotation,
+                version=ItemInstance.version + 1,
+            )
+            outcome = 'moved'
+        else:
+            statement = update(ItemInstance).where(*conditions, ItemInstance.amount > taken).values(
+                amount=ItemInstance.amount - taken,
+                version=ItemInstance.version + 1,
+            )
+            outcome = 'split'
+        result = db.session.execute(statement.execution_options(synchronize_session=False))
+        if result.rowcount == 1:
+            return outcome, taken, row.amount - taken
+        if version:
+            return 'conflict', 0, row.amount
+    return 'conflict', 0, 0
+
+
+@app.route('/api/lobby/<int:lobby_id>/shop/take', methods=['POST'])
+def lobby_shop_take(lobby_id: int):
+    user = require_user()
+    membership = get_membership(user, lobby_id)
+    # Spectators can look at the shop but, as everywhere else, cannot change inventories.
+    if not membership or not can_edit_inventory(user, user.id, lobby_id):
+        return jsonify({'ok': False, 'error': 'forbidden'}), 403
+    shop = ACTIVE_SHOPS.get(lobby_id)
+    if not shop:
+        return jsonify({'ok': False, 'error': 'shop_inactive'}), 409
+    if shop.owner_id == user.id:
+        return jsonify({'ok': False, 'error': 'own_shop'}), 400
+    data = request.get_json(silent=True) or {}
+    item_id = parse_int(data.get('item_id'), 0)
+    requested = parse_int(data.get('amount'), 1, minimum=1)
+    version = parse_int(data.get('version'), 0)
+
+    instance = ItemInstance.query.get(item_id)
+    if not instance or instance.owner_id != shop.owner_id or instance.container_i != shop.container_id:
+        return jsonify({'ok': False, 'error': 'not_found'}), 404
+    definition = instance.definition
+    if not stackable_type(definition):
+        requested = instance.amount
+    elif requested > normalized_max_amount(definition):
+        return jsonify({'ok': False, 'error': 'invalid_amount'}), 400
+
+    # Snapshot what the new stack copies before the conditional statement makes the ORM copy stale.
+    item_name = item_display_name(instance)
+    template_id = instance.template_id
+    str_current = instance.str_current
+    custom_name = instance.custom_name
+    custom_description = instance.custom_description
+    layout = InventoryLayout.load(user.id)
+    top_up_capacity = sum(
+        normalized_max_amount(definition) - stack.amount
+        for stack in top_up_candidates(
+            layout,
+            definition,
+            custom_name=custom_name,
+            custom_description=custom_description,
+        )
+    )
+    placement = None
+    if top_up_capacity < requested:
+        placement = layout.find_preferred_placement(PlacementPreview(definition=definition, owner_id=user.id))
+        if not placement:
+            return jsonify({'ok': False, 'error': 'no_space'}), 400
+
+    outcome, taken, remaining = _reserve_shop_stock(item_id, shop, requested, version, user.id, placement)
+    if outcome == 'gone':
+        db.session.rollback()
+        return jsonify({'ok': False, 'error': 'sold_out', 'delta': {'removed_ids': [item_id]}}), 409
+    if outcome == 'conflict':
+        db.session.rollback()
+        return jsonify({'ok': False, 'error': 'conflict', 'amount': remaining}), 409
+
+    left_to_place, topped_up = top_up_stacks(
+        layout,
+        definition,
+        taken,
+        custom_name=custom_name,
+        custom_description=custom_description,
+    )
+    added_instances: list[ItemInstance] = []
+    touched = [(shop.owner_id, shop.container_id)]
+    if outcome == 'moved':
+        db.session.refresh(instance)
+        if left_to_place <= 0:
+            # Existing stacks absorbed everything, so the moved row has nothing left to hold.
+            db.session.delete(instance)
+        else:
+            if left_to_place != taken:
+                instance.amount = left_to_place
+                instance.version += 1
+            added_instances.append(instance)
+            touched.append((user.id, instance.container_i))
+    elif left_to_place > 0:
+        container_id, pos_x, pos_y, rotation = placement
+        taken_instance = ItemInstance(
+            owner_id=user.id,
+            template_id=template_id,
+            container_i=container_id,
+            pos_x=pos_x,
+            pos_y=pos_y,
+            rotated=rotation,
+            str_current=str_current,
+            amount=left_to_place,
+            custom_name=custom_name,
+            custom_description=custom_description,
+        )
+        db.session.add(taken_instance)
+        added_instances.append(taken_instance)
+        touched.append((user.id, container_id))
+    mark_containers_touched(*touched)
+    queue_system_message(lobby_id, user.id, f'{user.nickname} took {item_name} x{taken} from the shop')
+    db.session.commit()
+
+    if outcome in {'moved', 'consumed'}:
+        shop_delta = {'removed_ids': [item_id]}
+    else:
+        db.session.refresh(instance)
+        shop_delta = {'updated': [{'id': item_id, 'amount': instance.amount, 'version': instance.version}]}
+    return jsonify({
+        'ok': True,
+        'taken': taken,
+        'delta': {
+            'shop': shop_delta,
+            'inventory': {
+                'added': [build_instance_payload(item, user, lobby_id) for item in added_instances],
+                'updated': [build_instance_payload(item, user, lobby_id) for item in topped_up],
+            },
+        },
+        'weight': build_weight_payload(user.id, log_context='shop_take'),
+    })
+
+
+@app.route('/api/lobby/<int:lobby_id>/skill-check/start', methods=['POST'])
+def start_skill_check(lobby_id: int):
+    user = require_user()
+    if not is_lobby_master(user, lobby_id):
         return jsonify({'error': 'forbidden'}), 403
     lobby = Lobby.query.get(lobby_id)
     if not lobby:
         return jsonify({'error': 'not_found'}), 404
     data = request.get_json(silent=True) or {}
-    target_user_id = parse_int(str(data.get('target_user_id') or ''), 0)
+    raw_targets = data.get('target_user_ids')
+    if not isinstance(raw_targets, list):
+        raw_targets = [data.get('target_user_id')]
+    target_user_ids = list(dict.fromkeys(parse_int(str(raw or ''), 0) for raw in raw_targets))
     difficulty = parse_int(str(data.get('difficulty') or ''), 0)
     if difficulty < 5 or difficulty > 30:
         return jsonify({'error': 'invalid_difficulty'}), 400
-    target_member = LobbyMember.query.filter_by(lobby_id=lobby_id, user_id=target_user_id).first()
-    if not target_member:
+    member_ids = {
+        member_id
+        for (member_id,) in db.session.query(LobbyMember.user_id).filter(
+            LobbyMember.lobby_id == lobby_id,
+            LobbyMember.user_id.in_(target_user_ids),
+        )
+    }
+    if not target_user_ids or any(target_id not in member_ids for target_id in target_user_ids):
         return jsonify({'error': 'invalid_target'}), 400
-    existing = ACTIVE_SKILL_CHECKS.get(lobby_id)
-    if existing and existing.status != 'completed':
-        return jsonify({'error': 'already_active'}), 409
-    check_id = secrets.token_hex(8)
-    check = ActiveSkillCheck(
-        id=check_id,
-        lobby_id=lobby_id,
-        target_user_id=target_user_id,
-        difficulty=difficulty,
-    )
-    ACTIVE_SKILL_CHECKS[lobby_id] = check
-    return jsonify({'status': 'ok', 'check': serialize_skill_check(check)})
+    busy_ids = [
+        target_id
+        for target_id in target_user_ids
+        if (lobby_id, target_id) in ACTIVE_SKILL_CHECKS
+    ]
+    if busy_ids:
+        return jsonify({'error': 'already_active', 'target_user_ids': busy_ids}), 409
+    checks = []
+    for target_id in target_user_ids:
+        check = ActiveSkillCheck(
+            id=secrets.token_hex(8),
+            lobby_id=lobby_id,
+            target_user_id=target_id,
+            difficulty=difficulty,
+            master_user_id=user.id,
+        )
+        ACTIVE_SKILL_CHECKS[(lobby_id, target_id)] = check
+        checks.append(serialize_skill_check(check))
+    return jsonify({'status': 'ok', 'check': checks[0], 'checks': checks})
 
 
 @app.route('/api/lobby/<int:lobby_id>/skill-check/status')
@@ -1974,13 +4197,37 @@ def skill_check_status(lobby_id: int):
     membership = LobbyMember.query.filter_by(lobby_id=lobby_id, user_id=user.id).first()
     if not membership:
         return jsonify({'error': 'forbidden'}), 403
-    check = ACTIVE_SKILL_CHECKS.get(lobby_id)
-    if not check:
-        return jsonify({'check': None})
-    if check.status == 'active' and check.expires_at and datetime.utcnow() >= check.expires_at:
-        complete_skill_check(check, success=False)
-        return jsonify({'check': None})
-    return jsonify({'check': serialize_skill_check(check)})
+    skill_check_scheduler.ensure_started()
+    checks = sorted(ACTIVE_SKILL_CHECKS.values(lobby_id), key=lambda check: check.created_at)
+    own_check = next((check for check in checks if check.target_user_id == user.id), None)
+    return jsonify({
+        'check': serialize_skill_check(own_check) if own_check else None,
+        'checks': [serialize_skill_check(check) for check in checks],
+    })
+
+
+@app.route('/api/lobby/<int:lobby_id>/skill-check/history')
+def skill_check_history(lobby_id: int):
+    user = require_user()
+    membership = LobbyMember.query.filter_by(lobby_id=lobby_id, user_id=user.id).first()
+    if not membership:
+        return jsonify({'error': 'forbidden'}), 403
+    before_id = parse_int(request.args.get('before_id'), 0)
+    target_user_id = parse_int(request.args.get('target_user_id'), 0)
+    limit = min(
+        parse_int(request.args.get('limit'), SKILL_CHECK_HISTORY_LIMIT, minimum=1),
+        SKILL_CHECK_HISTORY_LIMIT,
+    )
+    query = SkillCheckResult.query.filter(SkillCheckResult.lobby_id == lobby_id)
+    if before_id:
+        query = query.filter(SkillCheckResult.id < before_id)
+    if target_user_id:
+        query = query.filter(SkillCheckResult.target_user_id == target_user_id)
+    entries = query.order_by(SkillCheckResult.id.desc()).limit(limit + 1).all()
+    return jsonify({
+        'results': [serialize_skill_check_result(entry) for entry in entries[:limit]],
+        'has_more': len(entries) > limit,
+    })
 
 
 @app.route('/api/lobby/<int:lobby_id>/skill-check/accept', methods=['POST'])
@@ -1989,16 +4236,16 @@ def accept_skill_check(lobby_id: int):
     membership = LobbyMember.query.filter_by(lobby_id=lobby_id, user_id=user.id).first()
     if not membership:
         return jsonify({'error': 'forbidden'}), 403
-    check = ACTIVE_SKILL_CHECKS.get(lobby_id)
+    check = ACTIVE_SKILL_CHECKS.get((lobby_id, user.id))
     if not check:
         return jsonify({'error': 'not_found'}), 404
-    if check.target_user_id != user.id:
-        return jsonify({'error': 'forbidden'}), 403
     if check.status != 'pending':
         return jsonify({'error': 'already_started'}), 409
     check.status = 'active'
     check.started_at = datetime.utcnow()
     check.expires_at = check.started_at + timedelta(seconds=SKILL_CHECK_TIME_LIMIT)
+    ACTIVE_SKILL_CHECKS[(lobby_id, user.id)] = check
+    skill_check_scheduler.schedule(check)
     return jsonify({'status': 'ok', 'check': serialize_skill_check(check)})
 
 
@@ -2008,11 +4255,9 @@ def skill_check_result(lobby_id: int):
     membership = LobbyMember.query.filter_by(lobby_id=lobby_id, user_id=user.id).first()
     if not membership:
         return jsonify({'error': 'forbidden'}), 403
-    check = ACTIVE_SKILL_CHECKS.get(lobby_id)
+    check = ACTIVE_SKILL_CHECKS.get((lobby_id, user.id))
     if not check:
         return jsonify({'error': 'not_found'}), 404
-    if check.target_user_id != user.id:
-        return jsonify({'error': 'forbidden'}), 403
     data = request.get_json(silent=True) or {}
     success = data.get('success')
     if not isinstance(success, bool):
@@ -2024,7 +4269,7 @@ def skill_check_result(lobby_id: int):
     if success and check.status != 'active':
         return jsonify({'error': 'not_active'}), 409
     if check.status in {'pending', 'active'}:
-        complete_skill_check(check, success=success)
+        complete_skill_check(check, success=success, successes=successes, failures=failures)
     return jsonify({'status': 'ok'})
 
 
@@ -2063,151 +4308,798 @@ def master_user_id(lobby_id: Optional[int]) -> Optional[int]:
     return lobby.admin_id
 
 
-def auto_place_item(
-    instance: ItemInstance,
-    container_id: str,
-    *,
-    prefer_rotation: Optional[int] = None,
-) -> Optional[tuple[int, int, int]]:
-    rotations = [normalize_rotation_value(prefer_rotation)]
-    rotations.append(1 - rotations[0])
-    for rotation in rotations:
-        position = find_first_fit(instance, container_id, rotation)
-        if position:
-            return position[0], position[1], rotation
-    return None
+def auto_place_item(
+    instance: ItemInstance,
+    container_id: str,
+    *,
+    prefer_rotation: Optional[int] = None,
+) -> Optional[tuple[int, int, int]]:
+    rotations = [normalize_rotation_value(prefer_rotation)]
+    rotations.append(1 - rotations[0])
+    for rotation in rotations:
+        position = find_first_fit(instance, container_id, rotation)
+        if position:
+            return position[0], position[1], rotation
+    return None
+
+
+def preferred_container_ids(owner_id: int) -> list[str]:
+    return InventoryLayout.load(owner_id).preferred_container_ids()
+
+
+@dataclass
+class InventoryLayout:
+    """In-memory view of one owner's inventory used for bulk placement checks.
+
+    Mirrors container_size/is_container_allowed/can_place_item/find_first_fit,
+    but works on instances loaded once instead of querying per cell.
+    """
+
+    owner_id: int
+    instances: list[ItemInstance] = field(default_factory=list)
+
+    @classmethod
+    def load(cls, owner_id: int) -> 'InventoryLayout':
+        instances = (
+            ItemInstance.query
+            .filter_by(owner_id=owner_id)
+            .order_by(ItemInstance.id.asc())
+            .all()
+        )
+        return cls(owner_id=owner_id, instances=instances)
+
+    def get(self, instance_id: int) -> Optional[ItemInstance]:
+        for instance in self.instances:
+            if instance.id == instance_id:
+                return instance
+        return None
+
+    def bag_instance(self, container_id: str) -> Optional[ItemInstance]:
+        bag_instance = self.get(parse_int(container_id.split(':', 1)[1], 0))
+        if not bag_instance or bag_instance.container_i not in EQUIPMENT_GRIDS:
+            return None
+        definition = bag_instance.definition
+        if not definition.is_cloth or not definition.bag_width or not definition.bag_height:
+            return None
+        return bag_instance
+
+    def belt_instance(self, container_id: str) -> Optional[ItemInstance]:
+        belt_instance = self.get(parse_int(container_id.split(':', 1)[1], 0))
+        if not belt_instance or belt_instance.container_i != 'equip_belt':
+            return None
+        definition = belt_instance.definition
+        if not definition.item_type or definition.item_type.name != 'belt':
+            return None
+        if (definition.fast_w or 0) <= 0 or (definition.fast_h or 0) <= 0:
+            return None
+        return belt_instance
+
+    def container_size(self, container_id: str) -> Optional[tuple[int, int]]:
+        if container_id.startswith('fast:'):
+            belt_instance = self.belt_instance(container_id)
+            if not belt_instance:
+                return None
+            return belt_instance.definition.fast_w, belt_instance.definition.fast_h
+        if container_id.startswith('bag:'):
+            bag_instance = self.bag_instance(container_id)
+            if not bag_instance:
+                return None
+            return bag_instance.definition.bag_width, bag_instance.definition.bag_height
+        return container_size(container_id)
+
+    def is_container_allowed(self, instance: ItemInstance, container_id: str) -> tuple[bool, str]:
+        if container_id in {'inv_main', 'hands'}:
+            return True, ''
+        if container_id.startswith('fast:'):
+            if not self.belt_instance(container_id):
+                return False, 'invalid_belt'
+            return True, ''
+        if container_id.startswith('bag:'):
+            if not self.bag_instance(container_id):
+                return False, 'missing_backpack'
+            return True, ''
+        if container_id in EQUIPMENT_GRIDS or container_id in SPECIAL_GRIDS:
+            allowed_types = CONTAINER_ALLOWED_TYPES.get(container_id)
+            if allowed_types and instance.definition.item_type.name not in allowed_types:
+                return False, 'type_mismatch'
+            return True, ''
+        return False, 'invalid_container'
+
+    def occupied_cells(self, container_id: str, exclude_id: Optional[int] = None) -> set[tuple[int, int]]:
+        occupied = set()
+        for other in self.instances:
+            if other.container_i != container_id or (exclude_id and other.id == exclude_id):
+                continue
+            if other.pos_x is None or other.pos_y is None:
+                continue
+            other_w, other_h = item_dimensions(other.definition, other.rotated)
+            for dx in range(other_w):
+                for dy in range(other_h):
+                    occupied.add((other.pos_x + dx, other.pos_y + dy))
+        return occupied
+
+    def can_place(
+        self,
+        instance: ItemInstance,
+        container_id: str,
+        pos_x: int,
+        pos_y: int,
+        rotated: int,
+        *,
+        occupied: Optional[set[tuple[int, int]]] = None,
+    ) -> tuple[bool, Optional[str]]:
+        size = self.container_size(container_id)
+        if not size:
+            return False, 'invalid_container'
+        width, height = size
+        item_w, item_h = item_dimensions(instance.definition, rotated)
+        if pos_x < 1 or pos_y < 1:
+            return False, 'out_of_bounds'
+        if pos_x + item_w - 1 > width or pos_y + item_h - 1 > height:
+            return False, 'out_of_bounds'
+        if occupied is None:
+            occupied = self.occupied_cells(container_id, exclude_id=instance.id)
+        for dx in range(item_w):
+            for dy in range(item_h):
+                if (pos_x + dx, pos_y + dy) in occupied:
+                    return False, 'overlap'
+        return True, None
+
+    def find_first_fit(
+        self,
+        instance: ItemInstance,
+        container_id: str,
+        rotated: int,
+    ) -> Optional[tuple[int, int]]:
+        size = self.container_size(container_id)
+        if not size:
+            return None
+        width, height = size
+        item_w, item_h = item_dimensions(instance.definition, rotated)
+        occupied = self.occupied_cells(container_id, exclude_id=instance.id)
+        for y in range(1, height - item_h + 2):
+            for x in range(1, width - item_w + 2):
+                valid, _reason = self.can_place(instance, container_id, x, y, rotated, occupied=occupied)
+                if valid:
+                    return x, y
+        return None
+
+    def auto_place(
+        self,
+        instance: ItemInstance,
+        container_id: str,
+        *,
+        prefer_rotation: Optional[int] = None,
+    ) -> Optional[tuple[int, int, int]]:
+        rotations = [normalize_rotation_value(prefer_rotation)]
+        rotations.append(1 - rotations[0])
+        for rotation in rotations:
+            position = self.find_first_fit(instance, container_id, rotation)
+            if position:
+                return position[0], position[1], rotation
+        return None
+
+    def preferred_container_ids(self) -> list[str]:
+        bag_ids = [
+            f'bag:{instance.id}'
+            for instance in self.instances
+            if self.bag_instance(f'bag:{instance.id}')
+        ]
+        fast_ids = [
+            f'fast:{instance.id}'
+            for instance in self.instances
+            if self.belt_instance(f'fast:{instance.id}')
+        ]
+        containers: list[str] = []
+        for container_id in (
+            bag_ids
+            + ['inv_main', 'hands']
+            + list(EQUIPMENT_GRIDS.keys())
+            + list(SPECIAL_GRIDS.keys())
+            + fast_ids
+        ):
+            if container_id not in containers:
+                containers.append(container_id)
+        return containers
+
+    def find_preferred_placement(
+        self,
+        instance: ItemInstance,
+        *,
+        prefer_container: Optional[str] = None,
+    ) -> Optional[tuple[str, int, int, int]]:
+        candidate_containers = [prefer_container] if prefer_container else []
+        for container_id in self.preferred_container_ids():
+            if container_id not in candidate_containers:
+                candidate_containers.append(container_id)
+        for container_id in candidate_containers:
+            if not self.container_size(container_id):
+                continue
+            allowed, _reason = self.is_container_allowed(instance, container_id)
+            if not allowed:
+                continue
+            target_pos = self.auto_place(instance, container_id)
+            if target_pos:
+                return container_id, target_pos[0], target_pos[1], target_pos[2]
+        return None
+
+
+def find_preferred_placement(
+    instance: ItemInstance,
+    owner_id: int,
+    *,
+    prefer_container: Optional[str] = None,
+) -> Optional[tuple[str, int, int, int]]:
+    layout = InventoryLayout.load(owner_id)
+    return layout.find_preferred_placement(instance, prefer_container=prefer_container)
+
+
+def definition_geometry(definition: ItemDefinition) -> tuple:
+    return (
+        definition.w,
+        definition.h,
+        bool(definition.is_cloth),
+        definition.bag_width,
+        definition.bag_height,
+        definition.fast_w,
+        definition.fast_h,
+        definition.item_type.name if definition.item_type else None,
+    )
+
+
+def repack_owner_instances(layout: InventoryLayout, template_id: int) -> list[int]:
+    targets = [instance for instance in layout.instances if instance.template_id == template_id]
+    nested_containers = set()
+    for instance in targets:
+        nested_containers.add(f'bag:{instance.id}')
+        nested_containers.add(f'fast:{instance.id}')
+    targets.extend(instance for instance in layout.instances if instance.container_i in nested_containers)
+
+    invalid_instances: list[ItemInstance] = []
+    for instance in targets:
+        container_id = instance.container_i or 'inv_main'
+        rotation = normalize_rotation_value(instance.rotated)
+        if not layout.container_size(container_id):
+            invalid_instances.append(instance)
+            continue
+        allowed, _reason = layout.is_container_allowed(instance, container_id)
+        if not allowed:
+            invalid_instances.append(instance)
+            continue
+        if instance.pos_x is None or instance.pos_y is None:
+            invalid_instances.append(instance)
+            continue
+        valid, _reason = layout.can_place(instance, container_id, instance.pos_x, instance.pos_y, rotation)
+        if not valid:
+            invalid_instances.append(instance)
+            continue
+
+    for instance in invalid_instances:
+        instance.pos_x = None
+        instance.pos_y = None
+
+    unplaced_ids: list[int] = []
+    for instance in invalid_instances:
+        placement = layout.find_preferred_placement(instance, prefer_container=instance.container_i)
+        if placement:
+            container_id, pos_x, pos_y, rotation = placement
+            instance.container_i = container_id
+            instance.pos_x = pos_x
+            instance.pos_y = pos_y
+            instance.rotated = rotation
+        else:
+            instance.container_i = 'inv_main'
+            instance.pos_x = None
+            instance.pos_y = None
+            unplaced_ids.append(instance.id)
+        instance.version += 1
+    return unplaced_ids
+
+
+def repack_instances_for_definition(
+    definition: ItemDefinition,
+    *,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> list[int]:
+    owner_ids = [
+        owner_id
+        for (owner_id,) in (
+            db.session.query(ItemInstance.owner_id)
+            .filter(ItemInstance.template_id == definition.id)
+            .distinct()
+            .order_by(ItemInstance.owner_id.asc())
+            .all()
+        )
+    ]
+    unplaced_ids: list[int] = []
+    for index, owner_id in enumerate(owner_ids, start=1):
+        unplaced_ids.extend(repack_owner_instances(InventoryLayout.load(owner_id), definition.id))
+        if on_progress:
+            on_progress(index, len(owner_ids))
+    return unplaced_ids
+
+
+JOB_MAX_WORKERS = 2
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY_SECONDS = 0.5
+# Each process renews the lease on its queued and running jobs; other workers take over or
+# fail a job only after its lease has gone unrenewed for JOB_LEASE_SECONDS.
+JOB_HEARTBEAT_INTERVAL_SECONDS = 30
+JOB_LEASE_SECONDS = 120
+JOB_HANDLERS: dict[str, Callable[[BackgroundJob, dict], Optional[dict]]] = {}
+job_executor = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS, thread_name_prefix='dra-job')
+
+
+def job_handler(kind: str):
+    def register(func: Callable[[BackgroundJob, dict], Optional[dict]]):
+        JOB_HANDLERS[kind] = func
+        return func
+    return register
+
+
+def is_database_locked(exc: Exception) -> bool:
+    return isinstance(exc, OperationalError) and 'database is locked' in str(exc).lower()
+
+
+def serialize_job(job: BackgroundJob) -> dict:
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': {'done': job.progress_done, 'total': job.progress_total},
+        'attempts': job.attempts,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def update_job_progress(job: BackgroundJob, done: int, total: int) -> None:
+    """Record progress and commit the work done so far, releasing the write lock."""
+    job.progress_done = done
+    job.progress_total = total
+    db.session.commit()
+
+
+def _finish_job(job_id: str, status: str, *, result: Optional[dict] = None, error: Optional[str] = None) -> None:
+    for attempt in range(1, JOB_MAX_ATTEMPTS + 1):
+        try:
+            job = BackgroundJob.query.get(job_id)
+            job.status = status
+            job.result = json.dumps(result) if result is not None else None
+            job.error = error
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            return
+        except OperationalError as exc:
+            db.session.rollback()
+            if not is_database_locked(exc) or attempt == JOB_MAX_ATTEMPTS:
+                app.logger.error('Job %s state update failed: %s', job_id, exc)
+                return
+            time.sleep(JOB_RETRY_DELAY_SECONDS * attempt)
+
+
+def _run_job(job_id: str) -> None:
+    with app.app_context():
+        try:
+            for attempt in range(1, JOB_MAX_ATTEMPTS + 1):
+                try:
+                    job = BackgroundJob.query.get(job_id)
+                    if not job or job.worker_token != WORKER_BOOT_TOKEN:
+                        # Another worker took the job over after this process's lease ran out.
+                        return
+                    job.status = 'running'
+                    job.heartbeat_at = datetime.utcnow()
+                    job.attempts = attempt
+                    job.started_at = job.started_at or datetime.utcnow()
+                    db.session.commit()
+                    handler = JOB_HANDLERS[job.kind]
+                    result = handler(job, json.loads(job.payload or '{}'))
+                    db.session.commit()
+                except StaleDataError:
+                    db.session.rollback()
+                    if attempt < JOB_MAX_ATTEMPTS:
+                        app.logger.warning('Job %s lost a version race, retrying (%s)', job_id, attempt)
+                        continue
+                    _finish_job(job_id, 'failed', error='conflict')
+                    return
+                except OperationalError as exc:
+                    db.session.rollback()
+                    if is_database_locked(exc) and attempt < JOB_MAX_ATTEMPTS:
+                        app.logger.warning('Job %s hit a locked database, retrying (%s)', job_id, attempt)
+                        time.sleep(JOB_RETRY_DELAY_SECONDS * attempt)
+                        continue
+                    _finish_job(job_id, 'failed', error='db_locked' if is_database_locked(exc) else 'db_error')
+                    return
+                except ValueError as exc:
+                    db.session.rollback()
+                    _finish_job(job_id, 'failed', error=str(exc))
+                    return
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Job %s failed', job_id)
+                    _finish_job(job_id, 'failed', error='server_error')
+                    return
+                _finish_job(job_id, 'completed', result=result)
+                return
+        finally:
+            db.session.remove()
+
+
+def enqueue_job(
+    kind: str,
+    payload: dict,
+    *,
+    user_id: Optional[int] = None,
+    lobby_id: Optional[int] = None,
+) -> BackgroundJob:
+    """Persist a job and hand it to the worker pool; commits the current session."""
+    if kind not in JOB_HANDLERS:
+        raise KeyError(kind)
+    job = BackgroundJob(
+        id=secrets.token_hex(8),
+        kind=kind,
+        payload=json.dumps(payload),
+        user_id=user_id,
+        lobby_id=lobby_id,
+        worker_pid=os.getpid(),
+        worker_token=WORKER_BOOT_TOKEN,
+        heartbeat_at=datetime.utcnow(),
+    )
+    db.session.add(job)
+    db.session.commit()
+    job_executor.submit(_run_job, job.id)
+    return job
+
+
+def renew_job_leases() -> int:
+    """Mark this process's unfinished jobs as alive; returns how many leases were renewed."""
+    result = db.session.execute(
+        update(BackgroundJob)
+        .where(
+            BackgroundJob.worker_token == WORKER_BOOT_TOKEN,
+            BackgroundJob.status.in_(('queued', 'running')),
+        )
+        .values(heartbeat_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def recover_interrupted_jobs() -> tuple[int, int]:
+    """Settle jobs whose worker stopped renewing their lease; returns (requeued, failed).
+
+    Queued jobs never started, so they are handed to this process's pool. Running jobs
+    may have done part of their work and are marked failed instead of being replayed.
+    Each job is claimed with a conditional UPDATE on the token and lease that were read, so
+    when several workers recover at once exactly one of them wins it.
+    """
+    if not inspect(db.engine).has_table(BackgroundJob.__tablename__):
+        return 0, 0
+    now = datetime.utcnow()
+    lease_expired = or_(
+        BackgroundJob.heartbeat_at.is_(None),
+        BackgroundJob.heartbeat_at < now - timedelta(seconds=JOB_LEASE_SECONDS),
+    )
+    candidates = (
+        db.session.query(BackgroundJob.id, BackgroundJob.kind, BackgroundJob.status, BackgroundJob.worker_token)
+        .filter(
+            BackgroundJob.status.in_(('queued', 'running')),
+            or_(BackgroundJob.worker_token.is_(None), BackgroundJob.worker_token != WORKER_BOOT_TOKEN),
+            lease_expired,
+        )
+        .all()
+    )
+    requeued: list[str] = []
+    failed = 0
+    for job_id, kind, status, token in candidates:
+        claim = update(BackgroundJob).where(
+            BackgroundJob.id == job_id,
+            BackgroundJob.status == status,
+            BackgroundJob.worker_token.is_(None) if token is None else BackgroundJob.worker_token == token,
+            lease_expired,
+        )
+        takeover = status == 'queued' and kind in JOB_HANDLERS
+        if takeover:
+            claim = claim.values(worker_pid=os.getpid(), worker_token=WORKER_BOOT_TOKEN, heartbeat_at=now)
+        else:
+            claim = claim.values(status='failed', error='interrupted', finished_at=now, worker_token=WORKER_BOOT_TOKEN)
+        if db.session.execute(claim.execution_options(synchronize_session=False)).rowcount != 1:
+            continue
+        if takeover:
+            requeued.append(job_id)
+        else:
+            failed += 1
+    db.session.commit()
+    for job_id in requeued:
+        job_executor.submit(_run_job, job_id)
+    return len(requeued), failed
+
+
+def _job_lease_loop() -> None:
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL_SECONDS)
+        with app.app_context():
+            try:
+                renew_job_leases()
+                # Jobs of a worker that died while its siblings kept running are picked up here.
+                recover_interrupted_jobs()
+            except SQLAlchemyError:
+                db.session.rollback()
+                app.logger.warning('Job lease renewal failed', exc_info=True)
+            finally:
+                db.session.remove()
+
+
+@job_handler('repack_template')
+def _repack_template_job(job: BackgroundJob, payload: dict) -> dict:
+    definition = ItemDefinition.query.get(payload.get('template_id'))
+    if not definition:
+        raise ValueError('not_found')
+    unplaced_ids = repack_instances_for_definition(
+        definition,
+        on_progress=lambda done, total: update_job_progress(job, done, total),
+    )
+    return {'template_id': definition.id, 'unplaced': unplaced_ids}
+
+
+@job_handler('image_variants')
+def _image_variants_job(job: BackgroundJob, payload: dict) -> dict:
+    definition = ItemDefinition.query.get(payload.get('definition_id'))
+    if not definition:
+        raise ValueError('not_found')
+    if definition.image_path != payload.get('image_path'):
+        return {'definition_id': definition.id, 'sizes': [], 'superseded': True}
+    variants = refresh_image_variants(definition)
+    db.session.commit()
+    return {'definition_id': definition.id, 'sizes': sorted(int(size) for size in variants)}
+
+
+def enqueue_image_variants(definition: ItemDefinition, user_id: Optional[int], lobby_id: Optional[int]) -> None:
+    if Image is None or not definition.image_path:
+        return
+    enqueue_job(
+        'image_variants',
+        {'definition_id': definition.id, 'image_path': definition.image_path},
+        user_id=user_id,
+        lobby_id=lobby_id,
+    )
+
+
+@app.cli.command('build-thumbnails')
+@click.option('--force', is_flag=True, help='Rebuild variants that already exist.')
+def build_thumbnails_command(force: bool):
+    """Write WebP thumbnails for item definitions with an uploaded image."""
+    if Image is None:
+        raise click.ClickException('Pillow is not installed')
+    query = ItemDefinition.query.filter(ItemDefinition.image_path.isnot(None))
+    if not force:
+        query = query.filter(ItemDefinition.image_variants.is_(None))
+    built = 0
+    for definition in query.all():
+        if refresh_image_variants(definition):
+            built += 1
+    db.session.commit()
+    click.echo(f'{built} definitions updated')
+
+
+@job_handler('collect_uploads')
+def _collect_uploads_job(job: BackgroundJob, payload: dict) -> dict:
+    return {'removed': collect_orphaned_uploads()}
+
+
+@app.cli.command('gc-uploads')
+@click.option('--grace', type=int, default=UPLOAD_GC_GRACE_SECONDS, help='Keep orphans younger than this many seconds.')
+def gc_uploads_command(grace: int):
+    """Delete uploaded files no template or avatar references any more."""
+    click.echo(f'{collect_orphaned_uploads(grace)} files removed')
+
+
+@job_handler('cleanup_starter_kit')
+def _cleanup_starter_kit_job(job: BackgroundJob, payload: dict) -> None:
+    cleanup_starter_kit()
+
+
+def top_up_candidates(
+    layout: InventoryLayout,
+    definition: ItemDefinition,
+    *,
+    custom_name: Optional[str] = None,
+    custom_description: Optional[str] = None,
+) -> list[ItemInstance]:
+    """Partial stacks of the item that sit where placement could also put new items."""
+    if not stackable_type(definition):
+        return []
+    max_amount = normalized_max_amount(definition)
+    allowed = set(layout.preferred_container_ids())
+    # Items laid out in an open shop belong to the shop until someone takes them.
+    allowed -= {shop.container_id for shop in ACTIVE_SHOPS.values() if shop.owner_id == layout.owner_id}
+    return [
+        instance
+        for instance in layout.instances
+        if instance.template_id == definition.id
+        and instance.pos_x is not None
+        and instance.amount < max_amount
+        and instance.custom_name == custom_name
+        and instance.custom_description == custom_description
+        and instance.container_i in allowed
+        and layout.is_container_allowed(instance, instance.container_i)[0]
+    ]
+
+
+def top_up_stacks(
+    layout: InventoryLayout,
+    definition: ItemDefinition,
+    amount: int,
+    *,
+    custom_name: Optional[str] = None,
+    custom_description: Optional[str] = None,
+) -> tuple[int, list[ItemInstance]]:
+    """Add to the owner's partial stacks of the same item first; returns the amount still to place."""
+    if amount <= 0 or not stackable_type(definition):
+        return amount, []
+    max_amount = normalized_max_amount(definition)
+    topped_up: list[ItemInstance] = []
+    candidates = top_up_candidates(
+        layout,
+        definition,
+        custom_name=custom_name,
+        custom_description=custom_description,
+    )
+    for instance in candidates:
+        if amount <= 0:
+            break
+        added = min(max_amount - instance.amount, amount)
+        instance.amount += added
+        instance.version += 1
+        amount -= added
+        topped_up.append(instance)
+    return amount, topped_up
+
+
+def issue_item_stacks(
+    definition: ItemDefinition,
+    owner_id: int,
+    amount: int,
+    *,
+    durability_value: Optional[int] = None,
+    randomize_durability: bool = False,
+) -> tuple[list[ItemInstance], list[ItemInstance]]:
+    """Give an owner `amount` of an item; returns (new instances, topped-up existing stacks)."""
+    layout = InventoryLayout.load(owner_id)
+    created_instances: list[ItemInstance] = []
+    amount, topped_up = top_up_stacks(layout, definition, max(amount, 1))
+    if amount <= 0:
+        return created_instances, topped_up
+    for stack_amount in split_stack_amounts(definition, amount):
+        temp_instance = PlacementPreview(
+            owner_id=owner_id,
+            definition=definition,
+        )
+        placement = layout.find_preferred_placement(temp_instance)
+        if not placement:
+            raise ValueError('no_space')
+        container_id, pos_x, pos_y, rotation = placement
+        new_instance = ItemInstance(
+            owner_id=owner_id,
+            template_id=definition.id,
+            container_i=container_id,
+            pos_x=pos_x,
+            pos_y=pos_y,
+            rotated=rotation,
+            str_current=resolve_durability_value(
+                definition,
+                durability_value,
+                randomize=randomize_durability,
+            ),
+            amount=stack_amount,
+        )
+        db.session.add(new_instance)
+        db.session.flush()
+        layout.instances.append(new_instance)
+        created_instances.append(new_instance)
+    return created_instances, topped_up
+
+
+def serialize_issued_instances(instances: list[ItemInstance]) -> list[dict]:
+    return [
+        {
+            'instance_id': instance.id,
+            'amount': instance.amount,
+            'container_id': instance.container_i,
+            'pos_x': instance.pos_x,
+            'pos_y': instance.pos_y,
+        }
+        for instance in instances
+    ]
+
 
+@job_handler('issue_items')
+def _issue_items_job(job: BackgroundJob, payload: dict) -> dict:
+    definition = ItemDefinition.query.get(payload.get('definition_id'))
+    if not definition:
+        raise ValueError('definition_not_found')
+    created_instances, topped_up = issue_item_stacks(
+        definition,
+        payload['target_user_id'],
+        payload.get('amount') or 1,
+        durability_value=payload.get('durability_current'),
+    )
+    return {
+        'created': serialize_issued_instances(created_instances),
+        'topped_up': serialize_issued_instances(topped_up),
+    }
 
-def preferred_container_ids(owner_id: int) -> list[str]:
-    containers: list[str] = []
-    seen: set[str] = set()
-    instances = ItemInstance.query.filter_by(owner_id=owner_id).all()
-    bag_instances = []
-    fast_instances = []
-    for instance in instances:
-        definition = instance.definition
-        if (
-            instance.container_i in EQUIPMENT_GRIDS
-            and definition.is_cloth
-            and (definition.bag_width or 0) > 0
-            and (definition.bag_height or 0) > 0
-        ):
-            bag_instances.append(instance)
-        if (
-            instance.container_i == 'equip_belt'
-            and definition.item_type
-            and definition.item_type.name == 'belt'
-            and (definition.fast_w or 0) > 0
-            and (definition.fast_h or 0) > 0
-        ):
-            fast_instances.append(instance)
 
-    for bag_instance in bag_instances:
-        container_id = f'bag:{bag_instance.id}'
-        if container_id not in seen:
-            containers.append(container_id)
-            seen.add(container_id)
+def _pending_chat_archive(lobby_id: Optional[int]) -> Optional[BackgroundJob]:
+    pending = BackgroundJob.query.filter(
+        BackgroundJob.kind == 'archive_chat',
+        BackgroundJob.status.in_(('queued', 'running')),
+    )
+    if lobby_id is None:
+        pending = pending.filter(BackgroundJob.lobby_id.is_(None))
+    else:
+        # A pass over every lobby covers this one too.
+        pending = pending.filter(or_(BackgroundJob.lobby_id == lobby_id, BackgroundJob.lobby_id.is_(None)))
+    return pending.order_by(BackgroundJob.created_at.asc()).first()
 
-    for container_id in ('inv_main', 'hands'):
-        if container_id not in seen:
-            containers.append(container_id)
-            seen.add(container_id)
 
-    for container_id in list(EQUIPMENT_GRIDS.keys()) + list(SPECIAL_GRIDS.keys()):
-        if container_id not in seen:
-            containers.append(container_id)
-            seen.add(container_id)
+def enqueue_chat_archive(lobby_id: Optional[int] = None, *, user_id: Optional[int] = None) -> BackgroundJob:
+    """Queue an archive pass for one lobby (or all), reusing one that is already pending."""
+    existing = _pending_chat_archive(lobby_id)
+    if existing:
+        return existing
+    payload = {'lobby_id': lobby_id} if lobby_id is not None else {}
+    try:
+        return enqueue_job('archive_chat', payload, user_id=user_id, lobby_id=lobby_id)
+    except IntegrityError:
+        # uq_background_job_active_archive: another request or worker queued it first.
+        db.session.rollback()
+        return _pending_chat_archive(lobby_id)
 
-    for fast_instance in fast_instances:
-        container_id = f'fast:{fast_instance.id}'
-        if container_id not in seen:
-            containers.append(container_id)
-            seen.add(container_id)
-    return containers
 
+# Counted from startup so a fresh process doesn't archive before serving its first requests.
+_last_chat_archive = time.monotonic()
 
-def find_preferred_placement(
-    instance: ItemInstance,
-    owner_id: int,
-    *,
-    prefer_container: Optional[str] = None,
-) -> Optional[tuple[str, int, int, int]]:
-    candidate_containers: list[str] = []
-    seen: set[str] = set()
-    if prefer_container:
-        candidate_containers.append(prefer_container)
-        seen.add(prefer_container)
-    for container_id in preferred_container_ids(owner_id):
-        if container_id in seen:
-            continue
-        candidate_containers.append(container_id)
-        seen.add(container_id)
 
-    for container_id in candidate_containers:
-        if not container_size(container_id):
-            continue
-        allowed, _reason = is_container_allowed(instance, container_id, owner_id)
-        if not allowed:
-            continue
-        target_pos = auto_place_item(instance, container_id)
-        if target_pos:
-            return container_id, target_pos[0], target_pos[1], target_pos[2]
-    return None
+@app.before_request
+def schedule_chat_archive() -> None:
+    """Queue the periodic archive pass over every lobby, at most once per interval."""
+    global _last_chat_archive
+    now = time.monotonic()
+    if now - _last_chat_archive < CHAT_ARCHIVE_INTERVAL_SECONDS:
+        return
+    _last_chat_archive = now
+    # Every worker keeps its own clock; the job table tells whether a sibling already queued one.
+    recent = BackgroundJob.query.filter(
+        BackgroundJob.kind == 'archive_chat',
+        BackgroundJob.lobby_id.is_(None),
+        BackgroundJob.created_at >= datetime.utcnow() - timedelta(seconds=CHAT_ARCHIVE_INTERVAL_SECONDS),
+    ).first()
+    if not recent:
+        enqueue_chat_archive()
 
 
-def repack_instances_for_definition(definition: ItemDefinition) -> list[int]:
-    instances = (
-        ItemInstance.query
-        .filter_by(template_id=definition.id)
-        .order_by(ItemInstance.owner_id.asc(), ItemInstance.id.asc())
-        .all()
+@job_handler('archive_chat')
+def _archive_chat_job(job: BackgroundJob, payload: dict) -> dict:
+    lobby_ids = [payload['lobby_id']] if payload.get('lobby_id') else None
+    archived = archive_expired_chat(
+        lobby_ids,
+        on_progress=lambda done, total: update_job_progress(job, done, total),
     )
-    if not instances:
-        return []
-    invalid_instances: list[ItemInstance] = []
-    for instance in instances:
-        container_id = instance.container_i or 'inv_main'
-        rotation = normalize_rotation_value(instance.rotated)
-        if not container_size(container_id):
-            invalid_instances.append(instance)
-            continue
-        allowed, _reason = is_container_allowed(instance, container_id, instance.owner_id)
-        if not allowed:
-            invalid_instances.append(instance)
-            continue
-        if instance.pos_x is None or instance.pos_y is None:
-            invalid_instances.append(instance)
-            continue
-        valid, _reason = can_place_item(instance, container_id, instance.pos_x, instance.pos_y, rotation)
-        if not valid:
-            invalid_instances.append(instance)
-            continue
+    return {'archived': {str(lobby_id): count for lobby_id, count in archived.items()}}
 
-    for instance in invalid_instances:
-        instance.pos_x = None
-        instance.pos_y = None
-    db.session.flush()
 
-    unplaced_ids: list[int] = []
-    for instance in invalid_instances:
-        placement = find_preferred_placement(
-            instance,
-            instance.owner_id,
-            prefer_container=instance.container_i,
-        )
-        if placement:
-            container_id, pos_x, pos_y, rotation = placement
-            instance.container_i = container_id
-            instance.pos_x = pos_x
-            instance.pos_y = pos_y
-            instance.rotated = rotation
-        else:
-            instance.container_i = 'inv_main'
-            instance.pos_x = None
-            instance.pos_y = None
-            unplaced_ids.append(instance.id)
-        instance.version += 1
-    return unplaced_ids
+@app.cli.command('archive-chat')
+@click.option('--lobby', 'lobby_id', type=int, default=None, help='Archive a single lobby.')
+def archive_chat_command(lobby_id: Optional[int]):
+    """Move chat older than each lobby's retention into the archive."""
+    archived = archive_expired_chat([lobby_id] if lobby_id else None)
+    for archived_lobby_id, count in archived.items():
+        click.echo(f'lobby {archived_lobby_id}: archived {count} messages')
 
 
 def log_weight_breakdown(instances: list[ItemInstance], reason: str) -> None:
@@ -2459,6 +5351,9 @@ def split_inventory_item():
         if inventory_logger.handlers:
             inventory_logger.info('Split rejected item_id=%s reason=%s', item_id, exc.reason)
         return jsonify({'ok': False, 'error': exc.reason}), exc.status
+    except StaleDataError:
+        # Let handle_stale_data_error answer 409 instead of the generic 500 below.
+        raise
     except SQLAlchemyError as exc:
         db.session.rollback()
         if inventory_logger.handlers:
@@ -2543,6 +5438,324 @@ def merge_inventory_items():
     })
 
 
+class InventoryBatchError(Exception):
+    def __init__(self, reason: str, status: int = 400):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+
+
+class InventoryBatch:
+    """Applies ordered inventory operations for one owner against a single in-memory layout."""
+
+    def __init__(self, layout: InventoryLayout) -> None:
+        self.layout = layout
+        self.initial_versions = {instance.id: instance.version for instance in layout.instances}
+        self.touched: dict[int, ItemInstance] = {}
+        self.deleted_ids: list[int] = []
+
+    def instance(self, instance_id: int, version: int) -> ItemInstance:
+        instance = self.layout.get(instance_id)
+        if not instance:
+            raise InventoryBatchError('not_found', 404)
+        if not _require_version(version):
+            raise InventoryBatchError('missing_version')
+        # Versions refer to the client's snapshot, so later operations on the same item reuse it.
+        if self.initial_versions.get(instance_id) != version:
+            raise InventoryBatchError('conflict', 409)
+        return instance
+
+    def touch(self, instance: ItemInstance) -> None:
+        if instance.id not in self.touched:
+            instance.version += 1
+            self.touched[instance.id] = instance
+
+    def move(self, operation: dict) -> None:
+        instance = self.instance(parse_int(operation.get('item_id'), 0), parse_int(operation.get('version'), 0))
+        container_id = (operation.get('container_id') or '').strip()
+        if not container_id:
+            raise InventoryBatchError('missing_container')
+        allowed, reason = self.layout.is_container_allowed(instance, container_id)
+        if not allowed:
+            raise InventoryBatchError(reason)
+        if instance.container_i in EQUIPMENT_GRIDS and container_id not in EQUIPMENT_GRIDS:
+            if any(other.container_i == f'bag:{instance.id}' for other in self.layout.instances):
+                raise InventoryBatchError('backpack_not_empty')
+        if instance.container_i == 'equip_belt' and container_id != 'equip_belt':
+            if any(other.container_i == f'fast:{instance.id}' for other in self.layout.instances):
+                raise InventoryBatchError('belt_not_empty')
+        rotation_value = normalize_rotation(instance.definition, operation.get('rotated'))
+        if rotation_value and not rotation_allowed(container_id):
+            raise InventoryBatchError('rotation_not_allowed')
+        pos_x = operation.get('pos_x')
+        pos_y = operation.get('pos_y')
+        if pos_x is not None and pos_y is not None:
+            target_pos = (parse_int(pos_x, 0), parse_int(pos_y, 0))
+            valid, reason = self.layout.can_place(instance, container_id, *target_pos, rotation_value)
+            if not valid:
+                raise InventoryBatchError(reason)
+        else:
+            target_pos = self.layout.find_first_fit(instance, container_id, rotation_value)
+            if not target_pos:
+                raise InventoryBatchError('no_space')
+        instance.container_i = container_id
+        instance.pos_x, instance.pos_y = target_pos
+        instance.rotated = rotation_value
+        self.touch(instance)
+
+    def rotate(self, operation: dict) -> None:
+        instance = self.instance(parse_int(operation.get('item_id'), 0), parse_int(operation.get('version'), 0))
+        if not rotation_allowed(instance.container_i):
+            raise InventoryBatchError('rotation_not_allowed')
+        if instance.pos_x is None or instance.pos_y is None:
+            raise InventoryBatchError('invalid_position')
+        new_rotation = 1 if normalize_rotation_value(instance.rotated) == 0 else 0
+        valid, _reason = self.layout.can_place(
+            instance,
+            instance.container_i,
+            instance.pos_x,
+            instance.pos_y,
+            new_rotation,
+        )
+        if not valid:
+            raise InventoryBatchError('invalid_rotation')
+        instance.rotated = new_rotation
+        self.touch(instance)
+
+    def split(self, operation: dict) -> None:
+        instance = self.instance(parse_int(operation.get('item_id'), 0), parse_int(operation.get('version'), 0))
+        if not stackable_type(instance.definition) or has_durability(instance.definition):
+            raise InventoryBatchError('not_stackable')
+        split_half = str(operation.get('split_half') or '').lower() in {'1', 'true', 'yes'}
+        current_amount = instance.amount
+        split_amount = current_amount // 2 if split_half else parse_int(operation.get('amount'), 0)
+        if split_amount <= 0 or split_amount >= current_amount:
+            raise InventoryBatchError('invalid_amount')
+        max_amount = normalized_max_amount(instance.definition)
+        if split_amount > max_amount or (current_amount - split_amount) > max_amount:
+            raise InventoryBatchError('max_stack_exceeded')
+        rotation_value = normalize_rotation_value(instance.rotated)
+        target_pos = self.layout.find_first_fit(
+            PlacementPreview(definition=instance.definition, owner_id=instance.owner_id),
+            instance.container_i,
+            rotation_value,
+        )
+        if not target_pos:
+            raise InventoryBatchError('no_space')
+        instance.amount = current_amount - split_amount
+        self.touch(instance)
+        new_instance = ItemInstance(
+            owner_id=instance.owner_id,
+            template_id=instance.template_id,
+            container_i=instance.container_i,
+            pos_x=target_pos[0],
+            pos_y=target_pos[1],
+            rotated=rotation_value,
+            str_current=instance.str_current,
+            amount=split_amount,
+            custom_name=instance.custom_name,
+            custom_description=instance.custom_description,
+            version=1,
+        )
+        db.session.add(new_instance)
+        db.session.flush()
+        self.layout.instances.append(new_instance)
+        self.touched[new_instance.id] = new_instance
+
+    def merge(self, operation: dict) -> None:
+        source = self.instance(
+            parse_int(operation.get('source_instance_id'), 0),
+            parse_int(operation.get('source_version'), 0),
+        )
+        target = self.instance(
+            parse_int(operation.get('target_instance_id'), 0),
+            parse_int(operation.get('target_version'), 0),
+        )
+        if source.id == target.id:
+            raise InventoryBatchError('invalid_target')
+        if source.template_id != target.template_id:
+            raise InventoryBatchError('template_mismatch')
+        if not stackable_type(source.definition):
+            raise InventoryBatchError('not_stackable')
+        max_amount = normalized_max_amount(source.definition)
+        total_amount = source.amount + target.amount
+        if source.amount > target.amount:
+            target.custom_name = source.custom_name
+        self.touch(target)
+        if total_amount <= max_amount:
+            target.amount = normalize_stack_amount(target.definition, total_amount)
+            self.layout.instances.remove(source)
+            self.touched.pop(source.id, None)
+            self.deleted_ids.append(source.id)
+            db.session.delete(source)
+        else:
+            target.amount = max_amount
+            source.amount = total_amount - max_amount
+            self.touch(source)
+
+    def apply(self, operation: dict) -> None:
+        handler = {
+            'move': self.move,
+            'rotate': self.rotate,
+            'split': self.split,
+            'merge': self.merge,
+        }.get(str(operation.get('op') or ''))
+        if not handler:
+            raise InventoryBatchError('invalid_operation')
+        handler(operation)
+
+
+@app.route('/api/inventory/batch', methods=['POST'])
+def inventory_batch():
+    user = require_user()
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'ok': False, 'error': 'missing_operations'}), 400
+    if len(operations) > INVENTORY_BATCH_LIMIT:
+        return jsonify({'ok': False, 'error': 'too_many_operations'}), 400
+    if not all(isinstance(operation, dict) for operation in operations):
+        return jsonify({'ok': False, 'error': 'invalid_operation'}), 400
+
+    first = operations[0]
+    anchor = ItemInstance.query.get(parse_int(first.get('item_id') or first.get('source_instance_id'), 0))
+    if not anchor:
+        return jsonify({'ok': False, 'error': 'not_found', 'failed_index': 0}), 404
+    owner_id = anchor.owner_id
+    lobby_id = current_lobby_id_for(user)
+    if not can_edit_inventory(user, owner_id, lobby_id):
+        return jsonify({'ok': False, 'error': 'forbidden'}), 403
+
+    batch = InventoryBatch(InventoryLayout.load(owner_id))
+    for index, operation in enumerate(operations):
+        try:
+            batch.apply(operation)
+        except InventoryBatchError as exc:
+            db.session.rollback()
+            if inventory_logger.handlers:
+                inventory_logger.error('Inventory batch rejected at %s: %s', index, exc.reason)
+            return jsonify({'ok': False, 'error': exc.reason, 'failed_index': index}), exc.status
+    db.session.commit()
+    return jsonify({
+        'ok': True,
+        'instances': [build_instance_payload(instance, user, lobby_id) for instance in batch.touched.values()],
+        'deleted_instance_ids': batch.deleted_ids,
+        'weight': build_weight_payload(owner_id, log_context='batch'),
+    })
+
+
+def merge_container_stacks(layout: InventoryLayout, container_id: str) -> tuple[list[ItemInstance], list[int]]:
+    """Fold stacks of the same item with identical custom fields into as few instances as possible."""
+    groups: dict[tuple, list[ItemInstance]] = {}
+    for instance in layout.instances:
+        if instance.container_i != container_id or not stackable_type(instance.definition):
+            continue
+        key = (instance.template_id, instance.custom_name, instance.custom_description, instance.str_current)
+        groups.setdefault(key, []).append(instance)
+    changed: list[ItemInstance] = []
+    deleted_ids: list[int] = []
+    for stacks in groups.values():
+        if len(stacks) < 2:
+            continue
+        max_amount = normalized_max_amount(stacks[0].definition)
+        stacks.sort(key=lambda instance: (-instance.amount, instance.id))
+        remaining = sum(instance.amount for instance in stacks)
+        for instance in stacks:
+            amount = min(remaining, max_amount)
+            remaining -= amount
+            if amount <= 0:
+                layout.instances.remove(instance)
+                deleted_ids.append(instance.id)
+                db.session.delete(instance)
+            elif amount != instance.amount:
+                instance.amount = amount
+                changed.append(instance)
+    return changed, deleted_ids
+
+
+def pack_container(layout: InventoryLayout, container_id: str) -> Optional[list[ItemInstance]]:
+    """Re-place a container's items largest-first; returns moved items, or None if they no longer fit."""
+    instances = [instance for instance in layout.instances if instance.container_i == container_id]
+    original = {instance.id: (instance.pos_x, instance.pos_y, instance.rotated) for instance in instances}
+    for instance in instances:
+        instance.pos_x = instance.pos_y = None
+    allow_rotation = rotation_allowed(container_id)
+    instances.sort(key=lambda instance: (
+        -(instance.definition.w * instance.definition.h),
+        -max(instance.definition.w, instance.definition.h),
+        instance.id,
+    ))
+    for instance in instances:
+        rotations = [0, 1] if allow_rotation else [0]
+        if allow_rotation and instance.definition.w < instance.definition.h:
+            # Lying long items flat keeps the free space in whole rows.
+            rotations.reverse()
+        placement = None
+        for rotation in rotations:
+            position = layout.find_first_fit(instance, container_id, rotation)
+            if position:
+                placement = (position[0], position[1], rotation)
+                break
+        if not placement:
+            for other in instances:
+                other.pos_x, other.pos_y, other.rotated = original[other.id]
+            return None
+        instance.pos_x, instance.pos_y, instance.rotated = placement
+    return [
+        instance
+        for instance in instances
+        if (instance.pos_x, instance.pos_y, instance.rotated) != original[instance.id]
+    ]
+
+
+def compactable_container_ids(layout: InventoryLayout) -> list[str]:
+    return [
+        container_id
+        for container_id in layout.preferred_container_ids()
+        if container_id in {'inv_main', 'hands'} or container_id.startswith(('bag:', 'fast:'))
+    ]
+
+
+@app.route('/api/inventory/<int:user_id>/compact', methods=['POST'])
+def compact_inventory(user_id: int):
+    user = require_user()
+    data = request.get_json(silent=True) or {}
+    container_id = (data.get('container_id') or '').strip()
+    lobby_id = current_lobby_id_for(user)
+    if not can_edit_inventory(user, user_id, lobby_id):
+        return jsonify({'ok': False, 'error': 'forbidden'}), 403
+
+    layout = InventoryLayout.load(user_id)
+    container_ids = compactable_container_ids(layout)
+    if container_id:
+        if container_id not in container_ids:
+            return jsonify({'ok': False, 'error': 'invalid_container'}), 400
+        container_ids = [container_id]
+
+    changed: dict[int, ItemInstance] = {}
+    deleted_ids: list[int] = []
+    skipped: list[str] = []
+    for target_container in container_ids:
+        merged, removed_ids = merge_container_stacks(layout, target_container)
+        deleted_ids.extend(removed_ids)
+        moved = pack_container(layout, target_container)
+        if moved is None:
+            skipped.append(target_container)
+            moved = []
+        for instance in merged + moved:
+            changed[instance.id] = instance
+    for instance in changed.values():
+        instance.version += 1
+    db.session.commit()
+    return jsonify({
+        'ok': True,
+        'instances': [build_instance_payload(instance, user, lobby_id) for instance in changed.values()],
+        'deleted_instance_ids': deleted_ids,
+        'skipped_containers': skipped,
+        'weight': build_weight_payload(user_id, log_context='compact'),
+    })
+
+
 @app.route('/api/inventory/use', methods=['POST'])
 def use_inventory_item():
     user = require_user()
@@ -2570,7 +5783,7 @@ def use_inventory_item():
 
     if item_type == 'food':
         if lobby_id:
-            create_chat_message(lobby_id, user.id, f'{user.nickname} used {item_display_name(instance)}', is_system=True)
+            queue_system_message(lobby_id, user.id, f'{user.nickname} used {item_display_name(instance)}')
         db.session.delete(instance)
         db.session.commit()
         return jsonify({
@@ -2587,11 +5800,10 @@ def use_inventory_item():
         instance.str_current = max((instance.str_current or 0) - roll, 0)
         instance.version += 1
         if lobby_id:
-            create_chat_message(
+            queue_system_message(
                 lobby_id,
                 user.id,
                 f'{user.nickname} used {item_display_name(instance)} and lost {roll} durability',
-                is_system=True,
             )
         db.session.commit()
         return jsonify({
@@ -2601,7 +5813,8 @@ def use_inventory_item():
         })
 
     if lobby_id:
-        create_chat_message(lobby_id, user.id, f'{user.nickname} used {item_display_name(instance)}', is_system=True)
+        queue_system_message(lobby_id, user.id, f'{user.nickname} used {item_display_name(instance)}')
+        db.session.commit()
     return jsonify({
         'ok': True,
         'map_image': instance.definition.image_path,
@@ -2842,11 +6055,10 @@ def drop_inventory_item():
     amount = instance.amount
     if is_master(user, lobby_id):
         if lobby_id:
-            create_chat_message(
+            queue_system_message(
                 lobby_id,
                 user.id,
                 f'{user.nickname} dropped {item_name} x{amount}',
-                is_system=True,
             )
         db.session.delete(instance)
         db.session.commit()
@@ -2856,26 +6068,38 @@ def drop_inventory_item():
     if not master_id:
         return jsonify({'ok': False, 'error': 'missing_master'}), 400
     target_container = 'inv_main'
-    temp_instance = PlacementPreview(
-        owner_id=master_id,
-        definition=instance.definition,
+    master_layout = InventoryLayout.load(master_id)
+    remaining, _topped_up = top_up_stacks(
+        master_layout,
+        instance.definition,
+        amount,
+        custom_name=instance.custom_name,
+        custom_description=instance.custom_description,
     )
-    auto_pos = auto_place_item(temp_instance, target_container, prefer_rotation=instance.rotated)
-    if not auto_pos:
-        if inventory_logger.handlers:
-            inventory_logger.error('Drop failed: no space in master inventory for item %s', instance.id)
-        return jsonify({'ok': False, 'error': 'no_space'}), 400
-    instance.owner_id = master_id
-    instance.container_i = target_container
-    instance.pos_x, instance.pos_y, rotation_value = auto_pos
-    instance.rotated = rotation_value
-    instance.version += 1
+    if remaining <= 0:
+        db.session.delete(instance)
+    else:
+        temp_instance = PlacementPreview(
+            owner_id=master_id,
+            definition=instance.definition,
+        )
+        auto_pos = master_layout.auto_place(temp_instance, target_container, prefer_rotation=instance.rotated)
+        if not auto_pos:
+            db.session.rollback()
+            if inventory_logger.handlers:
+                inventory_logger.error('Drop failed: no space in master inventory for item %s', item_id)
+            return jsonify({'ok': False, 'error': 'no_space'}), 400
+        instance.owner_id = master_id
+        instance.container_i = target_container
+        instance.pos_x, instance.pos_y, rotation_value = auto_pos
+        instance.rotated = rotation_value
+        instance.amount = remaining
+        instance.version += 1
     if lobby_id:
-        create_chat_message(
+        queue_system_message(
             lobby_id,
             user.id,
             f'{user.nickname} dropped {item_name} x{amount}',
-            is_system=True,
         )
     db.session.commit()
     return jsonify({'ok': True})
@@ -2939,17 +6163,33 @@ def transfer_inventory_item():
         log_debug('Transfer failed: amount %s exceeds max stack %s', amount, max_amount)
         return jsonify({'error': 'invalid_amount'}), 400
 
-    temp_instance = PlacementPreview(
-        owner_id=recipient_id,
-        definition=instance.definition,
+    item_name = item_display_name(instance)
+    recipient_layout = InventoryLayout.load(recipient_id)
+    remaining, _topped_up = top_up_stacks(
+        recipient_layout,
+        instance.definition,
+        amount,
+        custom_name=instance.custom_name,
+        custom_description=instance.custom_description,
     )
-    target_pos = auto_place_item(temp_instance, 'inv_main', prefer_rotation=instance.rotated)
-    if not target_pos:
-        log_debug('Transfer failed: no space for recipient %s', recipient_id)
-        return jsonify({'error': 'no_space'}), 400
+    target_pos = None
+    if remaining > 0:
+        temp_instance = PlacementPreview(
+            owner_id=recipient_id,
+            definition=instance.definition,
+        )
+        target_pos = recipient_layout.auto_place(temp_instance, 'inv_main', prefer_rotation=instance.rotated)
+        if not target_pos:
+            db.session.rollback()
+            log_debug('Transfer failed: no space for recipient %s', recipient_id)
+            return jsonify({'error': 'no_space'}), 400
 
-    item_name = item_display_name(instance)
-    if amount == instance.amount:
+    if remaining <= 0 and amount == instance.amount:
+        db.session.delete(instance)
+    elif remaining <= 0:
+        instance.amount = normalize_stack_amount(instance.definition, instance.amount - amount)
+    elif amount == instance.amount:
+        instance.amount = remaining
         instance.owner_id = recipient_id
         instance.container_i = 'inv_main'
         instance.pos_x, instance.pos_y, rotation_value = target_pos
@@ -2964,18 +6204,17 @@ def transfer_inventory_item():
             pos_y=target_pos[1],
             rotated=target_pos[2],
             str_current=instance.str_current,
-            amount=amount,
+            amount=remaining,
             custom_name=instance.custom_name,
             custom_description=instance.custom_description,
         )
         db.session.add(new_instance)
     instance.version += 1
     if lobby_id:
-        create_chat_message(
+        queue_system_message(
             lobby_id,
             user.id,
             f'{user.nickname} transferred {item_name} x{amount} to {recipient.nickname}',
-            is_system=True,
         )
     db.session.commit()
     return jsonify({'status': 'ok'})
@@ -3025,7 +6264,12 @@ def create_item_template():
             if inventory_logger.handlers:
                 inventory_logger.error('Item image upload failed: %s', error)
             return jsonify({'error': 'invalid_image'}), 400
-        image_path = save_upload(image_file, 'items', f'item_{secrets.token_hex(4)}')
+        try:
+            image_path = save_upload(image_file, 'items', MAX_ITEM_IMAGE_BYTES)
+        except UploadRejected as exc:
+            if inventory_logger.handlers:
+                inventory_logger.error('Item image upload failed: %s', exc)
+            return jsonify({'error': 'invalid_image'}), 400
         if not image_path:
             if inventory_logger.handlers:
                 inventory_logger.error('Item image upload failed: save error')
@@ -3080,50 +6324,217 @@ def create_item_template():
             log_debug('Item template issue failed: target user %s not in lobby %s', issue_to, lobby_id)
             db.session.rollback()
             return jsonify({'error': 'invalid_recipient'}), 400
-        stack_amounts = split_stack_amounts(definition, issue_amount)
-        created_instances = []
-        for stack_amount in stack_amounts:
-            temp_instance = PlacementPreview(
-                owner_id=issue_to,
-                definition=definition,
-            )
-            placement = find_preferred_placement(temp_instance, issue_to)
-            if not placement:
-                log_debug('Item template issue failed: no space for user %s', issue_to)
-                db.session.rollback()
-                return jsonify({'error': 'no_space'}), 400
-            resolved_durability = resolve_durability_value(
+        try:
+            created_instances, _topped_up = issue_item_stacks(
                 definition,
-                durability_current_value,
-                randomize=random_durability,
-            )
-            container_id, pos_x, pos_y, rotation = placement
-            new_instance = ItemInstance(
-                owner_id=issue_to,
-                template_id=definition.id,
-                container_i=container_id,
-                pos_x=pos_x,
-                pos_y=pos_y,
-                rotated=rotation,
-                str_current=resolved_durability,
-                amount=stack_amount,
+                issue_to,
+                issue_amount,
+                durability_value=durability_current_value,
+                randomize_durability=random_durability,
             )
-            db.session.add(new_instance)
-            db.session.flush()
-            created_instances.append(new_instance)
+        except ValueError:
+            log_debug('Item template issue failed: no space for user %s', issue_to)
+            db.session.rollback()
+            return jsonify({'error': 'no_space'}), 400
         if created_instances:
             issued_instance_id = created_instances[0].id
 
+    sync_template_fts(definition)
     try:
         db.session.commit()
+    except StaleDataError:
+        raise
     except SQLAlchemyError as exc:
         db.session.rollback()
         if inventory_logger.handlers:
             inventory_logger.error('Item template create failed: %s', exc)
         return jsonify({'error': 'db_error'}), 500
+    template_search_index.upsert(definition)
+    enqueue_image_variants(definition, user.id, lobby_id)
     return jsonify({'status': 'ok', 'template_id': definition.id, 'instance_id': issued_instance_id})
 
 
+TEMPLATE_SEARCH_LIMIT = 5
+TEMPLATE_SEARCH_MAX_LIMIT = 50
+TEMPLATE_INDEX_GRAM = 3
+TEMPLATE_INDEX_TTL_SECONDS = 60
+
+
+def template_match_score(query_lower: str, name_lower: str) -> float:
+    # For a substring match SequenceMatcher finds exactly one block of len(query),
+    # so ratio() reduces to this expression; autojunk only kicks in at 200+ chars.
+    if len(name_lower) >= 200:
+        score = difflib.SequenceMatcher(None, query_lower, name_lower).ratio()
+    else:
+        score = 2.0 * len(query_lower) / (len(query_lower) + len(name_lower))
+    if name_lower.startswith(query_lower):
+        score += 0.3
+    return score
+
+
+class TemplateSearchIndex:
+    """Trigram index over lowercased template names for substring search."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names: dict[int, str] = {}
+        self._filters: dict[int, tuple[Optional[str], Optional[str]]] = {}
+        self._grams: dict[str, set[int]] = {}
+        self._short_ids: set[int] = set()
+        self._loaded_at: Optional[float] = None
+
+    @staticmethod
+    def _grams_for(name_lower: str) -> set[str]:
+        return {
+            name_lower[index:index + TEMPLATE_INDEX_GRAM]
+            for index in range(len(name_lower) - TEMPLATE_INDEX_GRAM + 1)
+        }
+
+    def _add(self, template_id: int, name: str, type_name: Optional[str], quality: Optional[str]) -> None:
+        name_lower = (name or '').lower()
+        self._names[template_id] = name_lower
+        self._filters[template_id] = (type_name, quality)
+        grams = self._grams_for(name_lower)
+        if not grams:
+            self._short_ids.add(template_id)
+        for gram in grams:
+            self._grams.setdefault(gram, set()).add(template_id)
+
+    def _discard(self, template_id: int) -> None:
+        name_lower = self._names.pop(template_id, None)
+        if name_lower is None:
+            return
+        self._filters.pop(template_id, None)
+        self._short_ids.discard(template_id)
+        for gram in self._grams_for(name_lower):
+            postings = self._grams.get(gram)
+            if postings is None:
+                continue
+            postings.discard(template_id)
+            if not postings:
+                del self._grams[gram]
+
+    def rebuild(self) -> None:
+        rows = (
+            db.session.query(ItemDefinition.id, ItemDefinition.name, ItemType.name, ItemDefinition.quality)
+            .outerjoin(ItemType, ItemType.id == ItemDefinition.type_id)
+            .all()
+        )
+        with self._lock:
+            self._names = {}
+            self._filters = {}
+            self._grams = {}
+            self._short_ids = set()
+            for template_id, name, type_name, quality in rows:
+                self._add(template_id, name, type_name, quality)
+            self._loaded_at = time.monotonic()
+
+    def ensure_loaded(self) -> None:
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > TEMPLATE_INDEX_TTL_SECONDS:
+            self.rebuild()
+
+    def upsert(self, definition: ItemDefinition, *, previous_id: Optional[int] = None) -> None:
+        if self._loaded_at is None:
+            return
+        type_name = definition.item_type.name if definition.item_type else None
+        with self._lock:
+            if previous_id is not None:
+                self._discard(previous_id)
+            self._discard(definition.id)
+            self._add(definition.id, definition.name, type_name, definition.quality)
+
+    def remove(self, template_id: int) -> None:
+        if self._loaded_at is None:
+            return
+        with self._lock:
+            self._discard(template_id)
+
+    def _candidates(self, query_lower: str) -> set[int]:
+        if len(query_lower) >= TEMPLATE_INDEX_GRAM:
+            postings = [self._grams.get(gram, set()) for gram in self._grams_for(query_lower)]
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for other in postings[1:]:
+                candidates &= other
+                if not candidates:
+                    break
+            return candidates
+        candidates = set(self._short_ids)
+        for gram, postings in self._grams.items():
+            if query_lower in gram:
+                candidates |= postings
+        return candidates
+
+    def search(
+        self,
+        query_lower: str,
+        *,
+        type_name: Optional[str] = None,
+        quality: Optional[str] = None,
+        limit: int = TEMPLATE_SEARCH_LIMIT,
+    ) -> list[int]:
+        self.ensure_loaded()
+        with self._lock:
+            scored = []
+            for template_id in self._candidates(query_lower):
+                name_lower = self._names[template_id]
+                if query_lower not in name_lower:
+                    continue
+                candidate_type, candidate_quality = self._filters[template_id]
+                if type_name and candidate_type != type_name:
+                    continue
+                if quality and candidate_quality != quality:
+                    continue
+                scored.append((-template_match_score(query_lower, name_lower), name_lower, template_id))
+        return [template_id for _score, _name, template_id in heapq.nsmallest(limit, scored)]
+
+
+def template_search_backend() -> str:
+    if settings.template_search_backend == 'fts' and TEMPLATE_FTS_READY:
+        return 'fts'
+    return 'memory'
+
+
+def _template_fts_match(query_lower: str) -> str:
+    return 'name : "{}"'.format(query_lower.replace('"', '""'))
+
+
+def search_templates_fts(
+    query_lower: str,
+    *,
+    type_name: Optional[str] = None,
+    quality: Optional[str] = None,
+    limit: int = TEMPLATE_SEARCH_LIMIT,
+) -> list[int]:
+    # Same ranking as template_match_score, evaluated by SQLite over the FTS hits.
+    conditions = ['instr(f.name_lower, :query) > 0']
+    params = {'query': query_lower, 'query_length': len(query_lower), 'limit': limit}
+    if len(query_lower) >= TEMPLATE_INDEX_GRAM:
+        conditions.append('item_definition_fts MATCH :match')
+        params['match'] = _template_fts_match(query_lower)
+    if type_name:
+        conditions.append('t.name = :type_name')
+        params['type_name'] = type_name
+    if quality:
+        conditions.append('d.quality = :quality')
+        params['quality'] = quality
+    rows = db.session.execute(text(
+        'SELECT d.id FROM item_definition_fts AS f '
+        'JOIN item_definition AS d ON d.id = f.rowid '
+        'LEFT JOIN item_type AS t ON t.id = d.type_id '
+        f'WHERE {" AND ".join(conditions)} '
+        'ORDER BY '
+        '2.0 * :query_length / (:query_length + length(f.name_lower)) '
+        '+ CASE WHEN substr(f.name_lower, 1, :query_length) = :query THEN 0.3 ELSE 0 END DESC, '
+        'f.name_lower ASC, d.id ASC '
+        'LIMIT :limit'
+    ), params).all()
+    return [row[0] for row in rows]
+
+
+template_search_index = TemplateSearchIndex()
+
+
 @app.route('/api/master/item_template/search')
 def search_item_templates():
     user = require_user()
@@ -3133,20 +6544,19 @@ def search_item_templates():
     query = (request.args.get('q') or '').strip()
     if not query:
         return jsonify({'ok': True, 'results': []})
-    query_lower = query.lower()
-    definitions = ItemDefinition.query.all()
-    scored = []
-    for definition in definitions:
-        name = definition.name or ''
-        name_lower = name.lower()
-        if query_lower not in name_lower:
-            continue
-        score = difflib.SequenceMatcher(None, query_lower, name_lower).ratio()
-        if name_lower.startswith(query_lower):
-            score += 0.3
-        scored.append((score, name_lower, definition))
-    scored.sort(key=lambda entry: (-entry[0], entry[1]))
-    results = [definition for _score, _name, definition in scored[:5]]
+    type_name = (request.args.get('type') or '').strip().lower() or None
+    quality = (request.args.get('quality') or '').strip().lower() or None
+    limit = min(
+        parse_int(request.args.get('limit'), TEMPLATE_SEARCH_LIMIT, minimum=1),
+        TEMPLATE_SEARCH_MAX_LIMIT,
+    )
+    search = search_templates_fts if template_search_backend() == 'fts' else template_search_index.search
+    template_ids = search(query.lower(), type_name=type_name, quality=quality, limit=limit)
+    definitions = {
+        definition.id: definition
+        for definition in ItemDefinition.query.filter(ItemDefinition.id.in_(template_ids)).all()
+    } if template_ids else {}
+    results = [definitions[template_id] for template_id in template_ids if template_id in definitions]
     payload = []
     for definition in results:
         payload.append({
@@ -3218,6 +6628,7 @@ def update_item_template():
     bag_height = parse_int(data.get('bag_height'), 0, minimum=0)
     fast_w = parse_int(data.get('fast_w'), 0, minimum=0)
     fast_h = parse_int(data.get('fast_h'), 0, minimum=0)
+    repack_in_background = str(data.get('background') or '').strip().lower() in {'1', 'true', 'yes', 'on'}
 
     if not name:
         return jsonify({'error': 'missing_name'}), 400
@@ -3230,6 +6641,7 @@ def update_item_template():
 
     if new_id != template_id and ItemDefinition.query.get(new_id):
         return jsonify({'error': 'duplicate_id'}), 400
+    previous_geometry = definition_geometry(definition)
 
     item_type = get_or_create_item_type(type_name)
     if max_amount > 1:
@@ -3275,14 +6687,21 @@ def update_item_template():
             synchronize_session=False,
         )
 
-    unplaced_ids = repack_instances_for_definition(definition)
+    needs_repack = definition_geometry(definition) != previous_geometry
+    unplaced_ids = []
+    if needs_repack and not repack_in_background:
+        unplaced_ids = repack_instances_for_definition(definition)
+    sync_template_fts(definition, previous_id=old_id if old_id != definition.id else None)
     try:
         db.session.commit()
+    except StaleDataError:
+        raise
     except SQLAlchemyError as exc:
         db.session.rollback()
         if inventory_logger.handlers:
             inventory_logger.error('Item template update failed: %s', exc)
         return jsonify({'error': 'db_error'}), 500
+    template_search_index.upsert(definition, previous_id=old_id)
 
     payload = {
         'ok': True,
@@ -3290,13 +6709,36 @@ def update_item_template():
         'template_id': definition.id,
         'unplaced': unplaced_ids,
     }
+    if needs_repack and repack_in_background:
+        job = enqueue_job('repack_template', {'template_id': definition.id}, user_id=user.id, lobby_id=lobby_id)
+        payload['job'] = serialize_job(job)
     if unplaced_ids:
         payload['warning'] = 'unplaced_items'
     return jsonify(payload)
 
 
+@app.route('/api/master/jobs/<job_id>')
+def background_job_status(job_id: str):
+    user = require_user()
+    job = BackgroundJob.query.get(job_id)
+    if not job:
+        return jsonify({'error': 'not_found'}), 404
+    if job.user_id != user.id and not user.is_admin:
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify({'ok': True, 'job': serialize_job(job)})
+
+
+@app.route('/api/master/cleanup_starter_kit', methods=['POST'])
+def cleanup_starter_kit_api():
+    user = require_user()
+    if not user.is_admin:
+        return jsonify({'error': 'forbidden'}), 403
+    job = enqueue_job('cleanup_starter_kit', {}, user_id=user.id)
+    return jsonify({'ok': True, 'job': serialize_job(job)}), 202
+
+
 def _handle_give_by_id(lobby_id: int):
-    request_id = str(uuid4())
+    request_id = g.request_id
     try:
         user = require_user()
     except AuthError:
@@ -3307,6 +6749,7 @@ def _handle_give_by_id(lobby_id: int):
     target_user_id = parse_int(data.get('target_user_id') or data.get('to_user_id'), 0)
     amount = parse_int(data.get('amount'), 1, minimum=1)
     durability_raw = data.get('durability_current')
+    run_in_background = str(data.get('background') or '').strip().lower() in {'1', 'true', 'yes', 'on'}
     durability_current_value = None
     if durability_raw not in (None, ''):
         durability_current_value = parse_int(durability_raw, 0)
@@ -3400,46 +6843,37 @@ def _handle_give_by_id(lobby_id: int):
     candidate_containers = preferred_container_ids(target_user_id)
     emit_step(f'Target containers scanned: {candidate_containers}')
 
-    stack_amounts = split_stack_amounts(definition, amount)
+    if run_in_background:
+        job = enqueue_job(
+            'issue_items',
+            {
+                'definition_id': definition.id,
+                'target_user_id': target_user_id,
+                'amount': amount,
+                'durability_current': durability_current_value,
+            },
+            user_id=user.id,
+            lobby_id=lobby_id,
+        )
+        emit_step(f'GiveID queued req={request_id} job={job.id}')
+        return jsonify({'ok': True, 'request_id': request_id, 'job': serialize_job(job)}), 202
+
     created_instances: list[ItemInstance] = []
     try:
-        with db.session.begin():
-            for stack_amount in stack_amounts:
-                temp_instance = PlacementPreview(
-                    owner_id=target_user_id,
-                    definition=definition,
-                )
-                placement = find_preferred_placement(temp_instance, target_user_id)
-                if not placement:
-                    emit_step('GiveID failed: no_space')
-                    raise ValueError('no_space')
-                resolved_durability = resolve_durability_value(definition, durability_current_value)
-                container_id, pos_x, pos_y, rotation = placement
-                new_instance = ItemInstance(
-                    owner_id=target_user_id,
-                    template_id=definition.id,
-                    container_i=container_id,
-                    pos_x=pos_x,
-                    pos_y=pos_y,
-                    rotated=rotation,
-                    str_current=resolved_durability,
-                    amount=stack_amount,
-                )
-                db.session.add(new_instance)
-                db.session.flush()
-                created_instances.append(new_instance)
-                emit_step(
-                    'Placed instance {instance} in {container} at ({x},{y}) amt={amount}'.format(
-                        instance=new_instance.id,
-                        container=container_id,
-                        x=pos_x,
-                        y=pos_y,
-                        amount=stack_amount,
-                    )
-                )
+        created_instances, topped_up = issue_item_stacks(
+            definition,
+            target_user_id,
+            amount,
+            durability_value=durability_current_value,
+        )
+        db.session.commit()
     except ValueError:
         db.session.rollback()
+        emit_step('GiveID failed: no_space')
         return jsonify({'ok': False, 'request_id': request_id, 'error': 'no_space'})
+    except StaleDataError:
+        emit_step(f'GiveID failed: conflict req={request_id}')
+        raise
     except SQLAlchemyError:
         db.session.rollback()
         emit_step(f'GiveID failed: db_error req={request_id}')
@@ -3449,6 +6883,18 @@ def _handle_give_by_id(lobby_id: int):
         emit_step(f'GiveID failed: server_error req={request_id}')
         return jsonify({'ok': False, 'request_id': request_id, 'error': 'server_error'}), 500
 
+    for instance in created_instances:
+        emit_step(
+            'Placed instance {instance} in {container} at ({x},{y}) amt={amount}'.format(
+                instance=instance.id,
+                container=instance.container_i,
+                x=instance.pos_x,
+                y=instance.pos_y,
+                amount=instance.amount,
+            )
+        )
+    for instance in topped_up:
+        emit_step(f'Topped up instance {instance.id} to amt={instance.amount}')
     emit_step(f'GiveID success: created {len(created_instances)} instances')
     emit_step(
         f'Master issued {definition.name} x{amount} to {target_user.nickname}'
@@ -3456,16 +6902,8 @@ def _handle_give_by_id(lobby_id: int):
     return jsonify({
         'ok': True,
         'request_id': request_id,
-        'created': [
-            {
-                'instance_id': instance.id,
-                'amount': instance.amount,
-                'container_id': instance.container_i,
-                'pos_x': instance.pos_x,
-                'pos_y': instance.pos_y,
-            }
-            for instance in created_instances
-        ],
+        'created': serialize_issued_instances(created_instances),
+        'topped_up': serialize_issued_instances(topped_up),
     })
 
 
@@ -3479,7 +6917,7 @@ def issue_item_by_id():
     data = request.get_json(silent=True) or {}
     lobby_id = parse_int(data.get('lobby_id'), 0)
     if not lobby_id:
-        return jsonify({'ok': False, 'request_id': str(uuid4()), 'error': 'bad_request'}), 400
+        return jsonify({'ok': False, 'request_id': g.request_id, 'error': 'bad_request'}), 400
     return _handle_give_by_id(lobby_id)
 
 
@@ -3500,16 +6938,30 @@ def update_item_template_image(template_id: int):
         if inventory_logger.handlers:
             inventory_logger.error('Item image update failed: %s', error)
         return jsonify({'error': 'invalid_image'}), 400
-    image_path = save_upload(image_file, 'items', f'item_{secrets.token_hex(4)}')
+    try:
+        image_path = save_upload(image_file, 'items', MAX_ITEM_IMAGE_BYTES)
+    except UploadRejected as exc:
+        if inventory_logger.handlers:
+            inventory_logger.error('Item image update failed: %s', exc)
+        return jsonify({'error': 'invalid_image'}), 400
     if not image_path:
         if inventory_logger.handlers:
             inventory_logger.error('Item image update failed: save error')
         return jsonify({'error': 'invalid_image'}), 400
     definition.image_path = image_path
+    definition.image_variants = None
     db.session.commit()
+    enqueue_image_variants(definition, user.id, lobby_id)
+    schedule_upload_gc(user.id)
     return jsonify({'status': 'ok'})
 
 
+# Runs after every @job_handler above is registered, so requeued jobs find their handler.
+with app.app_context():
+    recover_interrupted_jobs()
+threading.Thread(target=_job_lease_loop, name='job-lease', daemon=True).start()
+
+
 if __name__ == '__main__':
     with app.app_context():
         cleanup_starter_kit()
@@ -121,6 +121,9 @@
             this.shopDetailDescription = this.shopOverlay?.querySelector('[data-shop-detail-description]');
             this.shopDetailQty = this.shopOverlay?.querySelector('[data-shop-detail-qty]');
             this.shopDetailDurability = this.shopOverlay?.querySelector('[data-shop-detail-durability]');
+            this.shopTakeActions = this.shopOverlay?.querySelector('[data-shop-take-actions]');
+            this.shopTakeAmount = this.shopOverlay?.querySelector('[data-shop-take-amount]');
+            this.shopTakeButton = this.shopOverlay?.querySelector('[data-shop-take]');
             this.shopPollInterval = 3000;
             this.shopPollTimer = null;
             this.shopActive = false;
@@ -285,6 +288,7 @@
                 if (event.target === this.shopOverlay) this.closeShopOverlay();
             });
             this.shopStopButton?.addEventListener('click', () => this.confirmShopStop());
+            this.shopTakeButton?.addEventListener('click', () => this.takeShopItem());
         }
 
         loadInitialState() {
@@ -456,6 +460,7 @@
 
         updateShopDetails(item) {
             if (!this.shopDetailImage || !this.shopDetailName || !this.shopDetailDescription) return;
+            this.updateShopTakeActions(item);
             if (!item) {
                 this.shopDetailImage.src = '/static/images/default_avatar.png';
                 this.shopDetailImage.alt = 'Item';
@@ -471,7 +476,7 @@
                 }
                 return;
             }
-            const imageUrl = this.resolveImageUrl(item.image_path);
+            const imageUrl = this.resolveItemImageUrl(item, this.shopDetailImage);
             this.shopDetailImage.src = imageUrl || '/static/images/default_avatar.png';
             this.shopDetailImage.alt = item.name || 'Item';
             this.shopDetailName.textContent = item.name || 'Item';
@@ -497,12 +502,51 @@
             }
         }
 
+        updateShopTakeActions(item) {
+            if (!this.shopTakeActions) return;
+            const canTake = Boolean(item) && String(item.owner_id) !== String(this.currentUserId);
+            this.shopTakeActions.classList.toggle('is-hidden', !canTake);
+            if (!this.shopTakeAmount) return;
+            const showAmount = canTake && item.stackable && item.amount > 1;
+            this.shopTakeAmount.classList.toggle('is-hidden', !showAmount);
+            if (showAmount) {
+                this.shopTakeAmount.max = String(Math.min(item.amount, item.max_stack || item.amount));
+            }
+        }
+
+        async takeShopItem() {
+            const item = this.shopItems.find((entry) => String(entry.id) === String(this.shopDetailItemId));
+            if (!item || !this.lobbyId) return;
+            const amount = item.stackable ? Math.max(parseInt(this.shopTakeAmount?.value || '1', 10) || 1, 1) : item.amount;
+            try {
+                const response = await fetch(`/api/lobby/${this.lobbyId}/shop/take`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ item_id: item.id, amount }),
+                });
+                const payload = await response.json().catch(() => ({}));
+                if (!response.ok) {
+                    console.debug('[Shop] Take failed', payload?.error);
+                }
+                const removedIds = payload?.delta?.shop?.removed_ids || [];
+                if (removedIds.some((id) => String(id) === String(this.shopDetailItemId))) {
+                    this.shopDetailItemId = null;
+                }
+                await this.refreshShopStatus();
+                if (response.ok && String(this.selectedPlayerId) === String(this.currentUserId)) {
+                    await this.refreshInventory(this.selectedPlayerId);
+                }
+            } catch (error) {
+                console.debug('[Shop] Take failed', error);
+            }
+        }
+
         async refreshInventory(playerId) {
             const targetId = playerId || this.selectedPlayerId;
             if (!targetId) return;
             const endpoint = this.lobbyId
-                ? `/api/lobby/${this.lobbyId}/inventory/${targetId}`
-                : `/api/inventory/${targetId}`;
+                ? `/api/lobby/${this.lobbyId}/inventory/${targetId}?compact=1`
+                : `/api/inventory/${targetId}?compact=1`;
             try {
                 const response = await fetch(endpoint);
                 if (!response.ok) {
@@ -530,9 +574,22 @@
             this.refreshInventory(playerId);
         }
 
+        expandItems(payload) {
+            const items = Array.isArray(payload.items) ? payload.items : [];
+            if (!payload.templates) return items;
+            return items.map((record) => {
+                const template = payload.templates[String(record.template_id)] || {};
+                return {
+                    ...template,
+                    ...record,
+                    name: record.custom_name || template.base_name,
+                };
+            });
+        }
+
         applyInventory(payload) {
             if (!payload) return;
-            this.items = Array.isArray(payload.items) ? payload.items : [];
+            this.items = this.expandItems(payload);
             this.permissions = payload.permissions || { can_edit: false, is_master: false };
             this.containers = new Map();
             (payload.containers || []).forEach((container) => {
@@ -1547,6 +1604,16 @@
             return `/static/${normalized}`;
         }
 
+        resolveItemImageUrl(item, imageElement) {
+            const variants = item.image_variants || {};
+            const sizes = Object.keys(variants).map(Number).sort((a, b) => a - b);
+            if (!sizes.length) return this.resolveImageUrl(item.image_path);
+            const rect = imageElement?.getBoundingClientRect();
+            const wanted = Math.max(rect?.width || 0, rect?.height || 0, 1) * (window.devicePixelRatio || 1);
+            const size = sizes.find((candidate) => candidate >= wanted) || sizes[sizes.length - 1];
+            return this.resolveImageUrl(variants[String(size)]);
+        }
+
         openMapOverlay(path) {
             if (!this.mapOverlay || !this.mapImage) return;
             const imageUrl = this.resolveImageUrl(path);
@@ -1573,7 +1640,7 @@
                 }
                 return;
             }
-            const imageUrl = this.resolveImageUrl(item.image_path);
+            const imageUrl = this.resolveItemImageUrl(item, this.detailImage);
             this.detailImage.src = imageUrl || '/static/images/default_avatar.png';
             this.detailImage.alt = item.name || 'Item';
             this.detailName.textContent = item.name || 'Item';
@@ -2243,8 +2310,8 @@
                     await controller.refreshInventory(targetId);
                     return;
                 }
-                const payload = await response.json().catch(() => ({}));
-                controller.showIssueByIdError(payload, form);
+                const errorPayload = await response.json().catch(() => ({}));
+                controller.showIssueByIdError(errorPayload, form);
                 await controller.refreshInventory(targetId);
             };
             button?.addEventListener('click', submitIssue);
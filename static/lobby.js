@@ -70,6 +70,9 @@
             this.input = root.querySelector('[data-chat-input]');
             this.sendButton = root.querySelector('[data-chat-send]');
             this.latestId = 0;
+            this.oldestId = 0;
+            this.hasOlder = false;
+            this.loadingOlder = false;
             this.pollInterval = 5000;
             this.pollTimer = null;
             this.bind();
@@ -86,6 +89,11 @@
                 event.preventDefault();
                 this.submitMessage();
             });
+            this.messages?.addEventListener('scroll', () => {
+                if (this.messages.scrollTop <= 24) {
+                    this.loadOlder();
+                }
+            });
         }
 
         startPolling() {
@@ -102,15 +110,45 @@
                 if (!newMessages.length) return;
                 if (this.latestId === 0) {
                     this.messages.innerHTML = '';
+                    this.oldestId = data.oldest_id || 0;
+                    this.hasOlder = Boolean(data.has_more);
                 }
+                const initialLoad = this.latestId === 0;
                 newMessages.forEach((message) => this.appendMessage(message));
                 this.latestId = data.latest_id || this.latestId;
                 this.scrollToBottom();
+                if (!initialLoad && data.has_more) {
+                    this.refresh();
+                }
             } catch (error) {
                 console.debug('Chat refresh failed', error);
             }
         }
 
+        async loadOlder() {
+            if (!this.lobbyId || !this.messages || !this.hasOlder || this.loadingOlder || !this.oldestId) return;
+            this.loadingOlder = true;
+            try {
+                const response = await fetch(`/api/lobby/${this.lobbyId}/chat?before_id=${this.oldestId}`);
+                if (!response.ok) return;
+                const data = await response.json().catch(() => ({}));
+                const olderMessages = Array.isArray(data.messages) ? data.messages : [];
+                this.hasOlder = Boolean(data.has_more);
+                if (!olderMessages.length) return;
+                const previousHeight = this.messages.scrollHeight;
+                const anchor = this.messages.firstChild;
+                olderMessages.forEach((message) => {
+                    this.messages.insertBefore(this.buildMessage(message), anchor);
+                });
+                this.oldestId = data.oldest_id || this.oldestId;
+                this.messages.scrollTop += this.messages.scrollHeight - previousHeight;
+            } catch (error) {
+                console.debug('Chat history load failed', error);
+            } finally {
+                this.loadingOlder = false;
+            }
+        }
+
         async submitMessage() {
             if (!this.lobbyId || !this.input) return;
             const text = this.input.value.trim();
@@ -139,6 +177,10 @@
 
         appendMessage(message) {
             if (!this.messages) return;
+            this.messages.appendChild(this.buildMessage(message));
+        }
+
+        buildMessage(message) {
             const wrapper = document.createElement('div');
             wrapper.className = 'lobby-chat__message';
             if (message.is_system) {
@@ -154,7 +196,7 @@
                 </div>
                 <p class="lobby-chat__text">${message.message}</p>
             `;
-            this.messages.appendChild(wrapper);
+            return wrapper;
         }
 
         scrollToBottom() {
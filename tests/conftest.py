@@ -0,0 +1,102 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix='dra-tests-')
+DB_PATH = os.path.join(DATA_DIR, 'databaseDRA.db')
+
+# The app initializes the schema at import time, but only when the SQLite file already exists.
+os.environ['DRA_DB_PATH'] = DB_PATH
+open(DB_PATH, 'a').close()
+sys.path.insert(0, ROOT)
+
+import app as dra  # noqa: E402
+
+dra.app.config['TESTING'] = True
+
+
+@pytest.fixture(autouse=True)
+def clean_db():
+    yield
+    with dra.app.app_context():
+        dra.db.session.remove()
+        for table in reversed(dra.db.metadata.sorted_tables):
+            if table.name != 'attribute_formula':
+                dra.db.session.execute(table.delete())
+        dra.db.session.commit()
+    dra._state_backend = None
+
+
+@pytest.fixture
+def client_for():
+    def make(user_id: int):
+        client = dra.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+        return client
+    return make
+
+
+@pytest.fixture
+def add_stack():
+    def make(owner_id, template_id, amount, container_id='inv_main', pos_x=1, pos_y=1):
+        with dra.app.app_context():
+            instance = dra.ItemInstance(
+                owner_id=owner_id,
+                template_id=template_id,
+                container_i=container_id,
+                pos_x=pos_x,
+                pos_y=pos_y,
+                amount=amount,
+            )
+            dra.db.session.add(instance)
+            dra.db.session.commit()
+            return instance.id
+    return make
+
+
+@pytest.fixture
+def stack_amounts():
+    def read(owner_id, template_id):
+        with dra.app.app_context():
+            return {
+                instance.id: instance.amount
+                for instance in dra.ItemInstance.query.filter_by(owner_id=owner_id, template_id=template_id)
+            }
+    return read
+
+
+@pytest.fixture
+def lobby():
+    """A lobby with an admin master and two players; returns the ids."""
+    with dra.app.app_context():
+        master = dra.User(email='master@example.com', nickname='master', password='p', is_admin=True)
+        alice = dra.User(email='alice@example.com', nickname='alice', password='p')
+        bob = dra.User(email='bob@example.com', nickname='bob', password='p')
+        dra.db.session.add_all([master, alice, bob])
+        dra.db.session.flush()
+        room = dra.Lobby(name='L', access_key='ABC', admin_id=master.id)
+        dra.db.session.add(room)
+        dra.db.session.flush()
+        dra.db.session.add_all([
+            dra.LobbyMember(lobby_id=room.id, user_id=master.id, role='master'),
+            dra.LobbyMember(lobby_id=room.id, user_id=alice.id, role='player'),
+            dra.LobbyMember(lobby_id=room.id, user_id=bob.id, role='player'),
+        ])
+        dra.db.session.commit()
+        return {'lobby': room.id, 'master': master.id, 'alice': alice.id, 'bob': bob.id}
+
+
+@pytest.fixture
+def coin_template(lobby, client_for):
+    response = client_for(lobby['master']).post('/api/master/item_template/create', json={
+        'lobby_id': lobby['lobby'],
+        'name': 'Coin',
+        'type': 'ammo',
+        'max_amount': 20,
+    })
+    assert response.status_code == 200, response.json
+    return response.json['template_id']
@@ -0,0 +1,148 @@
+import gzip
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+import app as dra
+
+OLD = datetime.utcnow() - timedelta(days=10)
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(dra, 'CHAT_ARCHIVE_DIR', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def old_chat(lobby):
+    with dra.app.app_context():
+        dra.db.session.get(dra.Lobby, lobby['lobby']).chat_retention_days = 1
+        dra.db.session.add_all([
+            dra.ChatMessage(lobby_id=lobby['lobby'], user_id=lobby['alice'], message=f'old {index}', created_at=OLD)
+            for index in range(50)
+        ])
+        dra.db.session.commit()
+    return lobby['lobby']
+
+
+def archived_lines(lobby_id):
+    with dra.app.app_context():
+        return [
+            line
+            for path in dra.chat_archive_segments(lobby_id)
+            for line in gzip.decompress(open(path, 'rb').read()).decode('utf-8').splitlines()
+        ]
+
+
+def archive(lobby_id):
+    with dra.app.app_context():
+        try:
+            return dra.archive_lobby_chat(dra.db.session.get(dra.Lobby, lobby_id))
+        finally:
+            dra.db.session.remove()
+
+
+def hot_rows(lobby_id):
+    with dra.app.app_context():
+        return dra.ChatMessage.query.filter_by(lobby_id=lobby_id).count()
+
+
+def wait_until_finished(job_id, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with dra.app.app_context():
+            if dra.db.session.get(dra.BackgroundJob, job_id).status in {'completed', 'failed'}:
+                return
+        time.sleep(0.05)
+
+
+def active_archive_job(job_id, lobby_id):
+    return dra.BackgroundJob(
+        id=job_id,
+        kind='archive_chat',
+        status='running',
+        payload='{}',
+        lobby_id=lobby_id,
+        worker_token=dra.WORKER_BOOT_TOKEN,
+        heartbeat_at=datetime.utcnow(),
+    )
+
+
+def test_enqueue_reuses_pending_archive_job(lobby):
+    with dra.app.app_context():
+        dra.db.session.add(active_archive_job('pending-archive', lobby['lobby']))
+        dra.db.session.commit()
+
+        assert dra.enqueue_chat_archive(lobby['lobby']).id == 'pending-archive'
+        everything = dra.enqueue_chat_archive()
+        assert everything.id != 'pending-archive'
+        # The pass over every lobby now covers each single lobby as well.
+        assert dra.enqueue_chat_archive(lobby['lobby'] + 1).id == everything.id
+        everything_id = everything.id
+    wait_until_finished(everything_id)
+
+
+def test_database_allows_one_unfinished_archive_per_lobby(lobby):
+    with dra.app.app_context():
+        dra.db.session.add(active_archive_job('first', lobby['lobby']))
+        dra.db.session.commit()
+        dra.db.session.add(active_archive_job('second', lobby['lobby']))
+        with pytest.raises(IntegrityError):
+            dra.db.session.commit()
+        dra.db.session.rollback()
+
+
+def test_concurrent_archive_passes_write_each_line_once(old_chat, archive_dir):
+    threads = [threading.Thread(target=archive, args=(old_chat,)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert hot_rows(old_chat) == 0
+    assert len(archived_lines(old_chat)) == 50
+    assert not [name for name in os.listdir(archive_dir / str(old_chat)) if name.endswith('.part')]
+
+
+def test_retry_after_failed_commit_does_not_duplicate(old_chat, archive_dir, monkeypatch):
+    commit = dra.db.session.commit
+    calls = []
+
+    def locked_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OperationalError('COMMIT', {}, Exception('database is locked'))
+        commit()
+
+    monkeypatch.setattr(dra.db.session, 'commit', locked_once)
+    with pytest.raises(OperationalError):
+        archive(old_chat)
+    assert archived_lines(old_chat) == []
+
+    assert archive(old_chat) == 50
+    assert len(archived_lines(old_chat)) == 50
+
+
+def test_recovery_promotes_only_batches_whose_rows_are_gone(old_chat, archive_dir):
+    with dra.app.app_context():
+        rows = dra.ChatMessage.query.filter_by(lobby_id=old_chat).order_by(dra.ChatMessage.id).all()
+        deleted = [(row.id, f'{row.message}\n') for row in rows[:10]]
+        kept = [(row.id, f'{row.message}\n') for row in rows[10:20]]
+        dra.ChatMessage.query.filter(dra.ChatMessage.id.in_([row_id for row_id, _line in deleted])).delete()
+        dra.db.session.commit()
+        finished = dra._write_pending_segment(old_chat, '2020-01-01', deleted)
+        unfinished = dra._write_pending_segment(old_chat, '2020-01-02', kept)
+    past = time.time() - dra.CHAT_ARCHIVE_PENDING_GRACE_SECONDS * 2
+    for path in (finished, unfinished):
+        os.utime(path, (past, past))
+
+    with dra.app.app_context():
+        dra._recover_pending_segments(old_chat)
+
+    assert not os.path.exists(finished) and not os.path.exists(unfinished)
+    assert archived_lines(old_chat) == [line.strip() for _row_id, line in deleted]
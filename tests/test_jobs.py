@@ -0,0 +1,82 @@
+import time
+from datetime import datetime, timedelta
+
+import app as dra
+
+EXPIRED = datetime.utcnow() - timedelta(seconds=dra.JOB_LEASE_SECONDS * 2)
+
+
+def add_job(job_id, status, kind='cleanup_starter_kit', token='old-boot', heartbeat_at=EXPIRED):
+    with dra.app.app_context():
+        dra.db.session.add(dra.BackgroundJob(
+            id=job_id,
+            kind=kind,
+            status=status,
+            payload='{}',
+            worker_pid=dra.os.getpid(),
+            worker_token=token,
+            heartbeat_at=heartbeat_at,
+        ))
+        dra.db.session.commit()
+
+
+def job(job_id):
+    with dra.app.app_context():
+        found = dra.db.session.get(dra.BackgroundJob, job_id)
+        dra.db.session.expunge(found)
+        return found
+
+
+def wait_for(job_id, status, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while job(job_id).status != status and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return job(job_id).status
+
+
+def test_recovery_takes_over_jobs_with_expired_lease():
+    # Same PID as this process, as after a container restart, but a different boot token.
+    add_job('running-old', 'running')
+    add_job('queued-old', 'queued')
+    add_job('queued-unknown', 'queued', kind='no_such_job')
+    add_job('queued-current', 'queued', token=dra.WORKER_BOOT_TOKEN)
+
+    with dra.app.app_context():
+        assert dra.recover_interrupted_jobs() == (1, 2)
+
+    assert job('running-old').status == 'failed'
+    assert job('queued-unknown').status == 'failed'
+    assert job('queued-current').status == 'queued'
+    assert job('queued-old').worker_token == dra.WORKER_BOOT_TOKEN
+    assert wait_for('queued-old', 'completed') == 'completed'
+
+
+def test_recovery_leaves_live_sibling_jobs_alone():
+    fresh = datetime.utcnow()
+    add_job('sibling-running', 'running', token='sibling', heartbeat_at=fresh)
+    add_job('sibling-queued', 'queued', token='sibling', heartbeat_at=fresh)
+
+    with dra.app.app_context():
+        assert dra.recover_interrupted_jobs() == (0, 0)
+
+    assert (job('sibling-running').status, job('sibling-running').worker_token) == ('running', 'sibling')
+    assert (job('sibling-queued').status, job('sibling-queued').worker_token) == ('queued', 'sibling')
+
+
+def test_run_skips_job_claimed_by_another_worker():
+    add_job('claimed', 'queued', token='sibling', heartbeat_at=datetime.utcnow())
+
+    dra._run_job('claimed')
+
+    assert (job('claimed').status, job('claimed').attempts) == ('queued', 0)
+
+
+def test_renew_extends_only_own_leases():
+    add_job('mine', 'running', token=dra.WORKER_BOOT_TOKEN)
+    add_job('theirs', 'running', token='sibling')
+
+    with dra.app.app_context():
+        assert dra.renew_job_leases() == 1
+
+    assert job('mine').heartbeat_at > EXPIRED
+    assert job('theirs').heartbeat_at == EXPIRED
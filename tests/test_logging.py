@@ -0,0 +1,38 @@
+import io
+import json
+import logging
+import uuid
+
+import app as dra
+
+
+def test_queued_json_records_keep_exception():
+    logger = logging.getLogger('dra.test.queued')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    stream = io.StringIO()
+    dra._attach_queued_handler(logger, logging.StreamHandler(stream))
+    listener = dra._log_listeners.pop()
+    try:
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception('Split failed item_id=%s', 7, extra={'item_id': 7})
+    finally:
+        listener.stop()
+        logger.handlers.clear()
+
+    payload = json.loads(stream.getvalue())
+    assert payload['message'] == 'Split failed item_id=7'
+    assert payload['item_id'] == 7
+    assert 'ZeroDivisionError' in payload['exc_info']
+
+
+def test_request_id_is_echoed_only_when_safe():
+    client = dra.app.test_client()
+
+    assert client.get('/api/debug/db', headers={'X-Request-ID': 'abc-123.x'}).headers['X-Request-ID'] == 'abc-123.x'
+    for unsafe in ('a' * 65, 'id with spaces', '"}{"level":"ERROR'):
+        echoed = client.get('/api/debug/db', headers={'X-Request-ID': unsafe}).headers['X-Request-ID']
+        assert echoed != unsafe
+        uuid.UUID(echoed)
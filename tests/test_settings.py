@@ -0,0 +1,45 @@
+import os
+import signal
+import time
+
+import pytest
+
+import app as dra
+
+
+@pytest.fixture
+def restore_settings(monkeypatch, tmp_path):
+    monkeypatch.setattr(dra.app, 'root_path', str(tmp_path))
+    yield
+    monkeypatch.undo()
+    dra.reload_settings()
+
+
+def test_disabling_inventory_log_releases_listener_and_file(monkeypatch, restore_settings):
+    monkeypatch.setenv(dra.INVENTORY_DEBUG_ENV, '1')
+    dra.reload_settings()
+    assert dra.inventory_logger.handlers
+    listener = dra._log_listeners[-1]
+    file_handler = listener.handlers[0]
+    thread = listener._thread
+
+    monkeypatch.delenv(dra.INVENTORY_DEBUG_ENV)
+    dra.reload_settings()
+
+    assert not dra.inventory_logger.handlers
+    assert listener not in dra._log_listeners
+    assert not thread.is_alive()
+    assert file_handler.stream is None
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGHUP'), reason='no SIGHUP on this platform')
+def test_sighup_reloads_settings(monkeypatch, restore_settings):
+    assert signal.getsignal(signal.SIGHUP) is dra._reload_settings_on_signal
+    monkeypatch.setenv(dra.METRICS_TOKEN_ENV, 'reloaded')
+
+    os.kill(os.getpid(), signal.SIGHUP)
+    deadline = time.monotonic() + 5
+    while dra.settings.metrics_token != 'reloaded' and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert dra.settings.metrics_token == 'reloaded'
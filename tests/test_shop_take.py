@@ -0,0 +1,80 @@
+import app as dra
+
+
+def test_take_smaller_stock_tops_up_without_empty_stack(lobby, coin_template, client_for, add_stack, stack_amounts):
+    shop_item = add_stack(lobby['master'], coin_template, 3)
+    own_stack = add_stack(lobby['alice'], coin_template, 15)
+    master = client_for(lobby['master'])
+    assert master.post(f"/api/lobby/{lobby['lobby']}/shop/start", json={'container_id': 'inv_main'}).status_code == 200
+
+    response = client_for(lobby['alice']).post(
+        f"/api/lobby/{lobby['lobby']}/shop/take",
+        json={'item_id': shop_item, 'amount': 10},
+    )
+
+    assert response.status_code == 200, response.json
+    assert response.json['taken'] == 3
+    assert response.json['delta']['shop'] == {'removed_ids': [shop_item]}
+    assert response.json['delta']['inventory']['added'] == []
+    assert [item['id'] for item in response.json['delta']['inventory']['updated']] == [own_stack]
+    assert stack_amounts(lobby['alice'], coin_template) == {own_stack: 18}
+    assert stack_amounts(lobby['master'], coin_template) == {}
+
+
+def test_take_places_remainder_after_top_up(lobby, coin_template, client_for, add_stack, stack_amounts):
+    shop_item = add_stack(lobby['master'], coin_template, 10)
+    own_stack = add_stack(lobby['alice'], coin_template, 15)
+    client_for(lobby['master']).post(f"/api/lobby/{lobby['lobby']}/shop/start", json={'container_id': 'inv_main'})
+
+    response = client_for(lobby['alice']).post(
+        f"/api/lobby/{lobby['lobby']}/shop/take",
+        json={'item_id': shop_item, 'amount': 8},
+    )
+
+    assert response.status_code == 200, response.json
+    added = response.json['delta']['inventory']['added']
+    assert [item['amount'] for item in added] == [3]
+    amounts = stack_amounts(lobby['alice'], coin_template)
+    assert amounts[own_stack] == 20
+    assert sorted(amounts.values()) == [3, 20]
+    assert stack_amounts(lobby['master'], coin_template) == {shop_item: 2}
+
+
+def test_issue_does_not_top_up_open_shop_stack(lobby, coin_template, client_for, add_stack, stack_amounts):
+    shop_item = add_stack(lobby['master'], coin_template, 5)
+    master = client_for(lobby['master'])
+    master.post(f"/api/lobby/{lobby['lobby']}/shop/start", json={'container_id': 'inv_main'})
+
+    response = master.post('/api/master/issue_by_id', json={
+        'lobby_id': lobby['lobby'],
+        'target_user_id': lobby['master'],
+        'template_id': coin_template,
+        'amount': 4,
+    })
+
+    assert response.status_code == 200, response.json
+    amounts = stack_amounts(lobby['master'], coin_template)
+    assert amounts[shop_item] == 5
+    assert sorted(amounts.values()) == [4, 5]
+
+
+def test_spectator_cannot_take(lobby, coin_template, client_for, add_stack, stack_amounts):
+    with dra.app.app_context():
+        spectator = dra.User(email='carol@example.com', nickname='carol', password='p')
+        dra.db.session.add(spectator)
+        dra.db.session.flush()
+        dra.db.session.add(dra.LobbyMember(lobby_id=lobby['lobby'], user_id=spectator.id, role='spectator'))
+        dra.db.session.commit()
+        spectator_id = spectator.id
+    shop_item = add_stack(lobby['master'], coin_template, 5)
+    client_for(lobby['master']).post(f"/api/lobby/{lobby['lobby']}/shop/start", json={'container_id': 'inv_main'})
+
+    response = client_for(spectator_id).post(
+        f"/api/lobby/{lobby['lobby']}/shop/take",
+        json={'item_id': shop_item, 'amount': 2},
+    )
+
+    assert response.status_code == 403
+    assert response.json == {'ok': False, 'error': 'forbidden'}
+    assert stack_amounts(lobby['master'], coin_template) == {shop_item: 5}
+    assert stack_amounts(spectator_id, coin_template) == {}
@@ -0,0 +1,64 @@
+import app as dra
+
+
+class RecordingBackend(dra.MemoryStateBackend):
+    def __init__(self, fail=False):
+        super().__init__()
+        self.fail = fail
+        self.bulk_calls = []
+
+    def incr(self, namespace, key):
+        raise AssertionError('revisions must be bumped in bulk')
+
+    def incr_many(self, namespace, keys):
+        self.bulk_calls.append((namespace, list(keys)))
+        if self.fail:
+            raise ConnectionError('state server is down')
+        return super().incr_many(namespace, keys)
+
+
+def test_incr_many_bumps_every_key():
+    with dra.app.app_context():
+        for backend in (dra.MemoryStateBackend(), dra.SqliteStateBackend()):
+            backend.incr('revisions', 'a')
+            assert backend.incr_many('revisions', ['a', 'b']) == {'a': 2, 'b': 1}
+            assert backend.get('revisions', 'a') == '2'
+            assert backend.get('revisions', 'b') == '1'
+
+
+def test_commit_bumps_touched_revisions_in_one_call(lobby, coin_template, client_for, add_stack):
+    backend = RecordingBackend()
+    dra._state_backend = backend
+    shop_item = add_stack(lobby['master'], coin_template, 5)
+    add_stack(lobby['alice'], coin_template, 1)
+    client_for(lobby['master']).post(f"/api/lobby/{lobby['lobby']}/shop/start", json={'container_id': 'inv_main'})
+    backend.bulk_calls.clear()
+
+    response = client_for(lobby['alice']).post(
+        f"/api/lobby/{lobby['lobby']}/shop/take",
+        json={'item_id': shop_item, 'amount': 2},
+    )
+
+    assert response.status_code == 200, response.json
+    assert len(backend.bulk_calls) == 1
+    namespace, keys = backend.bulk_calls[0]
+    assert namespace == 'revisions'
+    assert dra.container_revision_key(lobby['master'], 'inv_main') in keys
+    assert dra.container_revision_key(lobby['alice'], 'inv_main') in keys
+
+
+def test_backend_outage_does_not_fail_committed_write(lobby, coin_template, client_for, add_stack, stack_amounts):
+    backend = RecordingBackend()
+    dra._state_backend = backend
+    shop_item = add_stack(lobby['master'], coin_template, 5)
+    client_for(lobby['master']).post(f"/api/lobby/{lobby['lobby']}/shop/start", json={'container_id': 'inv_main'})
+    backend.fail = True
+
+    response = client_for(lobby['alice']).post(
+        f"/api/lobby/{lobby['lobby']}/shop/take",
+        json={'item_id': shop_item, 'amount': 2},
+    )
+
+    assert response.status_code == 200, response.json
+    assert stack_amounts(lobby['master'], coin_template) == {shop_item: 3}
+    assert sum(stack_amounts(lobby['alice'], coin_template).values()) == 2
@@ -0,0 +1,55 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import app as dra
+
+
+class ManualBuffer(dra.SystemChatBuffer):
+    """Buffer without the background flusher, so the test decides when flushes happen."""
+
+    def _run(self) -> None:
+        pass
+
+
+def events(lobby_id, count):
+    return [dra.PendingChatEvent(lobby_id, 1, f'line {index}') for index in range(count)]
+
+
+@pytest.fixture
+def failing_inserts(monkeypatch):
+    def fail(*args, **kwargs):
+        raise OperationalError('INSERT', {}, Exception('disk I/O error'))
+    monkeypatch.setattr(dra.db.session, 'execute', fail)
+
+
+def test_push_drops_oldest_when_full():
+    buffer = ManualBuffer(max_events=3)
+    buffer.push(events(1, 5))
+
+    assert [item.message for item in buffer._events] == ['line 2', 'line 3', 'line 4']
+    assert buffer.dropped == 2
+
+
+def test_failed_flush_retries_then_gives_up(failing_inserts):
+    buffer = ManualBuffer(max_events=10, max_attempts=2)
+    buffer.push(events(1, 2))
+
+    with dra.app.app_context():
+        assert buffer.flush() == 0
+        assert [item.attempts for item in buffer._events] == [1, 1]
+        buffer.push(events(1, 1))
+        assert buffer.flush() == 0
+
+    # The first two lines hit the cap; the newer one keeps its place for another try.
+    assert buffer.dead_lettered == 2
+    assert [(item.message, item.attempts) for item in buffer._events] == [('line 0', 1)]
+
+
+def test_requeue_keeps_bound():
+    buffer = ManualBuffer(max_events=3, max_attempts=5)
+    failed = events(1, 2)
+    buffer.push(events(2, 3))
+    buffer._requeue(failed)
+
+    assert len(buffer._events) == 3
+    assert buffer.dropped == 2
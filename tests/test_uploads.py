@@ -0,0 +1,102 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import app as dra
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64
+OTHER_PNG = b'\x89PNG\r\n\x1a\n' + b'\x01' * 64
+
+
+@pytest.fixture(autouse=True)
+def upload_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(dra.app, 'static_folder', str(tmp_path))
+    return tmp_path
+
+
+def upload(data):
+    return dra.save_upload(FileStorage(stream=io.BytesIO(data), filename='image.png'), 'avatars', 1024 * 1024)
+
+
+def blob(path):
+    with dra.app.app_context():
+        return dra.db.session.get(dra.UploadBlob, path)
+
+
+def age_blob(path, upload_root, seconds=3600):
+    past = time.time() - seconds
+    os.utime(os.path.join(upload_root, path), (past, past))
+    with dra.app.app_context():
+        dra.db.session.get(dra.UploadBlob, path).orphaned_at = dra.datetime.utcnow() - dra.timedelta(seconds=seconds)
+        dra.db.session.commit()
+
+
+def test_reference_counts_follow_assignments(lobby):
+    with dra.app.app_context():
+        first, second = upload(PNG), upload(OTHER_PNG)
+        user = dra.db.session.get(dra.User, lobby['alice'])
+        user.userImage = first
+        dra.db.session.commit()
+        user.userImage = second
+        dra.db.session.commit()
+        # A replaced path that never reaches a flush must not be counted later.
+        user.userImage = first
+        dra.db.session.rollback()
+        user.nickname = 'alice2'
+        dra.db.session.commit()
+
+    assert (blob(first).ref_count, blob(second).ref_count) == (0, 1)
+    assert blob(first).orphaned_at is not None
+    assert blob(second).orphaned_at is None
+
+
+def test_reupload_restarts_grace_period(upload_root):
+    with dra.app.app_context():
+        path = upload(PNG)
+        dra.db.session.commit()
+    age_blob(path, upload_root)
+
+    with dra.app.app_context():
+        assert upload(PNG) == path
+        dra.db.session.commit()
+        past = time.time() - 3600
+        os.utime(os.path.join(upload_root, path), (past, past))
+        assert dra.collect_orphaned_uploads(60) == 0
+    assert os.path.exists(os.path.join(upload_root, path))
+
+
+def test_reupload_during_collection_keeps_file(lobby, upload_root, monkeypatch):
+    with dra.app.app_context():
+        path = upload(PNG)
+        dra.db.session.commit()
+    age_blob(path, upload_root)
+    collecting = threading.Event()
+    remove_files = dra._remove_upload_files
+
+    def slow_remove(relative_path):
+        collecting.set()
+        time.sleep(0.3)
+        remove_files(relative_path)
+
+    monkeypatch.setattr(dra, '_remove_upload_files', slow_remove)
+
+    def collect():
+        with dra.app.app_context():
+            dra.collect_orphaned_uploads(60)
+            dra.db.session.remove()
+
+    collector = threading.Thread(target=collect)
+    collector.start()
+    assert collecting.wait(5)
+    with dra.app.app_context():
+        assert upload(PNG) == path
+        dra.db.session.get(dra.User, lobby['alice']).userImage = path
+        dra.db.session.commit()
+    collector.join()
+
+    assert blob(path).ref_count == 1
+    assert os.path.exists(os.path.join(upload_root, path))